@@ -1,13 +1,7 @@
-import sqlite3
-DB='data.db'
-conn=sqlite3.connect(DB)
-cur=conn.cursor()
-cols=[r[1] for r in cur.execute('PRAGMA table_info(workers)').fetchall()]
-print('existing cols:', cols)
-if 'education_type' not in cols:
-    cur.execute("ALTER TABLE workers ADD COLUMN education_type TEXT")
-    conn.commit()
-    print('added education_type')
-else:
-    print('education_type already exists')
-conn.close()
+import os
+from src.utils import migrations
+DB = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data.db')
+# education_type (and the other workers columns) are added by the versioned migrations
+before = migrations.current_version(DB)
+after = migrations.migrate(DB)
+print(f'schema version {before} -> {after}' if after != before else 'schema already up to date')
@@ -0,0 +1,95 @@
+"""Micro-benchmark: per-row haversine loop vs batched scoring (src/utils/scoring.py).
+
+Usage: python bench_scoring.py [repeats]
+
+Generates random workers around Damascus for 1k / 10k / 100k rows, checks that
+every path returns the same ranking as the old code and prints the timings.
+"""
+import sys
+import math
+import time
+import random
+
+from src.utils import scoring
+
+CENTER = (33.5138, 36.2765)
+RADIUS_KM = 100.0
+SIZES = (1_000, 10_000, 100_000)
+
+
+def calc_distance(loc1, loc2):
+    # copy of bot.calc_distance (importing bot.py needs telegram and a token)
+    try:
+        lat1, lon1 = loc1
+        lat2, lon2 = loc2
+        R = 6371.0
+        phi1 = math.radians(lat1)
+        phi2 = math.radians(lat2)
+        dphi = math.radians(lat2 - lat1)
+        dlambda = math.radians(lon2 - lon1)
+        a = math.sin(dphi/2)**2 + math.cos(phi1)*math.cos(phi2)*math.sin(dlambda/2)**2
+        return R * 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+    except Exception:
+        return float("inf")
+
+
+def legacy(rows):
+    out = []
+    for uid, lat, lon, level in rows:
+        try:
+            d = calc_distance(CENTER, (lat, lon))
+            if d <= RADIUS_KM:
+                out.append((int(level or 0), d, uid))
+        except Exception:
+            pass
+    out.sort(key=lambda x: (-x[0], x[1]))
+    return [uid for _, _, uid in out]
+
+
+def batched(rows, force_python=False):
+    lats = [r[1] for r in rows]; lons = [r[2] for r in rows]; levels = [r[3] for r in rows]
+    fn = scoring._rank_python if force_python else scoring.rank
+    if force_python:
+        ranked = fn(CENTER[0], CENTER[1], lats, lons, levels, RADIUS_KM, False)
+    else:
+        ranked = fn(CENTER[0], CENTER[1], lats, lons, levels, RADIUS_KM)
+    return [rows[i][0] for i, _, _ in ranked]
+
+
+def make_rows(n, rnd):
+    rows = []
+    for uid in range(n):
+        # ~2 degrees around the centre so part of them fall outside the radius
+        lat = CENTER[0] + rnd.uniform(-1.5, 1.5)
+        lon = CENTER[1] + rnd.uniform(-1.5, 1.5)
+        if rnd.random() < 0.01:
+            lat = None  # missing location
+        rows.append((uid, lat, lon, rnd.choice((0, 0, 0, 1, 2))))
+    return rows
+
+
+def best_of(fn, repeats):
+    best = float("inf")
+    for _ in range(repeats):
+        t = time.perf_counter(); fn(); best = min(best, time.perf_counter() - t)
+    return best * 1000.0
+
+
+def main():
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    rnd = random.Random(42)
+    print(f"numpy: {'yes ' + scoring.np.__version__ if scoring.np is not None else 'not installed (pure-Python fallback)'}")
+    print(f"{'workers':>8} | {'legacy ms':>10} | {'python ms':>10} | {'batched ms':>10} | speedup")
+    for n in SIZES:
+        rows = make_rows(n, rnd)
+        expected = legacy(rows)
+        assert batched(rows) == expected, "batched ranking differs from legacy"
+        assert batched(rows, force_python=True) == expected, "python ranking differs from legacy"
+        t_legacy = best_of(lambda: legacy(rows), repeats)
+        t_python = best_of(lambda: batched(rows, force_python=True), repeats)
+        t_batched = best_of(lambda: batched(rows), repeats)
+        print(f"{n:>8} | {t_legacy:>10.1f} | {t_python:>10.1f} | {t_batched:>10.1f} | x{t_legacy / t_batched:.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -7,7 +7,8 @@ import logging
 import asyncio
 import sys
 import re
-from datetime import datetime, timedelta
+from datetime import datetime
+from types import SimpleNamespace
 import random
 import string
 import time
@@ -15,6 +16,28 @@ import traceback
 from dotenv import load_dotenv
 import requests
 import psutil  # optional: for robust PID check (install psutil) or use os
+from src.utils import db  # shared long-lived SQLite connections (WAL, busy timeout)
+from src.utils import migrations  # versioned schema migrations (PRAGMA user_version)
+from src.utils import usage  # O(1) usage_stats via the requesters table
+from src.utils import seen_users  # in-memory set of already greeted users
+from src.utils import coupons  # index-backed, atomic coupon redemption
+from src.utils import coupon_guard  # in-memory unused-code check + per-user attempt limiter
+from src.utils import outbound  # rate limiter every Telegram request goes through
+from src.utils import db_executor  # awaitable DB calls: one writer thread + reader pool
+from src.utils import counters  # write-behind buffer for worker counters
+from src.utils import geo  # grid-cell spatial index for nearest-worker search
+from src.utils import worker_index  # resident per-service geo index of located workers
+from src.utils import scoring  # batched (NumPy) distance scoring and ranking
+from src.utils import result_pages  # top-K search results cached for paging
+from src.utils import search_cache  # candidate lists cached per (service, edu_type, grid cell)
+from src.utils import broadcast  # persisted, rate-limited broadcast jobs (admin "sta")
+from src.utils import reachability  # chats that blocked the bot, skipped by fan-outs
+from src.utils import outbox  # durable notifications delivered by a background dispatcher
+from src.utils import state_store  # TTL-bounded conversation state persisted in SQLite
+from src.utils import router  # precompiled label / command / (role, step) routing for handle_buttons
+from src.utils import labels  # precompiled Arabic normalisation + label variant index
+from src.utils import service_search  # trigram index suggesting services for mistyped text
+from src.utils import worker_search  # FTS5 keyword filter over worker names and specialisations
 
 load_dotenv()  # سيحمّل القيم من .env في مجلد المشروع
 
@@ -141,12 +164,12 @@ def make_reply_kb(rows, one_time=False):
         # fallback to the plain keyboard if anything goes wrong
         return ReplyKeyboardMarkup(rows, resize_keyboard=True, one_time_keyboard=one_time)
 
-user_states = {}
-workers = {}
 # background tasks started by the process (so we can cancel them on shutdown)
 BG_TASKS = []
 
 DB_PATH = os.path.join(os.path.dirname(__file__), "data.db")
+# multi-step conversation state: TTL-bounded, persisted so a restart resumes at the same step
+user_states = state_store.StateStore("bot", DB_PATH)
 LOCKFILE = os.path.join(os.path.dirname(__file__), "bot.lock")
 
 # Windows event loop policy (suppress DeprecationWarning when calling)
@@ -164,172 +187,54 @@ if sys.platform.startswith("win"):
         pass
 
 # ---------- DB init ----------
-def add_column_if_not_exists(conn, table, column_def):
-    """column_def example: 'appearance_count INTEGER DEFAULT 0'"""
-    colname = column_def.split()[0]
-    cur = conn.cursor()
-    cur.execute(f"PRAGMA table_info({table})")
-    cols = [r[1] for r in cur.fetchall()]
-    if colname not in cols:
-        cur.execute(f"ALTER TABLE {table} ADD COLUMN {column_def}")
-        conn.commit()
-
 def init_db():
     try:
         logging.info("Init DB -> %s", DB_PATH)
-        conn = sqlite3.connect(DB_PATH)
-        cur = conn.cursor()
-
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS workers (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER UNIQUE,
-            name TEXT,
-            phone TEXT,
-            work_type TEXT,
-            lat REAL,
-            lon REAL,
-            worker_code INTEGER,
-            coupon_code TEXT,
-            subscription_level INTEGER DEFAULT 0,
-            subscription_expiry TIMESTAMP
-        )
-        """)
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS clients (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            name TEXT,
-            phone TEXT,
-            service TEXT,
-            lat REAL,
-            lon REAL,
-            assigned_worker_id INTEGER,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-        """)
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS coupons (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            code TEXT UNIQUE,
-            amount INTEGER,
-            used INTEGER DEFAULT 0,
-            used_by_worker_user_id INTEGER,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            used_at TIMESTAMP
-        )
-        """)
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS ratings (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            worker_user_id INTEGER,
-            client_user_id INTEGER,
-            rating INTEGER,
-            comment TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-        """)
-
-        # usage_stats table to track total users/requests
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS usage_stats (
-            id INTEGER PRIMARY KEY CHECK (id = 1),
-            total_users INTEGER DEFAULT 0,
-            total_requests INTEGER DEFAULT 0
-        )
-        """)
-        cur.execute("INSERT OR IGNORE INTO usage_stats (id, total_users, total_requests) VALUES (1,0,0)")
-
-        # table to track if we've greeted a user before (so first-time users get the full menu)
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS seen_users (
-            user_id INTEGER PRIMARY KEY,
-            first_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-        """)
-
-        conn.commit()
-
-        # Ensure counter columns exist on workers (safe migration)
-        try:
-            add_column_if_not_exists(conn, "workers", "appearance_count INTEGER DEFAULT 0")
-            add_column_if_not_exists(conn, "workers", "ratings_received INTEGER DEFAULT 0")
-            add_column_if_not_exists(conn, "workers", "selected_count INTEGER DEFAULT 0")
-            # new column to record education service subtype for workers who register under educational services
-            add_column_if_not_exists(conn, "workers", "education_type TEXT")
-            # new column to record vehicle type for workers who register under vehicle-related services
-            add_column_if_not_exists(conn, "workers", "vehicle_type TEXT")
-            # new column to record the teacher's specialization within educational services
-            add_column_if_not_exists(conn, "workers", "education_specialization TEXT")
-            # new column to record company name for certain workers (e.g., فني انترنت)
-            add_column_if_not_exists(conn, "workers", "company_name TEXT")
-            # new column to mark the special service "حلاقتك في حوشك"
-            add_column_if_not_exists(conn, "workers", "halakat_hoosh TEXT")
-            # new column to record a general work specialization (e.g., for 'أرضيات')
-            add_column_if_not_exists(conn, "workers", "work_specialization TEXT")
-        except Exception:
-            logging.exception("Failed adding counter columns")
-
-        conn.commit()
-        conn.close()
-        logging.info("Database initialized / migrated successfully.")
+        # versioned migrations keyed on PRAGMA user_version (src/utils/migrations.py);
+        # an up-to-date database costs one PRAGMA read, no per-column probing
+        version = migrations.migrate(DB_PATH)
+        logging.info("Database initialized / migrated successfully (schema version %d).", version)
     except Exception:
         logging.exception("init_db error")
 
 # ---------- Counters / stats helpers ----------
 def increment_worker_appearance(worker_user_id, by=1):
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    try:
-        cur.execute("UPDATE workers SET appearance_count = COALESCE(appearance_count,0) + ? WHERE user_id = ?", (by, worker_user_id))
-        conn.commit()
-    finally:
-        conn.close()
+    # buffered; written in batches by counters.run_flusher / counters.flush
+    counters.add("appearance_count", worker_user_id, by)
 
 def increment_worker_selected(worker_user_id, by=1):
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    try:
-        cur.execute("UPDATE workers SET selected_count = COALESCE(selected_count,0) + ? WHERE user_id = ?", (by, worker_user_id))
-        conn.commit()
-    finally:
-        conn.close()
+    # buffered; written in batches by counters.run_flusher / counters.flush
+    counters.add("selected_count", worker_user_id, by)
 
 def increment_worker_ratings(worker_user_id, by=1):
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    try:
-        cur.execute("UPDATE workers SET ratings_received = COALESCE(ratings_received,0) + ? WHERE user_id = ?", (by, worker_user_id))
-        conn.commit()
-    finally:
-        conn.close()
+    # buffered; written in batches by counters.run_flusher / counters.flush
+    counters.add("ratings_received", worker_user_id, by)
 
-def increment_usage_on_request(user_id):
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    try:
-        # اذا هذه أول مرة يطلب فيها هذا المستخدم زِدّ total_users
-        cur.execute("SELECT COUNT(*) FROM clients WHERE user_id = ?", (user_id,))
-        prior = cur.fetchone()[0] or 0
-        if prior == 0:
-            cur.execute("UPDATE usage_stats SET total_users = COALESCE(total_users,0) + 1 WHERE id = 1")
-        # دوّن الطلب كـ total_requests
-        cur.execute("UPDATE usage_stats SET total_requests = COALESCE(total_requests,0) + 1 WHERE id = 1")
-        conn.commit()
-    finally:
-        conn.close()
+def assign_worker_to_client(client_id, worker_user_id, chooser_user_id):
+    """Record the chosen worker and queue their notification in one transaction.
+
+    Returns False if the request does not exist. Choosing the same worker
+    again for the same request queues no second notification.
+    """
+    with db.transaction(DB_PATH) as conn:
+        cur = conn.execute("UPDATE clients SET assigned_worker_id = ? WHERE id = ?", (worker_user_id, client_id))
+        if cur.rowcount != 1:
+            return False
+        outbox.enqueue(conn, worker_user_id, f"تم اختيارك لطلب رقم {client_id} من قبل المستخدم {chooser_user_id}.",
+                       dedupe_key=f"choose:{client_id}:{worker_user_id}")
+    return True
 
 # ---------- DB helpers (single copy) ----------
 def fetch_worker_by_code(code):
     try:
-        conn = sqlite3.connect(DB_PATH)
+        conn = db.connect(DB_PATH)
         cur = conn.cursor()
         cur.execute("SELECT id, user_id, name, phone, work_type, lat, lon, subscription_level, subscription_expiry, worker_code, education_type, education_specialization, vehicle_type, company_name, halakat_hoosh, work_specialization, appearance_count, ratings_received, selected_count FROM workers WHERE worker_code = ?", (code,))
         r = cur.fetchone()
         conn.close()
         if not r:
             return None
-        return {
+        w = {
             "id": r[0],
             "user_id": r[1],
             "name": r[2],
@@ -349,13 +254,18 @@ def fetch_worker_by_code(code):
             "ratings_received": r[17] or 0,
             "selected_count": r[18] or 0
         }
+        # include increments still waiting in the write-behind buffer
+        for col, delta in counters.pending_for(r[1]).items():
+            if col in w:
+                w[col] += delta
+        return w
     except Exception:
         logging.exception("fetch_worker_by_code failed")
         return None
 
 
 def save_worker_to_db(user_id, state):
-    conn = sqlite3.connect(DB_PATH)
+    conn = db.connect(DB_PATH)
     cur = conn.cursor()
     lat, lon = state.get("location", (None, None))
     cur.execute("SELECT id, worker_code FROM workers WHERE user_id = ?", (user_id,))
@@ -404,7 +314,7 @@ def save_worker_to_db(user_id, state):
 
 
 def save_client_request_to_db(user_id, state, req_id=None):
-    conn = sqlite3.connect(DB_PATH)
+    conn = db.connect(DB_PATH)
     cur = conn.cursor()
     lat, lon = state.get("location", (None, None))
     name = state.get("name")
@@ -416,15 +326,15 @@ def save_client_request_to_db(user_id, state, req_id=None):
         conn.commit()
         cid = req_id
     else:
-        cur.execute("INSERT INTO clients (user_id, name, phone, service, lat, lon) VALUES (?,?,?,?,?,?)",
-                    (user_id, name, phone, service, lat, lon))
-        conn.commit()
-        cid = cur.lastrowid
-        # تحديث إحصاءات الاستخدام عند إنشاء طلب جديد
         try:
-            increment_usage_on_request(user_id)
-        except Exception:
-            logging.exception("Failed to increment usage stats")
+            with db.transaction(DB_PATH) as tx:
+                cid = tx.execute("INSERT INTO clients (user_id, name, phone, service, lat, lon) VALUES (?,?,?,?,?,?)",
+                                 (user_id, name, phone, service, lat, lon)).lastrowid
+                # تحديث إحصاءات الاستخدام في نفس المعاملة مع الطلب الجديد
+                usage.record_request(tx, user_id)
+        finally:
+            conn.close()
+        return cid
     conn.close()
     return cid
 
@@ -432,22 +342,14 @@ def save_client_request_to_db(user_id, state, req_id=None):
 def mark_user_seen(user_id):
     """Return True if this is the first time we've seen this user (inserted), False otherwise."""
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cur = conn.cursor()
-        cur.execute("SELECT 1 FROM seen_users WHERE user_id = ?", (user_id,))
-        if cur.fetchone():
-            conn.close(); return False
-        cur.execute("INSERT INTO seen_users (user_id) VALUES (?)", (user_id,))
-        conn.commit(); conn.close(); return True
+        # known users are answered from the in-memory set; only misses reach SQLite
+        return seen_users.mark_seen(user_id, DB_PATH)
     except Exception:
-        try:
-            conn.close()
-        except Exception:
-            pass
+        logging.debug("mark_user_seen failed for user %s", user_id, exc_info=True)
         return False
 
 def save_rating_to_db(worker_user_id, client_user_id, rating, comment=None):
-    conn = sqlite3.connect(DB_PATH)
+    conn = db.connect(DB_PATH)
     cur = conn.cursor()
     try:
         cur.execute("INSERT INTO ratings (worker_user_id, client_user_id, rating, comment) VALUES (?,?,?,?)",
@@ -470,81 +372,36 @@ async def redeem_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # New helper: redeem and apply coupon to a worker (target_worker_user_id)
 def redeem_coupon_for_worker(code_input, requesting_user_id, target_worker_user_id=None, desired_tier=None):
     """Try to redeem coupon and apply subscription to target worker. Returns (ok:bool, msg:str)."""
-    if not code_input:
-        return False, "كود غير صالح."
-    raw = re.sub(r"[^\w\-]", "", code_input.strip().upper())
-    raw_nz = re.sub(r"^0+", "", raw)
-    candidates = []
-    for cand in (raw, raw_nz):
-        if cand:
-            candidates.append(cand)
-            if not cand.startswith("VIP-"):
-                candidates.append("VIP-" + cand)
-    seen = []
-    candidates = [c for c in candidates if c and (c not in seen and not seen.append(c))]
-
-    try:
-        conn = sqlite3.connect(DB_PATH)
-        cur = conn.cursor()
-        found = None
-        for c in candidates:
-            cur.execute("SELECT id, amount, used, code FROM coupons WHERE UPPER(code) = ?", (c.upper(),))
-            row = cur.fetchone()
-            if row:
-                found = row
-                break
-        if not found:
-            conn.close()
-            return False, "الكود غير موجود أو غير صالح."
-        cid, amount, used, actual_code = found
-        if used:
-            conn.close()
-            return False, "هذا الكود مُستخدم مسبقاً."
-
+    def plan(amount):
+        tier = desired_tier
+        if tier == "gold" and amount != 100:
+            return "هذا الكود ليس مخصصًا للفئة الذهبية. استخدم كودًا بقيمة 100 د.ل."
+        if tier == "silver" and amount != 60:
+            return "هذا الكود ليس مخصصًا للفئة الفضية. استخدم كودًا بقيمة 60 د.ل."
         # Determine desired tier if not provided: default to code amount mapping
-        if desired_tier:
-            if desired_tier == "gold" and int(amount) != 100:
-                conn.close(); return False, "هذا الكود ليس مخصصًا للفئة الذهبية. استخدم كودًا بقيمة 100 د.ل."
-            if desired_tier == "silver" and int(amount) != 60:
-                conn.close(); return False, "هذا الكود ليس مخصصًا للفئة الفضية. استخدم كودًا بقيمة 60 د.ل."
-        else:
-            # infer
-            if int(amount) == 100:
-                desired_tier = "gold"
-            elif int(amount) == 60:
-                desired_tier = "silver"
-            else:
-                desired_tier = "custom"
-
-        if desired_tier == "gold":
-            level = 1; days = 32; tier_name = "ذهبي"
-        elif desired_tier == "silver":
-            level = 2; days = 30; tier_name = "فضي"
-        else:
-            level = 0; days = 30; tier_name = f"({amount})"
-
-        expiry = datetime.utcnow() + timedelta(days=days)
-        expiry_iso = expiry.isoformat()
-
-        # choose target worker
-        if not target_worker_user_id:
-            target_worker_user_id = requesting_user_id
-
-        # mark coupon used and update worker
-        try:
-            cur.execute("UPDATE coupons SET used=1, used_by_worker_user_id=?, used_at=? WHERE id=?", (target_worker_user_id, expiry_iso, cid))
-            cur.execute("UPDATE workers SET subscription_level = ?, subscription_expiry = ?, coupon_code = ? WHERE user_id = ?",
-                        (level, expiry_iso, actual_code, target_worker_user_id))
-            conn.commit()
-            conn.close()
-            return True, f"تم تفعيل الاشتراك للفئة {tier_name}. سينتهي الاشتراك بتاريخ {expiry_iso}."
-        except Exception:
-            conn.close()
-            logging.exception("Error while marking coupon used in redeem_coupon_for_worker")
-            return False, "حدث خطأ أثناء تفعيل الكود. حاول مرة أخرى أو تواصل مع الدعم."
+        if not tier:
+            tier = {100: "gold", 60: "silver"}.get(amount, "custom")
+        if tier == "gold":
+            return 1, 32, "ذهبي"
+        if tier == "silver":
+            return 2, 30, "فضي"
+        return 0, 30, f"({amount})"
+
+    # choose target worker
+    if not target_worker_user_id:
+        target_worker_user_id = requesting_user_id
+    try:
+        # lookup, claim (UPDATE ... WHERE used=0) and the worker update share one transaction
+        ok, result = coupons.redeem(code_input, target_worker_user_id, plan, path=DB_PATH, requested_by=requesting_user_id)
     except Exception:
         logging.exception("redeem_coupon_for_worker failed")
         return False, "حدث خطأ أثناء معالجة الكود."
+    if not ok:
+        return False, result
+    conn = db.connect(DB_PATH)
+    worker_index.reload_worker(conn, target_worker_user_id)
+    conn.close()
+    return True, f"تم تفعيل الاشتراك للفئة {result['tier_name']}. سينتهي الاشتراك بتاريخ {result['expiry']}."
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
@@ -559,7 +416,7 @@ async def send_admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         subs = fetch_subscribers()
         sub_count = len(subs)
-        conn = sqlite3.connect(DB_PATH); cur = conn.cursor()
+        conn = db.connect(DB_PATH); cur = conn.cursor()
         cur.execute("SELECT COUNT(*) FROM workers"); workers_count = cur.fetchone()[0] or 0
         cur.execute("SELECT id, name, phone, work_type, worker_code, subscription_level, subscription_expiry FROM workers ORDER BY id DESC LIMIT 1000"); wrows = cur.fetchall()
         conn.close()
@@ -591,12 +448,14 @@ async def send_admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # New: compute average rating for a worker
 def fetch_rating_stats(worker_user_id):
     try:
-        conn = sqlite3.connect(DB_PATH)
+        conn = db.connect(DB_PATH)
         cur = conn.cursor()
-        cur.execute("SELECT COUNT(*), COALESCE(AVG(rating),0) FROM ratings WHERE worker_user_id = ?", (worker_user_id,))
-        cnt, avg = cur.fetchone()
+        # totals kept on the worker row by the ratings triggers (schema migration 5)
+        cur.execute("SELECT rating_count, rating_sum FROM workers WHERE user_id = ?", (worker_user_id,))
+        row = cur.fetchone()
         conn.close()
-        return (cnt or 0, float(avg or 0))
+        cnt, total = (row[0] or 0, row[1] or 0) if row else (0, 0)
+        return (cnt, total / cnt if cnt else 0.0)
     except Exception:
         logging.exception("fetch_rating_stats failed")
         return (0, 0.0)
@@ -605,7 +464,7 @@ def fetch_rating_stats(worker_user_id):
 def fetch_worker_by_userid(user_id):
     """Return worker dict by Telegram user_id or None."""
     try:
-        conn = sqlite3.connect(DB_PATH)
+        conn = db.connect(DB_PATH)
         cur = conn.cursor()
         cur.execute("SELECT id, user_id, name, phone, work_type, lat, lon, subscription_level, subscription_expiry, worker_code, education_type, education_specialization, vehicle_type, company_name, halakat_hoosh, appearance_count, ratings_received, selected_count FROM workers WHERE user_id = ?", (user_id,))
         cur.execute("SELECT id, user_id, name, phone, work_type, lat, lon, subscription_level, subscription_expiry, worker_code, education_type, education_specialization, vehicle_type, company_name, halakat_hoosh, work_specialization, appearance_count, ratings_received, selected_count FROM workers WHERE user_id = ?", (user_id,))
@@ -613,7 +472,7 @@ def fetch_worker_by_userid(user_id):
         conn.close()
         if not r:
             return None
-        return {
+        w = {
             "id": r[0],
             "user_id": r[1],
             "name": r[2],
@@ -633,10 +492,36 @@ def fetch_worker_by_userid(user_id):
             "ratings_received": r[17] or 0,
             "selected_count": r[18] or 0
         }
+        # include increments still waiting in the write-behind buffer
+        for col, delta in counters.pending_for(r[1]).items():
+            if col in w:
+                w[col] += delta
+        return w
     except Exception:
         logging.exception("fetch_worker_by_userid failed")
         return None
 
+async def start_broadcast(update: Update, text_orig):
+    """Queue the admin's broadcast as a background job. Returns False if there is nothing to send."""
+    # If admin replied to an existing message, copy that message (copy_message hides the original sender)
+    orig = getattr(update.message, "reply_to_message", None)
+    if not orig and not text_orig:
+        await update.message.reply_text("النص فارغ. الرجاء إدخال رسالة صحيحة أو الرد على رسالة لإعادة توجيهها.")
+        return False
+    progress = await update.message.reply_text("جارٍ تجهيز الإرسال...")
+    job_id, total = await db_executor.run_write(
+        broadcast.create_job, DB_PATH, update.effective_chat.id, progress.message_id,
+        text=None if orig else text_orig,
+        from_chat_id=orig.chat_id if orig else None, message_id=orig.message_id if orig else None)
+    if not total:
+        await db_executor.run_write(broadcast.cancel, DB_PATH, job_id)
+        await progress.edit_text("لا يوجد حرفيين مسجلين لإرسال الرسالة.")
+        return True
+    # the job runs in broadcast.run_worker; progress is edited into this message
+    await progress.edit_text(f"تمت جدولة الإرسال إلى {total} حرفي(ـًا) (مهمة #{job_id}).", reply_markup=broadcast.cancel_keyboard(job_id))
+    broadcast.notify()
+    return True
+
 # ---------- Bot handlers (continued) ----------
 async def handle_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
@@ -1326,7 +1211,7 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # Remaining unchanged code follows (identical to vscode-local copy)...
 from telegram import Update, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, ContextTypes, filters, CallbackQueryHandler
+from telegram.ext import Application, CommandHandler, MessageHandler, ContextTypes, filters, CallbackQueryHandler, TypeHandler
 import math
 import sqlite3
 import os
@@ -1334,7 +1219,8 @@ import logging
 import asyncio
 import sys
 import re
-from datetime import datetime, timedelta
+from datetime import datetime
+from types import SimpleNamespace
 import random
 import string
 import time
@@ -1384,11 +1270,12 @@ except NameError:
     MAIN_MENU_LAYOUT = [["🛠️ الخدمات", "📝 التسجيل للحرفيين"], ["🔓 تفعيل الاشتراك", "📊حسابي"], ["📜 نبذة عنا", "📞 تواصل معنا"]]
 MAIN_KB = ReplyKeyboardMarkup(MAIN_MENU_LAYOUT, resize_keyboard=True)
 
-user_states = {}
-workers = {}
-
 DB_PATH = os.path.join(os.path.dirname(__file__), "data.db")
+# multi-step conversation state: TTL-bounded, persisted so a restart resumes at the same step
+user_states = state_store.StateStore("bot", DB_PATH)
 LOCKFILE = os.path.join(os.path.dirname(__file__), "bot.lock")
+# clients see workers up to this distance (km)
+CLIENT_MAX_KM = 100.0
 
 # Windows event loop policy (suppress DeprecationWarning when calling)
 import sys, asyncio
@@ -1405,245 +1292,115 @@ if sys.platform.startswith("win"):
         pass
 
 # ---------- DB init ----------
-def add_column_if_not_exists(conn, table, column_def):
-    """column_def example: 'appearance_count INTEGER DEFAULT 0'"""
-    colname = column_def.split()[0]
-    cur = conn.cursor()
-    cur.execute(f"PRAGMA table_info({table})")
-    cols = [r[1] for r in cur.fetchall()]
-    if colname not in cols:
-        cur.execute(f"ALTER TABLE {table} ADD COLUMN {column_def}")
-        conn.commit()
-
 def init_db():
     try:
         logging.info("Init DB -> %s", DB_PATH)
-        conn = sqlite3.connect(DB_PATH)
-        cur = conn.cursor()
-
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS workers (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER UNIQUE,
-            name TEXT,
-            phone TEXT,
-            work_type TEXT,
-            lat REAL,
-            lon REAL,
-            worker_code INTEGER,
-            coupon_code TEXT,
-            subscription_level INTEGER DEFAULT 0,
-            subscription_expiry TIMESTAMP
-        )
-        """)
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS clients (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            name TEXT,
-            phone TEXT,
-            service TEXT,
-            lat REAL,
-            lon REAL,
-            assigned_worker_id INTEGER,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-        """)
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS coupons (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            code TEXT UNIQUE,
-            amount INTEGER,
-            used INTEGER DEFAULT 0,
-            used_by_worker_user_id INTEGER,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            used_at TIMESTAMP
-        )
-        """)
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS ratings (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            worker_user_id INTEGER,
-            client_user_id INTEGER,
-            rating INTEGER,
-            comment TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-        """)
-
-        # usage_stats table to track total users/requests
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS usage_stats (
-            id INTEGER PRIMARY KEY CHECK (id = 1),
-            total_users INTEGER DEFAULT 0,
-            total_requests INTEGER DEFAULT 0
-        )
-        """)
-        cur.execute("INSERT OR IGNORE INTO usage_stats (id, total_users, total_requests) VALUES (1,0,0)")
-
-        # table to track if we've greeted a user before (so first-time users get the full menu)
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS seen_users (
-            user_id INTEGER PRIMARY KEY,
-            first_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-        """)
-
-        conn.commit()
-
-        # Ensure counter columns exist on workers (safe migration)
-        try:
-            add_column_if_not_exists(conn, "workers", "appearance_count INTEGER DEFAULT 0")
-            add_column_if_not_exists(conn, "workers", "ratings_received INTEGER DEFAULT 0")
-            add_column_if_not_exists(conn, "workers", "selected_count INTEGER DEFAULT 0")
-            # new column to record education service subtype for workers who register under educational services
-            add_column_if_not_exists(conn, "workers", "education_type TEXT")
-        except Exception:
-            logging.exception("Failed adding counter columns")
-
-        conn.commit()
-        conn.close()
-        logging.info("Database initialized / migrated successfully.")
+        # versioned migrations keyed on PRAGMA user_version (src/utils/migrations.py);
+        # an up-to-date database costs one PRAGMA read, no per-column probing
+        version = migrations.migrate(DB_PATH)
+        logging.info("Database initialized / migrated successfully (schema version %d).", version)
     except Exception:
         logging.exception("init_db error")
 
 # ---------- Counters / stats helpers ----------
 def increment_worker_appearance(worker_user_id, by=1):
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    try:
-        cur.execute("UPDATE workers SET appearance_count = COALESCE(appearance_count,0) + ? WHERE user_id = ?", (by, worker_user_id))
-        conn.commit()
-    finally:
-        conn.close()
+    # buffered; written in batches by counters.run_flusher / counters.flush
+    counters.add("appearance_count", worker_user_id, by)
 
 def increment_worker_selected(worker_user_id, by=1):
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    try:
-        cur.execute("UPDATE workers SET selected_count = COALESCE(selected_count,0) + ? WHERE user_id = ?", (by, worker_user_id))
-        conn.commit()
-    finally:
-        conn.close()
+    # buffered; written in batches by counters.run_flusher / counters.flush
+    counters.add("selected_count", worker_user_id, by)
 
 def increment_worker_ratings(worker_user_id, by=1):
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    try:
-        cur.execute("UPDATE workers SET ratings_received = COALESCE(ratings_received,0) + ? WHERE user_id = ?", (by, worker_user_id))
-        conn.commit()
-    finally:
-        conn.close()
+    # buffered; written in batches by counters.run_flusher / counters.flush
+    counters.add("ratings_received", worker_user_id, by)
 
-def increment_usage_on_request(user_id):
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    try:
-        # اذا هذه أول مرة يطلب فيها هذا المستخدم زِدّ total_users
-        cur.execute("SELECT COUNT(*) FROM clients WHERE user_id = ?", (user_id,))
-        prior = cur.fetchone()[0] or 0
-        if prior == 0:
-            cur.execute("UPDATE usage_stats SET total_users = COALESCE(total_users,0) + 1 WHERE id = 1")
-        # دوّن الطلب كـ total_requests
-        cur.execute("UPDATE usage_stats SET total_requests = COALESCE(total_requests,0) + 1 WHERE id = 1")
-        conn.commit()
-    finally:
-        conn.close()
+def assign_worker_to_client(client_id, worker_user_id, chooser_user_id):
+    """Record the chosen worker and queue their notification in one transaction.
+
+    Returns False if the request does not exist. Choosing the same worker
+    again for the same request queues no second notification.
+    """
+    with db.transaction(DB_PATH) as conn:
+        cur = conn.execute("UPDATE clients SET assigned_worker_id = ? WHERE id = ?", (worker_user_id, client_id))
+        if cur.rowcount != 1:
+            return False
+        outbox.enqueue(conn, worker_user_id, f"تم اختيارك لطلب رقم {client_id} من قبل المستخدم {chooser_user_id}.",
+                       dedupe_key=f"choose:{client_id}:{worker_user_id}")
+    return True
 
 # ---------- DB helpers (single copy) ----------
 def save_worker_to_db(user_id, state):
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
     lat, lon = state.get("location", (None, None))
-    cur.execute("SELECT id, worker_code FROM workers WHERE user_id = ?", (user_id,))
-    existing = cur.fetchone()
-    if existing:
-        row_id, worker_code = existing
-        cur.execute("UPDATE workers SET name = ?, phone = ?, work_type = ?, lat = ?, lon = ?, education_type = ? WHERE user_id = ?",
-                    (state.get("name"), state.get("phone"), state.get("work_type"), lat, lon, state.get("edu_type"), user_id))
-        # apply subscription fields if present in state
-        if state.get("subscription_level") or state.get("subscription_expiry") or state.get("coupon_code"):
+    # one transaction: a failure part-way leaves nothing behind on the shared connection
+    with db.transaction(DB_PATH) as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT id, worker_code FROM workers WHERE user_id = ?", (user_id,))
+        existing = cur.fetchone()
+        if existing:
+            row_id, worker_code = existing
+            cur.execute("UPDATE workers SET name = ?, phone = ?, work_type = ?, lat = ?, lon = ?, geo_cell = ?, education_type = ? WHERE user_id = ?",
+                        (state.get("name"), state.get("phone"), state.get("work_type"), lat, lon, geo.cell_of(lat, lon), state.get("edu_type"), user_id))
+            # apply subscription fields if present in state
+            if state.get("subscription_level") or state.get("subscription_expiry") or state.get("coupon_code"):
+                try:
+                    cur.execute("UPDATE workers SET subscription_level = ?, subscription_expiry = ?, coupon_code = ? WHERE user_id = ?",
+                                (state.get("subscription_level"), state.get("subscription_expiry"), state.get("coupon_code"), user_id))
+                except Exception:
+                    logging.debug("Could not update subscription fields for existing worker")
+            if not worker_code:
+                worker_code = 2000 + row_id
+                try:
+                    cur.execute("UPDATE workers SET worker_code = ? WHERE id = ?", (worker_code, row_id))
+                except Exception:
+                    pass
+        else:
+            cur.execute("INSERT INTO workers (user_id, name, phone, work_type, lat, lon, geo_cell, education_type) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                        (user_id, state.get("name"), state.get("phone"), state.get("work_type"), lat, lon, geo.cell_of(lat, lon), state.get("edu_type")))
+            rowid = cur.lastrowid
+            worker_code = 2000 + rowid
             try:
-                cur.execute("UPDATE workers SET subscription_level = ?, subscription_expiry = ?, coupon_code = ? WHERE user_id = ?",
-                            (state.get("subscription_level"), state.get("subscription_expiry"), state.get("coupon_code"), user_id))
+                cur.execute("UPDATE workers SET worker_code = ? WHERE id = ?", (worker_code, rowid))
             except Exception:
-                logging.debug("Could not update subscription fields for existing worker")
-        if not worker_code:
-            worker_code = 2000 + row_id
+                pass
+            # بعد الإدراج، طبق حقول الاشتراك إن وُجدت
             try:
-                cur.execute("UPDATE workers SET worker_code = ? WHERE id = ?", (worker_code, row_id))
+                if state.get("subscription_level") or state.get("subscription_expiry") or state.get("coupon_code"):
+                    cur.execute("UPDATE workers SET subscription_level = ?, subscription_expiry = ?, coupon_code = ? WHERE id = ?",
+                                (state.get("subscription_level"), state.get("subscription_expiry"), state.get("coupon_code"), rowid))
             except Exception:
-                pass
-        conn.commit()
-        conn.close()
-        return worker_code
-
-    cur.execute("INSERT INTO workers (user_id, name, phone, work_type, lat, lon, education_type) VALUES (?, ?, ?, ?, ?, ?, ?)",
-                (user_id, state.get("name"), state.get("phone"), state.get("work_type"), lat, lon, state.get("edu_type")))
-    conn.commit()
-    rowid = cur.lastrowid
-    worker_code = 2000 + rowid
-    try:
-        cur.execute("UPDATE workers SET worker_code = ? WHERE id = ?", (worker_code, rowid))
-        conn.commit()
-    except Exception:
-        pass
-    # بعد الإدراج، طبق حقول الاشتراك إن وُجدت
-    try:
-        if state.get("subscription_level") or state.get("subscription_expiry") or state.get("coupon_code"):
-            cur.execute("UPDATE workers SET subscription_level = ?, subscription_expiry = ?, coupon_code = ? WHERE id = ?",
-                        (state.get("subscription_level"), state.get("subscription_expiry"), state.get("coupon_code"), rowid))
-            conn.commit()
-    except Exception:
-        logging.debug("Could not set subscription fields for new worker")
-    conn.close()
+                logging.debug("Could not set subscription fields for new worker")
+    worker_index.reload_worker(db.get_conn(DB_PATH), user_id)  # keep the in-memory geo index current
     return worker_code
 
 def save_client_request_to_db(user_id, state, req_id=None):
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
     lat, lon = state.get("location", (None, None))
     name = state.get("name")
     phone = state.get("phone")
     service = state.get("service")
-    if req_id:
-        cur.execute("UPDATE clients SET user_id=?, name=?, phone=?, service=?, lat=?, lon=?, created_at=CURRENT_TIMESTAMP WHERE id=?",
-                    (user_id, name, phone, service, lat, lon, req_id))
-        conn.commit()
-        cid = req_id
-    else:
-        cur.execute("INSERT INTO clients (user_id, name, phone, service, lat, lon) VALUES (?,?,?,?,?,?)",
-                    (user_id, name, phone, service, lat, lon))
-        conn.commit()
-        cid = cur.lastrowid
-        # تحديث إحصاءات الاستخدام عند إنشاء طلب جديد
-        try:
-            increment_usage_on_request(user_id)
-        except Exception:
-            logging.exception("Failed to increment usage stats")
-    conn.close()
+    with db.transaction(DB_PATH) as tx:
+        if req_id:
+            tx.execute("UPDATE clients SET user_id=?, name=?, phone=?, service=?, lat=?, lon=?, created_at=CURRENT_TIMESTAMP WHERE id=?",
+                       (user_id, name, phone, service, lat, lon, req_id))
+            return req_id
+        cid = tx.execute("INSERT INTO clients (user_id, name, phone, service, lat, lon) VALUES (?,?,?,?,?,?)",
+                         (user_id, name, phone, service, lat, lon)).lastrowid
+        # تحديث إحصاءات الاستخدام في نفس المعاملة مع الطلب الجديد
+        usage.record_request(tx, user_id)
     return cid
 
 
 def mark_user_seen(user_id):
     """Return True if this is the first time we've seen this user (inserted), False otherwise."""
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cur = conn.cursor()
-        cur.execute("SELECT 1 FROM seen_users WHERE user_id = ?", (user_id,))
-        if cur.fetchone():
-            conn.close(); return False
-        cur.execute("INSERT INTO seen_users (user_id) VALUES (?)", (user_id,))
-        conn.commit(); conn.close(); return True
+        # known users are answered from the in-memory set; only misses reach SQLite
+        return seen_users.mark_seen(user_id, DB_PATH)
     except Exception:
-        try:
-            conn.close()
-        except Exception:
-            pass
+        logging.debug("mark_user_seen failed for user %s", user_id, exc_info=True)
         return False
 
 def save_rating_to_db(worker_user_id, client_user_id, rating, comment=None):
-    conn = sqlite3.connect(DB_PATH)
+    conn = db.connect(DB_PATH)
     cur = conn.cursor()
     try:
         cur.execute("INSERT INTO ratings (worker_user_id, client_user_id, rating, comment) VALUES (?,?,?,?)",
@@ -1657,6 +1414,33 @@ def save_rating_to_db(worker_user_id, client_user_id, rating, comment=None):
     finally:
         conn.close()
 
+def reserve_registration_coupon(code_input, user_id, desired):
+    """Mark a coupon used for a worker still registering.
+
+    Returns (ok, message, subscription_fields); the fields are kept in the
+    registration state and saved with the worker once the location arrives.
+    """
+    def plan(amount):
+        if desired == "gold" and amount != 100:
+            return "هذا الكود ليس مخصصًا للفئة الذهبية. استخدم كودًا بفئة 100 د.ل."
+        if desired == "silver" and amount != 60:
+            return "هذا الكود ليس مخصصًا للفئة الفضية. استخدم كودًا بفئة 60 د.ل."
+        # تحديد المستوى والمدة حسب الاختيار (التوافق مع متطلباتك)
+        if desired == "gold":
+            return 1, 32, "ذهبي"
+        return 2, 30, "فضي"
+
+    try:
+        # وسم القسيمة كمستخدمة (claim ذري: ينجح طلب واحد فقط لنفس الكود)
+        ok, result = coupons.redeem(code_input, user_id, plan, path=DB_PATH, update_worker=False, requested_by=user_id)
+    except Exception:
+        logging.exception("Error while marking coupon used")
+        return False, "حدث خطأ أثناء تفعيل الكود. حاول مرة أخرى أو تواصل مع الدعم.", {}
+    if not ok:
+        return False, result, {}
+    sub_fields = {"subscription_level": result["level"], "subscription_expiry": result["expiry"], "coupon_code": result["code"]}
+    return True, f"تم قبول الكود للفئة {result['tier_name']}. الآن اضغط 'إرسال الموقع' لمشاركة موقعك:", sub_fields
+
 # ---------- Bot handlers ----------
 async def redeem_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
@@ -1676,7 +1460,7 @@ async def send_admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         subs = fetch_subscribers()
         sub_count = len(subs)
-        conn = sqlite3.connect(DB_PATH); cur = conn.cursor()
+        conn = db.connect(DB_PATH); cur = conn.cursor()
         cur.execute("SELECT COUNT(*) FROM workers"); workers_count = cur.fetchone()[0] or 0
         cur.execute("SELECT id, name, phone, work_type, worker_code, subscription_level, subscription_expiry FROM workers ORDER BY id DESC LIMIT 1000"); wrows = cur.fetchall()
         conn.close()
@@ -1705,6 +1489,340 @@ async def send_admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         await update.message.reply_text(workers_text)
 
+# ---------- handle_buttons routes (see src/utils/router.py) ----------
+
+EDU_KB_ROWS = [["تمهيدي", "إعدادي"], ["ثانوي أو معهد", "اكاديمي"]]
+WORKER_REG_KEYS = ("التسجيل للحرفيين", "📝 التسجيل للحرفيين")
+
+# typed variants (no emoji, no "ال", other hamza forms) -> the exact label the routes use
+BUTTON_LABELS = labels.LabelIndex()
+for _keys in (CONTACT_KEYS, ABOUT_KEYS, SERVICE_KEYS, WORKER_REG_KEYS, ("التسجيل للعملاء", "التجيل للعملاء"), WORK_TYPES):
+    for _label in sorted(_keys):
+        BUTTON_LABELS.add(_label, _label)
+# education divisions are stored as the keyboard labels
+EDU_LABELS = labels.LabelIndex()
+for _row in EDU_KB_ROWS:
+    for _label in _row:
+        EDU_LABELS.add(_label, _label)
+
+
+def _service_catalogue():
+    """(label, service) pairs for typo-tolerant suggestions; every service is one of WORK_TYPES."""
+    pairs = [(w, w) for w in WORK_TYPES]
+    for cat, services in SERVICE_CATEGORIES.items():
+        for label in (cat, *services):
+            target = BUTTON_LABELS.get(label)
+            if target in WORK_TYPES:
+                pairs.append((label, target))
+    pairs.extend((alias, "الخدمات التعليمية") for alias in sorted(EDUCATION_SERVICE_ALIASES))
+    return pairs
+
+
+service_search.build(_service_catalogue())
+
+
+def _location_kb():
+    return ReplyKeyboardMarkup([[KeyboardButton("إرسال الموقع", request_location=True)]], resize_keyboard=True, one_time_keyboard=True)
+
+
+def _contact_kb():
+    return ReplyKeyboardMarkup([[KeyboardButton("مشاركة جهة الاتصال", request_contact=True)]], resize_keyboard=True, one_time_keyboard=True)
+
+
+def _profile_name_and_phone(update):
+    name = None
+    if update.effective_user:
+        fn = update.effective_user.first_name or ""; ln = update.effective_user.last_name or ""; name = (fn + " " + ln).strip() or None
+    contact = getattr(update.message, "contact", None)
+    phone = contact.phone_number if contact and getattr(contact, "phone_number", None) else None
+    return name, phone
+
+
+async def _route_admin_panel(ctx):
+    await send_admin_panel(ctx.update, ctx.context)
+
+
+async def _route_broadcast_start(ctx):
+    # send-to-all shortcut for the admin: the next message (or a reply to one) is broadcast to all workers
+    user_states[ctx.user_id] = {"role": "broadcast", "step": "compose"}
+    await ctx.update.message.reply_text("أرسل النص الذي تريد إرساله لجميع الحرفيين أو قم بالرد على رسالة موجودة لإعادة توجيهها (forward) إليهم:")
+
+
+async def _route_contact(ctx):
+    phone_local = "0916564000"; phone_international = "+218916564000"; wa_number = "218916564000"
+    try:
+        await ctx.update.message.reply_contact(phone_number=phone_international, first_name="فريق الدعم")
+    except Exception:
+        logging.debug("reply_contact failed")
+    wa_btn = InlineKeyboardMarkup([[InlineKeyboardButton("مراسلتنا عبر واتساب", url=f"https://wa.me/{wa_number}")]])
+    # include phone number with phone emoji in the reply
+    await ctx.update.message.reply_text(f"📞 للتواصل الهاتفي: {phone_local}\n\nيمكنك أيضًا مراسلتنا عبر واتساب:", reply_markup=wa_btn)
+
+
+async def _route_about(ctx):
+    about_text = (
+        "بوت خدمتي | تأسس عام 2025\n\n"
+        "نحن بوت تيليجرام يهدف إلى تسهيل طلب الخدمات بين العملاء والحرفيين.\n"
+        "كل ما عليك هو اختيار الخدمة المناسبة ثم إرسال موقعك، وسيعرض لك البوت أقرب حرفي مع جميع بيانات التواصل.\n\n"
+        "✅ الخدمة مجانية تمامًا للعملاء\n"
+        "💼 واشتراك رمزي للحرفيين\n\n"
+        "لأي استفسار أو دعم، لا تتردد في التواصل معنا 💬"
+    )
+    await ctx.update.message.reply_text(about_text, reply_markup=ReplyKeyboardRemove())
+    await ctx.update.message.reply_text("الرجوع إلى القائمة الرئيسية:", reply_markup=MAIN_KB)
+
+
+async def _route_client_registration_removed(ctx):
+    await ctx.update.message.reply_text("تمت إزالة خاصية تسجيل العملاء. عند رغبتك بطلب خدمة اختر 'الخدمات' ثم تابع الخطوات لمشاركة بياناتك وموقعك وسيُسجل الطلب مباشرة.")
+
+
+async def _route_request_lookup(ctx):
+    req = await db_executor.run_read(fetch_client_request_by_id, int(ctx.text))
+    if not req:
+        return False
+    await ctx.update.message.reply_text(f"تم العثور على طلب رقم {req['id']} — الاسم: {req['name'] or '-'} — الهاتف: {req['phone'] or '-'}")
+
+
+async def _route_subscriber_start(ctx):
+    name, phone = _profile_name_and_phone(ctx.update)
+    user_states[ctx.user_id] = {"role": "subscriber", "step": ("location" if phone else "phone"), "name": name, "phone": phone}
+    if phone:
+        await ctx.update.message.reply_text(f"تم استخدام اسم ملفك الشخصي: {name or 'غير متوفر'}\nالآن اضغط لإرسال موقعك:", reply_markup=_location_kb())
+    else:
+        await ctx.update.message.reply_text(f"سيُستخدم اسم ملفك الشخصي: {name or 'غير متوفر'}\nالرجاء مشاركة رقم هاتفك بالزر أدناه:", reply_markup=_contact_kb())
+
+
+async def _route_worker_start(ctx):
+    user_states[ctx.user_id] = {"role": "worker", "step": "name"}
+    await ctx.update.message.reply_text("سجل كعامل - يرجى إدخال اسمك:")
+
+
+async def _route_services(ctx):
+    user_states.pop(ctx.user_id, None)
+    kb = ReplyKeyboardMarkup([[w] for w in WORK_TYPES], resize_keyboard=True, one_time_keyboard=True)
+    await ctx.update.message.reply_text("اختر الخدمة المطلوبة:", reply_markup=kb)
+
+
+async def _route_client_start(ctx):
+    text = ctx.label
+    name, phone = _profile_name_and_phone(ctx.update)
+    state = {"role": "client", "service": text, "name": name, "phone": phone}
+    # If client requested educational services, ask which teaching division they want
+    if text == "الخدمات التعليمية":
+        state["step"] = "edu_choice"
+        user_states[ctx.user_id] = state
+        edu_kb = ReplyKeyboardMarkup(EDU_KB_ROWS, resize_keyboard=True, one_time_keyboard=True)
+        await ctx.update.message.reply_text(f"لقد اخترت: {text}\nاختر قسم التدريس المناسب للمعلم الذي تريده:", reply_markup=edu_kb)
+        return
+    if phone:
+        state["step"] = "location"; user_states[ctx.user_id] = state
+        await ctx.update.message.reply_text(f"لقد اخترت: {text}\nالاسم المستخدم: {name or 'غير متوفر'}\nالآن شارك موقعك:", reply_markup=_location_kb())
+    else:
+        state["step"] = "phone"; user_states[ctx.user_id] = state
+        await ctx.update.message.reply_text(f"لقد اخترت: {text}\nسيُستخدم اسم ملفك الشخصي: {name or 'غير متوفر'}\nالرجاء مشاركة رقم هاتفك بالزر أدناه:", reply_markup=_contact_kb())
+
+
+async def _route_broadcast_compose(ctx):
+    if await start_broadcast(ctx.update, ctx.text_orig):
+        user_states.pop(ctx.user_id, None)
+
+
+# subscriber flow
+async def _route_subscriber_name(ctx):
+    state = ctx.state
+    state["name"] = ctx.text; state["step"] = "phone"
+    await ctx.update.message.reply_text("يرجى إدخال رقم هاتفك أو مشاركة جهة الاتصال:")
+
+
+async def _route_subscriber_phone(ctx):
+    state = ctx.state
+    if not is_valid_phone(ctx.text):
+        await ctx.update.message.reply_text("رقم الهاتف غير صالح. ارسله بصيغة 091xxxxxxx أو 9xxxxxxx أو +2189xxxxxxx."); return
+    state["phone"] = normalize_phone(ctx.text); state["step"] = "location"
+    await ctx.update.message.reply_text("الآن اضغط 'إرسال الموقع' لمشاركة موقعك:", reply_markup=_location_kb())
+
+
+# client flow
+async def _route_client_request_id(ctx):
+    state, text = ctx.state, ctx.text
+    if text.isdigit():
+        req = await db_executor.run_read(fetch_client_request_by_id, int(text))
+        if req:
+            state["name"] = req.get("name"); state["phone"] = req.get("phone")
+            state["step"] = "location" if state.get("phone") else "phone"
+            await ctx.update.message.reply_text("تم استرجاع بيانات الطلب. أرسل موقعك أو أدخل هاتفك:", reply_markup=_location_kb()); return
+    await ctx.update.message.reply_text("رمز الطلب غير صحيح. اعد المحاولة أو اكتب اسمك."); state["step"] = "name"
+
+
+async def _route_client_name(ctx):
+    state, text = ctx.state, ctx.text
+    if text.isdigit():
+        sub = await db_executor.run_read(fetch_subscriber_by_id, int(text))
+        if sub:
+            state["name"] = sub["name"]; state["phone"] = sub.get("phone"); state["step"] = "location" if state.get("phone") else "phone"
+            await ctx.update.message.reply_text("تم استرجاع بيانات المشترك. أرسل موقعك أو أدخل هاتفك:", reply_markup=_location_kb()); return
+        req = await db_executor.run_read(fetch_client_request_by_id, int(text))
+        if req:
+            state["request_id"] = req["id"]; state["name"] = req.get("name"); state["phone"] = req.get("phone"); state["step"] = "location" if state.get("phone") else "phone"
+            await ctx.update.message.reply_text("تم استرجاع بيانات الطلب. أرسل موقعك أو ادخل هاتفك:", reply_markup=_location_kb()); return
+    state["name"] = text; state["step"] = "phone"; await ctx.update.message.reply_text("يرجى إدخال رقم هاتفك أو مشاركة جهة الاتصال:")
+
+
+async def _route_client_phone(ctx):
+    state = ctx.state
+    if not is_valid_phone(ctx.text):
+        await ctx.update.message.reply_text("رقم الهاتف غير صالح. ارسله بصيغة 091xxxxxxx أو +2189xxxxxxx."); return
+    state["phone"] = normalize_phone(ctx.text); state["step"] = "location"
+    await ctx.update.message.reply_text("الآن اضغط 'إرسال الموقع' لمشاركة موقعك:", reply_markup=_location_kb())
+
+
+async def _route_client_edu_choice(ctx):
+    state = ctx.state
+    # client chose which teaching division they want
+    state["edu_type"] = EDU_LABELS.get(ctx.text, ctx.text)
+    # after selecting edu_type proceed to phone/location as usual
+    if state.get("phone"):
+        state["step"] = "location"
+        await ctx.update.message.reply_text(f"لقد اخترت: {state.get('edu_type')}\nالآن شارك موقعك:", reply_markup=_location_kb())
+    else:
+        state["step"] = "phone"
+        await ctx.update.message.reply_text(f"لقد اخترت: {state.get('edu_type')}\nالرجاء مشاركة رقم هاتفك بالزر أدناه:", reply_markup=_contact_kb())
+
+
+# worker flow
+async def _route_worker_name(ctx):
+    state = ctx.state
+    state["name"] = ctx.text; state["step"] = "work_type"
+    kb = ReplyKeyboardMarkup([[w] for w in WORK_TYPES], resize_keyboard=True, one_time_keyboard=True)
+    await ctx.update.message.reply_text("اختر نوع عملك:", reply_markup=kb)
+
+
+async def _route_worker_work_type(ctx):
+    state, text = ctx.state, ctx.label
+    if text not in WORK_TYPES:
+        await ctx.update.message.reply_text("الرجاء اختيار نوع العمل من الأزرار."); return
+    state["work_type"] = text
+    # Special flow for educational services: ask for specific edu type to organize later
+    if text == "الخدمات التعليمية":
+        state["step"] = "edu_type"
+        edu_kb = ReplyKeyboardMarkup(EDU_KB_ROWS, resize_keyboard=True, one_time_keyboard=True)
+        await ctx.update.message.reply_text("اختر قسم التدريس المناسب لك (تمهيدي / إعدادي / ثانوي أو معهد / اكاديمي):", reply_markup=edu_kb)
+    else:
+        state["step"] = "phone"
+        await ctx.update.message.reply_text("يرجى إدخال رقم هاتفك أو مشاركة جهة الاتصال:")
+
+
+async def _route_worker_edu_type(ctx):
+    # store the educational service subtype and continue to phone step
+    ctx.state["edu_type"] = EDU_LABELS.get(ctx.text, ctx.text)
+    ctx.state["step"] = "phone"
+    await ctx.update.message.reply_text("شكرًا. الآن ادخل رقم هاتفك أو شارك جهة الاتصال:")
+
+
+async def _route_worker_phone(ctx):
+    state = ctx.state
+    raw = ctx.text; logging.info("Worker phone raw input: %r from user %s", raw, ctx.user_id)
+    norm = normalize_phone(raw)
+    if not norm:
+        await ctx.update.message.reply_text("رقم الهاتف غير صالح. ارسله بصيغة 0912xxxxxx أو +2189xxxxxxx. حاول مرة أخرى:"); return
+    state["phone"] = norm
+    state["step"] = "choose_sub"
+    # عرض أزرار اختيار الفئة بدل طلب الكود مباشرة
+    sub_kb = InlineKeyboardMarkup([
+        [InlineKeyboardButton("الفئة الذهبية — 100 د.ل", callback_data=f"pick_sub:gold")],
+        [InlineKeyboardButton("الفئة الفضية — 60 د.ل", callback_data=f"pick_sub:silver")]
+    ])
+    await ctx.update.message.reply_text("اختر نوع الاشتراك الذي تريد تفعيله ثم أدخل كود القسيمة المناسب:", reply_markup=sub_kb)
+
+
+async def _route_worker_coupon(ctx):
+    state, user_id = ctx.state, ctx.user_id
+    code_input = ctx.text.strip()
+    if not code_input:
+        await ctx.update.message.reply_text("الرجاء إدخال كود صالح."); return
+    ok, msg, sub_fields = await db_executor.run_write(reserve_registration_coupon, code_input, user_id, state.get("desired_tier"))
+    if not ok:
+        await ctx.update.message.reply_text(msg); return
+    # خزّن معلومات الاشتراك مؤقتاً في state (سيتم حفظها عند حفظ العامل بعد الموقع)
+    state.update(sub_fields)
+    state["step"] = "location"
+    user_states[user_id] = state
+    await ctx.update.message.reply_text(msg, reply_markup=_location_kb())
+
+
+async def _route_client_results(ctx):
+    # results are on screen: a service or request id starts over, any other text is a keyword
+    state = ctx.state
+    if ctx.label in WORK_TYPES:
+        user_states.pop(ctx.user_id, None)
+        return await _route_client_start(ctx)
+    if ctx.text.isdigit():
+        return await _route_request_lookup(ctx)
+    if not worker_search.match_query(ctx.text):
+        return False
+    lat, lon = state["location"]
+    candidates = await db_executor.run_read(fetch_workers_by_service, state.get("service"), edu_type=state.get("edu_type"),
+                                            near=(lat, lon), radius_km=CLIENT_MAX_KM, keyword=ctx.text)
+    found = rank_workers_for_client(lat, lon, candidates)
+    if not found:
+        await ctx.update.message.reply_text(f"لا يوجد حرفي قريب يطابق «{ctx.text}». جرّب كلمة أخرى أو اختر خدمة من القائمة.")
+        return
+    result_pages.put(state["client_id"], found, service=state.get("service"))
+    text, kb = render_results_page(state["client_id"], 0, note=f"نتائج البحث عن «{ctx.text}»:")
+    await ctx.update.message.reply_text(text, reply_markup=kb)
+
+
+# redeem flow
+async def _route_redeem_code(ctx):
+    code = ctx.text.strip(); ok, msg = await db_executor.run_write(redeem_coupon_for_worker, code, ctx.user_id)
+    await ctx.update.message.reply_text(msg); user_states.pop(ctx.user_id, None)
+
+
+async def _route_fallback(ctx):
+    # free text outside a conversation is most likely a service name typed by hand
+    found = service_search.suggest(ctx.text) if not ctx.state else []
+    if found:
+        kb = ReplyKeyboardMarkup([[w] for w in found], resize_keyboard=True, one_time_keyboard=True)
+        await ctx.update.message.reply_text("هل تقصد إحدى هذه الخدمات؟ اختر من الأزرار:", reply_markup=kb)
+        return
+    await ctx.update.message.reply_text("لم أفهم. استخدم الأزرار أو اكتب /start للعودة للقائمة.", reply_markup=MAIN_KB)
+
+
+def build_button_router():
+    """Routing table of handle_buttons; built once at import (WORK_TYPES is fixed by then)."""
+    r = router.Router(_route_fallback)
+    r.command("admin_panel", _route_admin_panel, "conf")
+    # a "sta" typed while composing is part of the broadcast text
+    r.command("broadcast_start", _route_broadcast_start, "sta",
+              when=lambda ctx: (ctx.state or {}).get("role") != "broadcast")
+    r.label("contact", _route_contact, *CONTACT_KEYS)
+    r.label("about", _route_about, *ABOUT_KEYS)
+    r.label("client_registration_removed", _route_client_registration_removed, "التسجيل للعملاء")
+    r.label("subscriber_start", _route_subscriber_start, "التجيل للعملاء")
+    r.label("worker_start", _route_worker_start, *WORKER_REG_KEYS)
+    r.label("services", _route_services, *SERVICE_KEYS)
+    r.idle_label("client_start", _route_client_start, *WORK_TYPES)
+    r.number("request_lookup", _route_request_lookup)
+    r.step("broadcast_compose", _route_broadcast_compose, "broadcast", "compose")
+    r.step("subscriber_name", _route_subscriber_name, "subscriber", "name")
+    r.step("subscriber_phone", _route_subscriber_phone, "subscriber", "phone")
+    r.step("client_request_id", _route_client_request_id, "client", "awaiting_request_id")
+    r.step("client_name", _route_client_name, "client", "name")
+    r.step("client_phone", _route_client_phone, "client", "phone")
+    r.step("client_edu_choice", _route_client_edu_choice, "client", "edu_choice")
+    r.step("client_results", _route_client_results, "client", "results")
+    r.step("worker_name", _route_worker_name, "worker", "name")
+    r.step("worker_work_type", _route_worker_work_type, "worker", "work_type")
+    r.step("worker_edu_type", _route_worker_edu_type, "worker", "edu_type")
+    r.step("worker_phone", _route_worker_phone, "worker", "phone")
+    r.step("worker_coupon", _route_worker_coupon, "worker", "await_coupon_code")
+    r.step("redeem_code", _route_redeem_code, "redeem", "code")
+    return r
+
+
+BUTTON_ROUTER = build_button_router()
+
+
 async def handle_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         user_id = update.message.from_user.id if update.message and update.message.from_user else None
@@ -1712,7 +1830,8 @@ async def handle_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # immediately sees the available options.
         try:
             if user_id:
-                if mark_user_seen(user_id):
+                # known users are answered from memory without a trip to the DB writer
+                if not seen_users.is_known(user_id) and await db_executor.run_write(mark_user_seen, user_id):
                     try:
                         await update.message.reply_text("مرحبًا! إليك القائمة الرئيسية:", reply_markup=MAIN_KB)
                     except Exception:
@@ -1729,267 +1848,17 @@ async def handle_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 text_orig = update.message.text
         logging.info("RAW_MSG repr: %r ; contact=%r ; from=%s", text_orig, contact_obj, user_id)
         text = text_orig.strip()
-        text_l = text.lower()
-        if "conf" in text_l:
-            await send_admin_panel(update, context); return
-        if text_l in CONTACT_KEYS:
-            phone_local = "0916564000"; phone_international = "+218916564000"; wa_number = "218916564000"
-            try:
-                await update.message.reply_contact(phone_number=phone_international, first_name="فريق الدعم")
-            except Exception:
-                logging.debug("reply_contact failed")
-            wa_btn = InlineKeyboardMarkup([[InlineKeyboardButton("مراسلتنا عبر واتساب", url=f"https://wa.me/{wa_number}")]])
-            # include phone number with phone emoji in the reply
-            await update.message.reply_text(f"📞 للتواصل الهاتفي: {phone_local}\n\nيمكنك أيضًا مراسلتنا عبر واتساب:", reply_markup=wa_btn)
-            return
-        if text_l in ABOUT_KEYS:
-            about_text = (
-                "بوت خدمتي | تأسس عام 2025\n\n"
-                "نحن بوت تيليجرام يهدف إلى تسهيل طلب الخدمات بين العملاء والحرفيين.\n"
-                "كل ما عليك هو اختيار الخدمة المناسبة ثم إرسال موقعك، وسيعرض لك البوت أقرب حرفي مع جميع بيانات التواصل.\n\n"
-                "✅ الخدمة مجانية تمامًا للعملاء\n"
-                "💼 واشتراك رمزي للحرفيين\n\n"
-                "لأي استفسار أو دعم، لا تتردد في التواصل معنا 💬"
-            )
-            await update.message.reply_text(about_text, reply_markup=ReplyKeyboardRemove())
-            await update.message.reply_text("الرجوع إلى القائمة الرئيسية:", reply_markup=MAIN_KB)
-            return
-
-        # If user types "التسجيل للعملاء" inform them registration removed
-        if text_l == "التسجيل للعملاء":
-            await update.message.reply_text("تمت إزالة خاصية تسجيل العملاء. عند رغبتك بطلب خدمة اختر 'الخدمات' ثم تابع الخطوات لمشاركة بياناتك وموقعك وسيُسجل الطلب مباشرة.")
-            return
-
-        # rest of existing logic unchanged...
-        if text.isdigit() and user_id not in user_states:
-            req = fetch_client_request_by_id(int(text))
-            if req:
-                await update.message.reply_text(f"تم العثور على طلب رقم {req['id']} — الاسم: {req['name'] or '-'} — الهاتف: {req['phone'] or '-'}")
-                return
-        if text_l in ("التسجيل للعملاء", "📝 التسجيل للعملاء", "التسجيل للحرفيين", "📝 التسجيل للحرفيين") or text_l in SERVICE_KEYS or text_l in ABOUT_KEYS or text_l in CONTACT_KEYS:
-            user_states.pop(user_id, None)
-        if text_l == "التجيل للعملاء":
-            name = None
-            if update.effective_user:
-                fn = update.effective_user.first_name or ""; ln = update.effective_user.last_name or ""; name = (fn + " " + ln).strip() or None
-            contact = getattr(update.message, "contact", None)
-            phone = contact.phone_number if contact and getattr(contact, "phone_number", None) else None
-            user_states[user_id] = {"role": "subscriber", "step": ("location" if phone else "phone"), "name": name, "phone": phone}
-            if phone:
-                kb = ReplyKeyboardMarkup([[KeyboardButton("إرسال الموقع", request_location=True)]], resize_keyboard=True, one_time_keyboard=True)
-                await update.message.reply_text(f"تم استخدام اسم ملفك الشخصي: {name or 'غير متوفر'}\nالآن اضغط لإرسال موقعك:", reply_markup=kb)
-            else:
-                kb = ReplyKeyboardMarkup([[KeyboardButton("مشاركة جهة الاتصال", request_contact=True)]], resize_keyboard=True, one_time_keyboard=True)
-                await update.message.reply_text(f"سيُستخدم اسم ملفك الشخصي: {name or 'غير متوفر'}\nالرجاء مشاركة رقم هاتفك بالزر أدناه:", reply_markup=kb)
-            return
-        if text_l in ("التسجيل للحرفيين", "📝 التسجيل للحرفيين"):
-            user_states[user_id] = {"role": "worker", "step": "name"}
-            await update.message.reply_text("سجل كعامل - يرجى إدخال اسمك:")
-            return
-        if text_l in SERVICE_KEYS:
-            kb = ReplyKeyboardMarkup([[w] for w in WORK_TYPES], resize_keyboard=True, one_time_keyboard=True)
-            await update.message.reply_text("اختر الخدمة المطلوبة:", reply_markup=kb)
-            return
-        if text in WORK_TYPES and user_id not in user_states:
-            name = None
-            if update.effective_user:
-                fn = update.effective_user.first_name or ""; ln = update.effective_user.last_name or ""; name = (fn + " " + ln).strip() or None
-            contact = getattr(update.message, "contact", None)
-            phone = contact.phone_number if contact and getattr(contact, "phone_number", None) else None
-            state = {"role": "client", "service": text, "name": name, "phone": phone}
-            # If client requested educational services, ask which teaching division they want
-            if text == "الخدمات التعليمية":
-                state["step"] = "edu_choice"
-                user_states[user_id] = state
-                edu_kb = ReplyKeyboardMarkup([
-                    ["تمهيدي", "إعدادي"],
-                    ["ثانوي أو معهد", "اكاديمي"]
-                ], resize_keyboard=True, one_time_keyboard=True)
-                await update.message.reply_text(f"لقد اخترت: {text}\nاختر قسم التدريس المناسب للمعلم الذي تريده:", reply_markup=edu_kb)
-                return
-            if phone:
-                state["step"] = "location"; user_states[user_id] = state
-                kb = ReplyKeyboardMarkup([[KeyboardButton("إرسال الموقع", request_location=True)]], resize_keyboard=True, one_time_keyboard=True)
-                await update.message.reply_text(f"لقد اخترت: {text}\nالاسم المستخدم: {name or 'غير متوفر'}\nالآن شارك موقعك:", reply_markup=kb)
-            else:
-                state["step"] = "phone"; user_states[user_id] = state
-                kb = ReplyKeyboardMarkup([[KeyboardButton("مشاركة جهة الاتصال", request_contact=True)]], resize_keyboard=True, one_time_keyboard=True)
-                await update.message.reply_text(f"لقد اخترت: {text}\nسيُستخدم اسم ملفك الشخصي: {name or 'غير متوفر'}\nالرجاء مشاركة رقم هاتفك بالزر أدناه:", reply_markup=kb)
-            return
-        if user_id in user_states:
-            state = user_states[user_id]
-            # subscriber flow
-            if state.get("role") == "subscriber":
-                if state.get("step") == "name":
-                    state["name"] = text; state["step"] = "phone"
-                    await update.message.reply_text("يرجى إدخال رقم هاتفك أو مشاركة جهة الاتصال:"); return
-                if state.get("step") == "phone":
-                    if not is_valid_phone(text):
-                        await update.message.reply_text("رقم الهاتف غير صالح. ارسله بصيغة 091xxxxxxx أو 9xxxxxxx أو +2189xxxxxxx."); return
-                    state["phone"] = normalize_phone(text); state["step"] = "location"
-                    kb = ReplyKeyboardMarkup([[KeyboardButton("إرسال الموقع", request_location=True)]], resize_keyboard=True, one_time_keyboard=True)
-                    await update.message.reply_text("الآن اضغط 'إرسال الموقع' لمشاركة موقعك:", reply_markup=kb); return
-            # client flow
-            if state.get("role") == "client":
-                if state.get("step") == "awaiting_request_id":
-                    if text.isdigit():
-                        req = fetch_client_request_by_id(int(text))
-                        if req:
-                            state["name"] = req.get("name"); state["phone"] = req.get("phone")
-                            state["step"] = "location" if state.get("phone") else "phone"
-                            await update.message.reply_text("تم استرجاع بيانات الطلب. أرسل موقعك أو أدخل هاتفك:", reply_markup=ReplyKeyboardMarkup([[KeyboardButton("إرسال الموقع", request_location=True)]], resize_keyboard=True, one_time_keyboard=True)); return
-                    await update.message.reply_text("رمز الطلب غير صحيح. اعد المحاولة أو اكتب اسمك."); state["step"] = "name"; return
-                if state.get("step") == "name":
-                    if text.isdigit():
-                        sub = fetch_subscriber_by_id(int(text))
-                        if sub:
-                            state["name"] = sub["name"]; state["phone"] = sub.get("phone"); state["step"] = "location" if state.get("phone") else "phone"
-                            await update.message.reply_text("تم استرجاع بيانات المشترك. أرسل موقعك أو أدخل هاتفك:", reply_markup=ReplyKeyboardMarkup([[KeyboardButton("إرسال الموقع", request_location=True)]], resize_keyboard=True, one_time_keyboard=True)); return
-                        req = fetch_client_request_by_id(int(text))
-                        if req:
-                            state["request_id"] = req["id"]; state["name"] = req.get("name"); state["phone"] = req.get("phone"); state["step"] = "location" if state.get("phone") else "phone"
-                            await update.message.reply_text("تم استرجاع بيانات الطلب. أرسل موقعك أو ادخل هاتفك:", reply_markup=ReplyKeyboardMarkup([[KeyboardButton("إرسال الموقع", request_location=True)]], resize_keyboard=True, one_time_keyboard=True)); return
-                    state["name"] = text; state["step"] = "phone"; await update.message.reply_text("يرجى إدخال رقم هاتفك أو مشاركة جهة الاتصال:"); return
-                if state.get("step") == "phone":
-                    if not is_valid_phone(text):
-                        await update.message.reply_text("رقم الهاتف غير صالح. ارسله بصيغة 091xxxxxxx أو +2189xxxxxxx."); return
-                    state["phone"] = normalize_phone(text); state["step"] = "location"
-                    await update.message.reply_text("الآن اضغط 'إرسال الموقع' لمشاركة موقعك:", reply_markup=ReplyKeyboardMarkup([[KeyboardButton("إرسال الموقع", request_location=True)]], resize_keyboard=True, one_time_keyboard=True)); return
-                if state.get("step") == "edu_choice":
-                    # client chose which teaching division they want
-                    state["edu_type"] = text
-                    # after selecting edu_type proceed to phone/location as usual
-                    if state.get("phone"):
-                        state["step"] = "location"
-                        kb = ReplyKeyboardMarkup([[KeyboardButton("إرسال الموقع", request_location=True)]], resize_keyboard=True, one_time_keyboard=True)
-                        await update.message.reply_text(f"لقد اخترت: {state.get('edu_type')}\nالآن شارك موقعك:", reply_markup=kb)
-                    else:
-                        state["step"] = "phone"
-                        kb = ReplyKeyboardMarkup([[KeyboardButton("مشاركة جهة الاتصال", request_contact=True)]], resize_keyboard=True, one_time_keyboard=True)
-                        await update.message.reply_text(f"لقد اخترت: {state.get('edu_type')}\nالرجاء مشاركة رقم هاتفك بالزر أدناه:", reply_markup=kb)
-                    return
-            # worker flow
-            if state.get("role") == "worker":
-                if state.get("step") == "name":
-                    state["name"] = text; state["step"] = "work_type"
-                    kb = ReplyKeyboardMarkup([[w] for w in WORK_TYPES], resize_keyboard=True, one_time_keyboard=True)
-                    await update.message.reply_text("اختر نوع عملك:", reply_markup=kb); return
-                if state.get("step") == "work_type":
-                    if text in WORK_TYPES:
-                        state["work_type"] = text
-                        # Special flow for educational services: ask for specific edu type to organize later
-                        if text == "الخدمات التعليمية":
-                            state["step"] = "edu_type"
-                            edu_kb = ReplyKeyboardMarkup([
-                                ["تمهيدي", "إعدادي"],
-                                ["ثانوي أو معهد", "اكاديمي"]
-                            ], resize_keyboard=True, one_time_keyboard=True)
-                            await update.message.reply_text("اختر قسم التدريس المناسب لك (تمهيدي / إعدادي / ثانوي أو معهد / اكاديمي):", reply_markup=edu_kb)
-                        else:
-                            state["step"] = "phone"
-                            await update.message.reply_text("يرجى إدخال رقم هاتفك أو مشاركة جهة الاتصال:")
-                    else:
-                        await update.message.reply_text("الرجاء اختيار نوع العمل من الأزرار.")
-                    return
-                if state.get("step") == "edu_type":
-                    # store the educational service subtype and continue to phone step
-                    state["edu_type"] = text
-                    state["step"] = "phone"
-                    await update.message.reply_text("شكرًا. الآن ادخل رقم هاتفك أو شارك جهة الاتصال:")
-                    return
-                if state.get("step") == "phone":
-                    raw = text; logging.info("Worker phone raw input: %r from user %s", raw, user_id)
-                    norm = normalize_phone(raw)
-                    if not norm:
-                        await update.message.reply_text("رقم الهاتف غير صالح. ارسله بصيغة 0912xxxxxx أو +2189xxxxxxx. حاول مرة أخرى:"); return
-                    state["phone"] = norm
-                    state["step"] = "choose_sub"
-                    # عرض أزرار اختيار الفئة بدل طلب الكود مباشرة
-                    sub_kb = InlineKeyboardMarkup([
-                        [InlineKeyboardButton("الفئة الذهبية — 100 د.ل", callback_data=f"pick_sub:gold")],
-                        [InlineKeyboardButton("الفئة الفضية — 60 د.ل", callback_data=f"pick_sub:silver")]
-                    ])
-                    await update.message.reply_text("اختر نوع الاشتراك الذي تريد تفعيله ثم أدخل كود القسيمة المناسب:", reply_markup=sub_kb)
-                    return
-                if state.get("step") == "await_coupon_code":
-                    code_input = text.strip()
-                    if not code_input:
-                        await update.message.reply_text("الرجاء إدخال كود صالح."); return
-
-                    # ابحث عن القسيمة في DB مع بعض التحويرات (VIP-.. أو بصيغة بدون أصفار بادئة)
-                    raw = re.sub(r"[^\w\-]", "", code_input.strip().upper())
-                    raw_nz = re.sub(r"^0+", "", raw)
-                    candidates = []
-                    for cand in (raw, raw_nz):
-                        if cand:
-                            candidates.append(cand)
-                            if not cand.startswith("VIP-"):
-                                candidates.append("VIP-" + cand)
-                    seen = []
-                    candidates = [c for c in candidates if c and (c not in seen and not seen.append(c))]
-
-                    conn = sqlite3.connect(DB_PATH)
-                    cur = conn.cursor()
-                    found = None
-                    for c in candidates:
-                        cur.execute("SELECT id, amount, used, code FROM coupons WHERE UPPER(code) = ?", (c.upper(),))
-                        row = cur.fetchone()
-                        if row:
-                            found = row
-                            break
-                    if not found:
-                        conn.close()
-                        await update.message.reply_text("الكود غير موجود أو غير صالح."); return
-                    cid, amount, used, actual_code = found
-                    if used:
-                        conn.close()
-                        await update.message.reply_text("هذا الكود مُستخدم مسبقاً."); return
-
-                    desired = state.get("desired_tier")
-                    if desired == "gold" and int(amount) != 100:
-                        conn.close()
-                        await update.message.reply_text("هذا الكود ليس مخصصًا للفئة الذهبية. استخدم كودًا بفئة 100 د.ل."); return
-                    if desired == "silver" and int(amount) != 60:
-                        conn.close()
-                        await update.message.reply_text("هذا الكود ليس مخصصًا للفئة الفضية. استخدم كودًا بفئة 60 د.ل."); return
-
-                    # تحديد المستوى والمدة حسب الاختيار (التوافق مع متطلباتك)
-                    if desired == "gold":
-                        level = 1; days = 32; tier_name = "ذهبي"
-                    else:
-                        level = 2; days = 30; tier_name = "فضي"
-                    expiry = datetime.utcnow() + timedelta(days=days)
-                    expiry_iso = expiry.isoformat()
-
-                    try:
-                        # وسم القسيمة كمستخدمة
-                        cur.execute("UPDATE coupons SET used=1, used_by_worker_user_id=?, used_at=? WHERE id=?", (user_id, expiry_iso, cid))
-                        # خزّن معلومات الاشتراك مؤقتاً في state (سيتم حفظها عند حفظ العامل بعد الموقع)
-                        state["subscription_level"] = level
-                        state["subscription_expiry"] = expiry_iso
-                        state["coupon_code"] = actual_code
-                        conn.commit()
-                        conn.close()
-                        state["step"] = "location"
-                        user_states[user_id] = state
-                        kb = ReplyKeyboardMarkup([[KeyboardButton("إرسال الموقع", request_location=True)]], resize_keyboard=True, one_time_keyboard=True)
-                        await update.message.reply_text(f"تم قبول الكود للفئة {tier_name}. الآن اضغط 'إرسال الموقع' لمشاركة موقعك:", reply_markup=kb)
-                    except Exception:
-                        conn.close()
-                        logging.exception("Error while marking coupon used")
-                        await update.message.reply_text("حدث خطأ أثناء تفعيل الكود. حاول مرة أخرى أو تواصل مع الدعم.")
-                    return
-            # redeem flow
-            if state.get("role") == "redeem" and state.get("step") == "code":
-                code = text.strip(); ok, msg = redeem_coupon_for_worker(code, user_id)
-                await update.message.reply_text(msg); user_states.pop(user_id, None); return
+        label = BUTTON_LABELS.get(text, text)
+        state = user_states.get(user_id)
+        ctx = SimpleNamespace(update=update, context=context, user_id=user_id, text=text, text_orig=text_orig, label=label, state=state)
+        await BUTTON_ROUTER.dispatch(ctx, label, label.lower(), state, is_admin=bool(ADMIN_ID) and user_id == ADMIN_ID)
     except Exception:
         logging.exception("Error in handle_buttons")
         try:
             await update.message.reply_text("حدث خطأ داخلي. أعد المحاولة أو اكتب /start.")
         except Exception:
             pass
-    await update.message.reply_text("لم أفهم. استخدم الأزرار أو اكتب /start للعودة للقائمة.", reply_markup=MAIN_KB)
+        await update.message.reply_text("لم أفهم. استخدم الأزرار أو اكتب /start للعودة للقائمة.", reply_markup=MAIN_KB)
 
 async def handle_contact(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
@@ -2054,43 +1923,52 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         # user chose a worker for their request: format choose:{client_id}:{worker_user_id}
         if data.startswith("choose:"):
+            # the answer goes in a new message: the results carousel stays usable for paging and rating
             parts = data.split(":")
             if len(parts) != 3:
-                await query.edit_message_text("خطأ في اختيار العامل. حاول مرة أخرى.")
+                await query.message.reply_text("خطأ في اختيار العامل. حاول مرة أخرى.")
                 return
             client_id = int(parts[1])
             try:
                 worker_user_id = int(parts[2])
             except Exception:
-                await query.edit_message_text("خطأ في معرف العامل.")
+                await query.message.reply_text("خطأ في معرف العامل.")
                 return
-            # سجل التعيين في DB وزدّ عداد الاختيار
+            # سجل التعيين وإشعار العامل (في صندوق الصادر) في معاملة واحدة، وزدّ عداد الاختيار
             try:
-                assign_worker_to_client(client_id, worker_user_id)
-                increment_worker_selected(worker_user_id, by=1)
+                assigned = await db_executor.run_write(assign_worker_to_client, client_id, worker_user_id, user_id)
             except Exception:
                 logging.exception("Failed to assign worker")
-                await query.edit_message_text("حدث خطأ أثناء اختيار العامل. حاول مرة أخرى.")
+                await query.message.reply_text("حدث خطأ أثناء اختيار العامل. حاول مرة أخرى.")
                 return
-            # تأكيد للمستخدم وإعلام العامل
-            await query.edit_message_text("تم اختيار هذا الحرفي وسيتم التواصل معه. شكراً.")
-            try:
-                # حاول إرسال إشعار للعامل إن أمكن
-                await context.bot.send_message(worker_user_id, f"تم اختيارك لطلب رقم {client_id} من قبل المستخدم {user_id}.")
-            except Exception:
-                logging.debug("Could not notify worker (maybe hasn't started the bot).")
+            if not assigned:
+                await query.message.reply_text("لم يعد هذا الطلب موجوداً. أرسل موقعك من جديد لعرض الحرفيين.")
+                return
+            increment_worker_selected(worker_user_id, by=1)
+            # يُرسل الإشعار للعامل في الخلفية (outbox.run_dispatcher) مع إعادة المحاولة
+            outbox.notify()
+            await query.message.reply_text("تم اختيار هذا الحرفي وسيتم التواصل معه. شكراً.")
             return
 
-        # فتح نافذة تقييم
+        # فتح نافذة تقييم: open_rate:{worker} أو open_rate:{worker}:{client_id}:{page} من رسالة النتائج
         if data.startswith("open_rate:"):
             parts = data.split(":")
-            if len(parts) != 2:
+            if len(parts) not in (2, 4):
                 await query.edit_message_text("خطأ في فتح صفحة التقييم.")
                 return
             try:
                 target_worker = int(parts[1])
             except Exception:
                 await query.edit_message_text("خطأ في معرف العامل."); return
+            if len(parts) == 4:
+                # carousel: swap the keyboard of the results message for the 1-5 row and a back button
+                back = f"{parts[2]}:{parts[3]}"
+                kb = InlineKeyboardMarkup([
+                    [InlineKeyboardButton(str(i), callback_data=f"rate:{target_worker}:{i}:{back}") for i in range(1,6)],
+                    [InlineKeyboardButton("رجوع", callback_data=f"page:{back}")],
+                ])
+                await query.edit_message_reply_markup(reply_markup=kb)
+                return
             # أرسل أزرار تقييم بسيطة (1-5)
             kb = InlineKeyboardMarkup([[InlineKeyboardButton(str(i), callback_data=f"rate:{target_worker}:{i}") for i in range(1,6)]])
             try:
@@ -2111,11 +1989,50 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await query.edit_message_text("خطأ في بيانات التقييم."); return
             # حفظ التقييم
             try:
-                save_rating_to_db(target_worker, user_id, score, comment=None)
-                await query.message.reply_text("شكراً لتقييمك.")
+                await db_executor.run_write(save_rating_to_db, target_worker, user_id, score, comment=None)
+                note = "شكراً لتقييمك."
             except Exception:
                 logging.exception("Failed saving rating")
-                await query.message.reply_text("حدث خطأ أثناء حفظ التقييم.")
+                note = "حدث خطأ أثناء حفظ التقييم."
+            # rate:{worker}:{score}:{client_id}:{page} comes from a results message: put the page back with the note
+            rendered = None
+            if len(parts) == 5:
+                try:
+                    rendered = render_results_page(int(parts[3]), int(parts[4]), note=note)
+                except ValueError:
+                    rendered = None
+            if rendered is not None:
+                text, kb = rendered
+                await query.edit_message_text(text, reply_markup=kb)
+            else:
+                await query.message.reply_text(note)
+            return
+
+        # إيقاف مهمة إرسال جماعي: bc_cancel:{job_id}
+        if data.startswith("bc_cancel:"):
+            if not ADMIN_ID or user_id != ADMIN_ID:
+                return
+            try:
+                job_id = int(data.split(":")[1])
+            except Exception:
+                return
+            if await db_executor.run_write(broadcast.cancel, DB_PATH, job_id):
+                await query.edit_message_text(f"تم إيقاف مهمة الإرسال #{job_id}.")
+            return
+
+        # تنقل بين صفحات نتائج البحث داخل نفس الرسالة: page:{client_id}:{page}
+        if data.startswith("page:"):
+            parts = data.split(":")
+            try:
+                client_id = int(parts[1]); page_no = int(parts[2])
+            except Exception:
+                await query.edit_message_text("خطأ في بيانات الصفحة."); return
+            rendered = render_results_page(client_id, page_no)
+            if rendered is None:
+                await query.edit_message_text("انتهت صلاحية نتائج هذا البحث. أرسل موقعك من جديد لعرض الحرفيين.")
+                return
+            text, kb = rendered
+            await query.edit_message_text(text, reply_markup=kb)
             return
 
         # ...existing callback handling for other cases...
@@ -2127,6 +2044,65 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         except Exception:
             pass
 
+def rank_workers_for_client(lat, lon, candidates):
+    """Exact distance refinement of candidate workers for one client: the best MAX_RESULTS within CLIENT_MAX_KM."""
+    ranked = scoring.rank(lat, lon, [w["location"][0] for w in candidates], [w["location"][1] for w in candidates],
+                          [w.get("subscription_level") for w in candidates], CLIENT_MAX_KM, k=result_pages.MAX_RESULTS)
+    workers_in_range = []
+    for i, dist_km, level in ranked:
+        w = candidates[i]
+        workers_in_range.append({
+            "id": w.get("id"),
+            "user_id": w.get("user_id"),
+            "name": w.get("name"),
+            "phone": w.get("phone"),
+            "work_type": w.get("work_type"),
+            "location": w.get("location"),
+            "subscription_level": level,
+            "subscription_expiry": w.get("subscription_expiry"),
+            "dist_km": dist_km
+        })
+    return workers_in_range
+
+def render_results_page(client_id, page_no, note=None):
+    """Return (text, keyboard) for one page of a cached search as a single message, or None if it expired.
+
+    The whole page is one message: every card is a numbered block of text, the
+    keyboard has a choose/rate row per card and a prev/next row. Paging, rating
+    and choosing edit this message instead of sending new ones.
+    """
+    found = result_pages.page(client_id, page_no)
+    if found is None:
+        return None
+    chunk, start, total, has_more, meta = found
+    # زيادة ظهور الحرفيين مرة واحدة لكل صفحة تُعرض (مخزنة مؤقتاً وتكتب دفعة واحدة)
+    seen = meta.setdefault("seen_pages", set())
+    if page_no not in seen:
+        seen.add(page_no)
+        counters.add_many("appearance_count", [w['user_id'] for w in chunk])
+    service = meta.get("service")
+    lines = [note] if note else []
+    lines.append(f"رقم الطلب: {client_id}\nالحرفيون الأقرب ({start + 1}-{start + len(chunk)} من {total}):")
+    rows = []
+    for n, w in enumerate(chunk, start + 1):
+        lines.append(
+            "━━━━━━━━━━━━━━━━━━━━\n"
+            f"{n}. الاسم: {w.get('name') or '-'}\n"
+            f"الخدمة: {w.get('work_type') or service}\n"
+            f"الهاتف: {w.get('phone') or '-'}\n"
+            f"المسافة: ≈{w['dist_km']:.1f} كم"
+        )
+        rows.append([InlineKeyboardButton(f"اختر {n}", callback_data=f"choose:{client_id}:{w['user_id']}"),
+                     InlineKeyboardButton(f"قيّم {n}", callback_data=f"open_rate:{w['user_id']}:{client_id}:{page_no}")])
+    nav = []
+    if page_no > 0:
+        nav.append(InlineKeyboardButton("« السابق", callback_data=f"page:{client_id}:{page_no - 1}"))
+    if has_more:
+        nav.append(InlineKeyboardButton("التالي »", callback_data=f"page:{client_id}:{page_no + 1}"))
+    if nav:
+        rows.append(nav)
+    return "\n".join(lines), InlineKeyboardMarkup(rows)
+
 async def handle_location(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         user_id = update.message.from_user.id
@@ -2146,14 +2122,14 @@ async def handle_location(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if state.get("role") == "worker" and state.get("step") in ("location",):
             state["location"] = (lat, lon)
             try:
-                worker_id = save_worker_to_db(user_id, state)
+                worker_id = await db_executor.run_write(save_worker_to_db, user_id, state)
             except Exception:
                 logging.exception("Failed saving worker")
                 await update.message.reply_text("حدث خطأ أثناء حفظ بيانات العامل. حاول مرة أخرى لاحقاً أو اكتب /start.")
                 if ADMIN_ID:
                     tb = traceback.format_exc(); await context.bot.send_message(ADMIN_ID, f"Error saving worker {user_id}:\n{tb[:3000]}")
                 return
-            workers[user_id] = state.copy(); user_states.pop(user_id, None)
+            user_states.pop(user_id, None)
             await update.message.reply_text(f"شكراً لتسجيلك كعامل.\nتم حفظ بياناتك.\nرقم المعرف: {worker_id}", reply_markup=ReplyKeyboardRemove())
 
             sub_kb = InlineKeyboardMarkup([
@@ -2174,32 +2150,25 @@ async def handle_location(update: Update, context: ContextTypes.DEFAULT_TYPE):
             state["location"] = (lat, lon)
             service = state.get("service")
             # If this is an educational service request, filter workers by the requested edu_type
-            if service == "الخدمات التعليمية":
-                db_workers = fetch_workers_by_service(service, edu_type=state.get("edu_type"))
-            else:
-                db_workers = fetch_workers_by_service(service)
-            MAX_KM = 100.0
-            workers_in_range = []
-            for w in db_workers:
-                try:
-                    if not w.get("location") or None in w.get("location"): continue
-                    dist_km = calc_distance(state["location"], w["location"])
-                    if dist_km <= MAX_KM:
-                        workers_in_range.append({
-                            "id": w.get("id"),
-                            "user_id": w.get("user_id"),
-                            "name": w.get("name"),
-                            "phone": w.get("phone"),
-                            "work_type": w.get("work_type"),
-                            "location": w.get("location"),
-                            "subscription_level": int(w.get("subscription_level") or 0),
-                            "subscription_expiry": w.get("subscription_expiry"),
-                            "dist_km": dist_km
-                        })
-                except Exception:
-                    logging.exception("Error computing distance for worker row: %r", w)
+            MAX_KM = CLIENT_MAX_KM
+            edu_type = state.get("edu_type") if service == "الخدمات التعليمية" else None
+            # candidates are shared by every client of the same grid cell (cached, empty lists too)
+            cell = geo.cell_of(lat, lon)
+            candidates = search_cache.get(service, edu_type, cell, MAX_KM)
+            if candidates is None:
+                # load every worker any client in this cell can reach, once for the whole cell
+                gen = search_cache.generation()
+                c_lat, c_lon, reach_km = search_cache.neighbourhood(cell, MAX_KM)
+                if worker_index.index.ready:
+                    candidates = worker_index.index.nearest(service, edu_type, c_lat, c_lon, reach_km)
+                else:
+                    # only candidates inside the grid cells / bounding box around the cell are loaded
+                    candidates = await db_executor.run_read(fetch_workers_by_service, service, edu_type=edu_type, near=(c_lat, c_lon), radius_km=reach_km)
+                search_cache.put(service, edu_type, cell, MAX_KM, candidates, gen=gen)
+            # refine by exact distance for this client, in one batched pass (NumPy when available)
+            workers_in_range = rank_workers_for_client(lat, lon, candidates)
             try:
-                client_id = save_client_request_to_db(user_id, state, req_id=state.get("request_id"))
+                client_id = await db_executor.run_write(save_client_request_to_db, user_id, state, req_id=state.get("request_id"))
             except Exception:
                 logging.exception("Failed saving client request")
                 await update.message.reply_text("حدث خطأ أثناء حفظ طلبك. حاول مرة واحدة أخرى أو اكتب /start.")
@@ -2209,26 +2178,20 @@ async def handle_location(update: Update, context: ContextTypes.DEFAULT_TYPE):
             if not workers_in_range:
                 await update.message.reply_text("عذراً، لا يوجد عمال متوفرون بنفس الخدمة ضمن 100 كم.", reply_markup=ReplyKeyboardRemove())
             else:
-                workers_in_range.sort(key=lambda x: (-x["subscription_level"], x["dist_km"]))
-                for w in workers_in_range:
-                    # زيادة ظهور الحرفي لأننا سانعرضه للمستخدم
-                    try:
-                        increment_worker_appearance(w['user_id'], by=1)
-                    except Exception:
-                        logging.debug("Failed increment appearance for worker %s", w['user_id'])
-                    block = (
-                        "━━━━━━━━━━━━━━━━━━━━\n"
-                        f"الاسم: {w.get('name') or '-'}\n"
-                        f"الخدمة: {w.get('work_type') or service}\n"
-                        f"الهاتف: {w.get('phone') or '-'}\n"
-                        f"المسافة: ≈{w['dist_km']:.1f} كم\n"
-                        "━━━━━━━━━━━━━━━━━━━━"
-                    )
-                    kb = InlineKeyboardMarkup([[InlineKeyboardButton("اختر هذا الحرفي", callback_data=f"choose:{client_id}:{w['user_id']}"),
-                                                InlineKeyboardButton("قيّم", callback_data=f"open_rate:{w['user_id']}")]])
-                    await update.message.reply_text(block, reply_markup=kb)
-            user_states.pop(user_id, None)
-            await update.message.reply_text(f"شكراً. رقم الطلب الخاص بك: {client_id}", reply_markup=main_kb)
+                # only the best MAX_RESULTS are kept and shown as one carousel message;
+                # prev/next/rate edit it in place from the cached result set
+                result_pages.put(client_id, workers_in_range, service=service)
+                text, kb = render_results_page(client_id, 0)
+                await update.message.reply_text(text, reply_markup=kb)
+            if workers_in_range:
+                # a typed word now narrows these results (see _route_client_results)
+                user_states[user_id] = {"role": "client", "step": "results", "client_id": client_id, "service": service,
+                                        "edu_type": edu_type, "location": [lat, lon]}
+                await update.message.reply_text(f"شكراً. رقم الطلب الخاص بك: {client_id}\n"
+                                                "لتضييق النتائج اكتب كلمة، مثل التخصص أو نوع السيارة أو اسم الحرفي.", reply_markup=main_kb)
+            else:
+                user_states.pop(user_id, None)
+                await update.message.reply_text(f"شكراً. رقم الطلب الخاص بك: {client_id}", reply_markup=main_kb)
             return
 
         logging.info("handle_location: unexpected state for user %s -> %s", user_id, state)
@@ -2312,18 +2275,31 @@ def make_code(length=8):
     return ''.join(random.choices(string.ascii_uppercase + string.digits, k=length))
 
 # ---------- Safe fetch helpers (add these) ----------
-def fetch_workers_by_service(service, edu_type=None):
+def fetch_workers_by_service(service, edu_type=None, near=None, radius_km=None, keyword=None):
     """
     Fetch workers by work_type. If service is educational and edu_type is provided,
     filter by education_type as well so clients match only teachers of the requested division.
+    When `near` (lat, lon) and `radius_km` are given, only workers in the grid cells and
+    bounding box around that point are loaded (workers without a location are excluded).
+    `keyword` narrows the result to workers whose name or specialisation matches (FTS index).
     """
     try:
-        conn = sqlite3.connect(DB_PATH)
+        conn = db.connect(DB_PATH)
         cur = conn.cursor()
+        sql = "SELECT id, user_id, name, phone, lat, lon, subscription_level, subscription_expiry, worker_code, work_type, education_type FROM workers WHERE work_type = ?"
+        params = [service]
         if service == "الخدمات التعليمية" and edu_type:
-            cur.execute("SELECT id, user_id, name, phone, lat, lon, subscription_level, subscription_expiry, worker_code, work_type, education_type FROM workers WHERE work_type = ? AND education_type = ?", (service, edu_type))
-        else:
-            cur.execute("SELECT id, user_id, name, phone, lat, lon, subscription_level, subscription_expiry, worker_code, work_type, education_type FROM workers WHERE work_type = ?", (service,))
+            sql += " AND education_type = ?"
+            params.append(edu_type)
+        if near and radius_km:
+            geo_sql, geo_params = geo.bbox_sql(near[0], near[1], radius_km)
+            sql += " AND " + geo_sql
+            params.extend(geo_params)
+        kw_sql, kw_params = worker_search.filter_sql(keyword) if keyword else ("", [])
+        if kw_sql:
+            sql += " AND " + kw_sql
+            params.extend(kw_params)
+        cur.execute(sql, params)
         rows = cur.fetchall()
         conn.close()
         results = []
@@ -2349,7 +2325,7 @@ def fetch_workers_by_service(service, edu_type=None):
 
 def fetch_client_request_by_id(rid):
     try:
-        conn = sqlite3.connect(DB_PATH)
+        conn = db.connect(DB_PATH)
         cur = conn.cursor()
         cur.execute("SELECT id, user_id, name, phone, service, lat, lon, assigned_worker_id FROM clients WHERE id = ?", (rid,))
         r = cur.fetchone()
@@ -2365,7 +2341,7 @@ def fetch_client_request_by_id(rid):
 
 def fetch_subscriber_by_id(sid):
     try:
-        conn = sqlite3.connect(DB_PATH)
+        conn = db.connect(DB_PATH)
         cur = conn.cursor()
         cur.execute("SELECT id, name, phone, lat, lon FROM subscribers WHERE id = ?", (sid,))
         r = cur.fetchone()
@@ -2381,7 +2357,7 @@ def fetch_subscriber_by_id(sid):
 
 def fetch_subscriber_by_user_id(user_id):
     try:
-        conn = sqlite3.connect(DB_PATH)
+        conn = db.connect(DB_PATH)
         cur = conn.cursor()
         cur.execute("SELECT id, user_id, name, phone, lat, lon FROM subscribers WHERE user_id = ?", (user_id,))
         r = cur.fetchone()
@@ -2397,7 +2373,7 @@ def fetch_subscriber_by_user_id(user_id):
 
 def fetch_subscribers(limit=100):
     try:
-        conn = sqlite3.connect(DB_PATH)
+        conn = db.connect(DB_PATH)
         cur = conn.cursor()
         cur.execute("SELECT id, name, phone FROM subscribers ORDER BY id DESC LIMIT ?", (limit,))
         rows = cur.fetchall()
@@ -2418,7 +2394,7 @@ async def send_admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         subs = fetch_subscribers()
         sub_count = len(subs)
-        conn = sqlite3.connect(DB_PATH); cur = conn.cursor()
+        conn = db.connect(DB_PATH); cur = conn.cursor()
         cur.execute("SELECT COUNT(*) FROM workers"); workers_count = cur.fetchone()[0] or 0
         cur.execute("SELECT id, name, phone, work_type, worker_code, subscription_level, subscription_expiry FROM workers ORDER BY id DESC LIMIT 1000"); wrows = cur.fetchall()
         conn.close()
@@ -2427,7 +2403,36 @@ async def send_admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("فشل في جلب بيانات لوحة الإدارة.")
         return
 
-    header = f"لوحة الإدارة\nالمشتركون: {sub_count}\nالعمال: {workers_count}\n\n"
+    sc = search_cache.stats()
+    cache_line = f"كاش البحث: إصابات {sc['hits']} | إخفاقات {sc['misses']} | مدخلات {sc['entries']}"
+    su = seen_users.stats()
+    cache_line += f"\nالمستخدمون المعروفون: {su['size']} | إصابات {su['hits']} | إخفاقات {su['misses']} | جدد {su['new_users']}"
+    rh = reachability.stats()
+    reasons = ", ".join(f"{k}: {v}" for k, v in sorted(rh["by_reason"].items())) or "-"
+    cache_line += (f"\nصحة التوصيل: تم {rh['delivered']} | فشل {rh['failed']} | تخطي {rh['skipped']}"
+                   f" | محادثات غير قابلة للوصول {rh['unreachable']} ({reasons}) | عادت {rh['revived']}")
+    ob = outbound.stats()
+    if ob:
+        cache_line += (f"\nطابور الإرسال: تفاعلي {ob['queued']['interactive']} | جماعي {ob['queued']['bulk']} | ينتظر {ob['waiting_global']}"
+                       f" | أُرسل {ob['sent']} | دُمج {ob['merged']} | RetryAfter {ob['retry_after']} | أقصى انتظار {ob['max_wait_ms']:.0f}ms")
+    try:
+        oc = await db_executor.run_read(outbox.counts, DB_PATH)
+    except Exception:
+        oc = {}
+    ox = outbox.stats()
+    cache_line += (f"\nصندوق الإشعارات: بانتظار {oc.get('pending', 0) + oc.get('sending', 0)} | أُرسل {oc.get('sent', 0)}"
+                   f" | فشل {oc.get('failed', 0)} | إعادات {ox['retried']}")
+    ss = user_states.stats()
+    cache_line += (f"\nحالات المحادثة: بالذاكرة {ss['size']} | بالقاعدة فقط {ss['spilled_now']}"
+                   f" | منتهية {ss['expired']} | مُخرجة للقاعدة {ss['spilled']} | مُستعادة {ss['loaded']}")
+    sv = service_search.stats()
+    cache_line += f"\nبحث الخدمات: استعلامات {sv['queries']} | اقتراحات {sv['suggested']} | تسميات مفهرسة {sv['entries']}"
+    rt = BUTTON_ROUTER.stats()
+    top_routes = ", ".join(f"{k}: {v}" for k, v in sorted(rt.items(), key=lambda kv: -kv[1])[:8]) or "-"
+    cache_line += f"\nمسارات الرسائل (الأكثر استخداماً): {top_routes}"
+    cg = coupon_guard.stats()
+    cache_line += f"\nأكواد غير مستخدمة بالذاكرة: {cg['size']} | مرفوضة بلا قاعدة بيانات {cg['rejected']} | مستخدمون محظورون مؤقتاً {cg['limited_users']}"
+    header = f"لوحة الإدارة\nالمشتركون: {sub_count}\nالعمال: {workers_count}\n\n{db_executor.format_latency_report()}\n{cache_line}\n\n"
     sub_lines = [f"{s['id']} | {s['name'] or '-'} | {s['phone'] or '-'}" for s in subs]
     subs_text = "المشتركون (آخر):\n" + ("\n".join(sub_lines) if sub_lines else "(لا سجلات)")
     w_lines = [f"{wid} | {name or '-'} | {phone or '-'} | {wtype or '-'} | code:{wcode or '-'} | lvl:{level or 0} | exp:{expiry or '-'}" for wid, name, phone, wtype, wcode, level, expiry in wrows]
@@ -2456,6 +2461,54 @@ async def _global_error_handler(update: object, context: ContextTypes.DEFAULT_TY
     except Exception:
         logging.exception("Error in global error handler")
 
+async def _note_interaction(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # any update from a user proves the chat is reachable again (no-op unless it was marked)
+    if update.effective_user:
+        await reachability.note_interaction(update.effective_user.id, DB_PATH)
+
+async def _post_init(application):
+    # warm the in-memory geo index, then start background jobs once the event loop is running
+    try:
+        await db_executor.run_read(worker_index.load, DB_PATH)
+    except Exception:
+        logging.exception("Could not load worker geo index; falling back to DB search")
+    try:
+        await db_executor.run_read(seen_users.load, DB_PATH)
+    except Exception:
+        logging.exception("Could not load seen users; every first message will check the DB")
+    try:
+        await db_executor.run_write(user_states.load)
+    except Exception:
+        logging.exception("Could not restore conversation states; everyone starts over")
+    try:
+        await db_executor.run_read(reachability.load, DB_PATH)
+    except Exception:
+        logging.exception("Could not load unreachable chats; fan-outs will try every chat")
+    try:
+        await db_executor.run_read(coupon_guard.load, DB_PATH)
+    except Exception:
+        logging.exception("Could not load coupon guard; every code will be checked in the DB")
+    BG_TASKS.append(asyncio.create_task(counters.run_flusher(DB_PATH)))
+    BG_TASKS.append(asyncio.create_task(user_states.run_flusher()))
+    BG_TASKS.append(asyncio.create_task(worker_index.run_resync(DB_PATH)))
+    # delivers queued worker notifications (and anything left from before a restart)
+    BG_TASKS.append(asyncio.create_task(outbox.run_dispatcher(application.bot, DB_PATH)))
+    # resumes broadcasts left unfinished by a restart
+    BG_TASKS.append(asyncio.create_task(broadcast.run_worker(application.bot, DB_PATH)))
+
+async def _post_shutdown(application):
+    for task in BG_TASKS:
+        task.cancel()
+    BG_TASKS.clear()
+    try:
+        await db_executor.run_write(counters.flush, DB_PATH)
+    except Exception:
+        logging.exception("Final counter flush failed")
+    try:
+        await db_executor.run_write(user_states.flush)
+    except Exception:
+        logging.exception("Final conversation state flush failed")
+
 if __name__ == "__main__":
     # تهيئة DB
     init_db()
@@ -2480,8 +2533,11 @@ if __name__ == "__main__":
         logging.exception("Could not write lock file")
 
     # إنشاء التطبيق وإضافة المعالجات
-    app = Application.builder().token(TOKEN).build()
+    app = (Application.builder().token(TOKEN).rate_limiter(outbound.OutboundScheduler())
+           .post_init(_post_init).post_shutdown(_post_shutdown).build())
 
+    # يسبق كل المعالجات: أي تفاعل يعيد المحادثة إلى قائمة المحادثات القابلة للوصول
+    app.add_handler(TypeHandler(Update, _note_interaction), group=-1)
     # أوامر
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("redeem", redeem_cmd))
@@ -2525,4 +2581,8 @@ if __name__ == "__main__":
             if os.path.exists(LOCKFILE):
                 os.remove(LOCKFILE)
         except Exception:
-            logging.debug("Could not remove lock file on exit")
\ No newline at end of file
+            logging.debug("Could not remove lock file on exit")
+        db_executor.shutdown()
+        # anything buffered after the last flush (e.g. shutdown hook failed)
+        counters.flush(DB_PATH)
+        db.close_all()
\ No newline at end of file
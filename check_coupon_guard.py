@@ -0,0 +1,68 @@
+"""Check the coupon pre-filter and attempt limiter on a throw-away database.
+
+Usage: python check_coupon_guard.py [coupons] [guesses]
+
+Generates coupons, loads src.utils.coupon_guard, then fires random guesses
+and checks that none of them reached SQLite (counted with a trace callback),
+that real codes in any spelling still redeem, that codes inserted after the
+load are picked up, and that a guessing user is locked out.
+"""
+import os
+import sys
+import time
+import tempfile
+
+from src.utils import db, migrations, coupons, coupon_guard
+import generate_coupons
+
+
+def plan(amount):
+    return 1, 32, "ذهبي"
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    guesses = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "guard.db")
+        migrations.migrate(path)
+        codes = generate_coupons.generate_chunks(100, n, "VIP-", path=path)
+        codes = [c for chunk in codes for c in chunk]
+        coupon_guard.load(path)
+
+        queries = []
+        db.get_conn(path).set_trace_callback(queries.append)
+        start = time.perf_counter()
+        for i in range(guesses):
+            ok, msg = coupons.redeem(generate_coupons._random_codes(1, 8)[0], 1, plan, path=path)
+            assert not ok and msg == coupons.MSG_UNAVAILABLE, msg
+        elapsed = time.perf_counter() - start
+        assert len(queries) <= 1, f"{len(queries)} queries for random guesses"  # at most one sync
+        print(f"{guesses} random guesses refused in {elapsed:.2f}s, {len(queries)} DB statements")
+
+        # real codes still work, whatever the spelling; then they are gone
+        ok, info = coupons.redeem(codes[0].lower().replace("-", " "), 1, plan, path=path, update_worker=False)
+        assert ok and info["code"] == codes[0], info
+        ok, msg = coupons.redeem(codes[0], 1, plan, path=path, update_worker=False)
+        assert not ok and msg == coupons.MSG_UNAVAILABLE, msg
+
+        # a coupon created behind the guard's back is found on the next sync
+        with db.transaction(path) as conn:
+            conn.execute("INSERT INTO coupons (code, code_norm, amount) VALUES ('LATE1', 'LATE1', 100)")
+        coupon_guard._synced_at = 0
+        ok, info = coupons.redeem("late1", 2, plan, path=path, update_worker=False)
+        assert ok, info
+
+        # the limiter stops a guessing user and spares everyone else
+        for _ in range(coupon_guard.MAX_FAILURES):
+            coupons.redeem("NOPE", 3, plan, path=path, requested_by=3)
+        ok, msg = coupons.redeem(codes[1], 3, plan, path=path, update_worker=False, requested_by=3)
+        assert not ok and "محاولات" in msg, msg
+        ok, _ = coupons.redeem(codes[1], 4, plan, path=path, update_worker=False, requested_by=4)
+        assert ok
+        db.close_all()
+    print("OK:", coupon_guard.stats())
+
+
+if __name__ == "__main__":
+    main()
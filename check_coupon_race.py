@@ -0,0 +1,68 @@
+"""Concurrency check: many threads redeem the same coupon at once; exactly one may win.
+
+Usage: python check_coupon_race.py [threads] [rounds]
+
+Works on a throw-away database in a temp directory (never touches data.db).
+Each round inserts one fresh coupon and N workers, releases N threads at the
+same moment against src.utils.coupons.redeem() and checks that exactly one
+redemption succeeded and only that worker got the subscription.
+"""
+import os
+import sys
+import tempfile
+import threading
+
+from src.utils import db, migrations, coupons
+
+
+def plan(amount):
+    return 1, 32, "ذهبي"
+
+
+def one_round(path, n, rnd):
+    code = f"VIP-RACE{rnd:04d}"
+    with db.transaction(path) as conn:
+        conn.execute("INSERT INTO coupons (code, code_norm, amount) VALUES (?, ?, 100)", (code, coupons.normalize(code)))
+        conn.executemany("INSERT OR IGNORE INTO workers (user_id, name) VALUES (?, ?)", [(1000 + i, f"w{i}") for i in range(n)])
+        conn.execute("UPDATE workers SET subscription_level = 0, coupon_code = NULL")
+    barrier = threading.Barrier(n)
+    results = [None] * n
+    # users type the code in different spellings; all must hit the same row
+    spellings = [code, code.lower(), "race" + code[-4:], " vip race" + code[-4:] + " "]
+
+    def worker(i):
+        barrier.wait()
+        try:
+            results[i] = coupons.redeem(spellings[i % len(spellings)], 1000 + i, plan, path=path)[0]
+        except Exception as e:  # a lock timeout would show up here
+            results[i] = e
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(n)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    errors = [r for r in results if isinstance(r, Exception)]
+    wins = [1000 + i for i, r in enumerate(results) if r is True]
+    conn = db.get_conn(path)
+    subscribed = [r[0] for r in conn.execute("SELECT user_id FROM workers WHERE coupon_code = ?", (code,))]
+    used_by = conn.execute("SELECT used, used_by_worker_user_id FROM coupons WHERE code = ?", (code,)).fetchone()
+    assert not errors, f"round {rnd}: errors {errors[:3]}"
+    assert len(wins) == 1, f"round {rnd}: {len(wins)} redemptions succeeded"
+    assert subscribed == wins and used_by == (1, wins[0]), f"round {rnd}: state mismatch {subscribed} {used_by}"
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 32
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "race.db")
+        migrations.migrate(path)
+        for rnd in range(rounds):
+            one_round(path, n, rnd)
+        db.close_all()
+    print(f"OK: {rounds} rounds x {n} threads, exactly one redemption per coupon")
+
+
+if __name__ == "__main__":
+    main()
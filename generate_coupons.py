@@ -1,36 +1,111 @@
-import sqlite3, os, random, string, argparse
+import os, sys, gzip, time, secrets, string, argparse
 from datetime import datetime
+from src.utils import db, migrations, coupon_guard
+from src.utils.coupons import normalize
 
-DB = os.path.join(os.path.dirname(__file__), "data.db")
+DB = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data.db")
 
-def make_code(length=8):
-    return ''.join(random.choices(string.ascii_uppercase + string.digits, k=length))
+ALPHABET = (string.ascii_uppercase + string.digits).encode()
+# byte -> code character; the top 256 % 36 byte values are dropped so every character is equally likely
+_KEEP = 256 - 256 % len(ALPHABET)
+_TO_CHAR = bytes(ALPHABET[b % len(ALPHABET)] for b in range(256))
+_REJECT = bytes(range(_KEEP, 256))
 
-def generate(amount, count, prefix=None):
-    conn = sqlite3.connect(DB)
-    cur = conn.cursor()
-    created = []
-    for _ in range(count):
-        code = (prefix or "") + make_code(8)
+
+def _random_codes(n, length):
+    """n random codes of `length` characters from one secrets.token_bytes buffer (no modulo bias)."""
+    need = n * length
+    chars = b""
+    while len(chars) < need:
+        # ~2% of the bytes are rejected; ask for a little more than needed
+        chars += secrets.token_bytes(int((need - len(chars)) * 1.05) + 16).translate(_TO_CHAR, _REJECT)
+    text = chars[:need].decode("ascii")
+    return [text[i:i + length] for i in range(0, need, length)]
+
+
+def _existing_norms(conn):
+    return {r[0] for r in conn.execute("SELECT code_norm FROM coupons WHERE code_norm IS NOT NULL")}
+
+
+def generate_chunks(amount, count, prefix=None, length=8, chunk_size=20000, path=None):
+    """Insert exactly `count` new coupons, yielding each committed chunk of codes.
+
+    Candidates are checked against every existing code (and each other) in
+    memory, so a chunk normally inserts in one executemany. If another process
+    inserted a clashing code meanwhile, the chunk is rolled back and redrawn.
+    """
+    if count < 1 or chunk_size < 1 or length < 1:
+        raise SystemExit("count, chunk_size and length must be at least 1")
+    path = path or DB
+    migrations.migrate(path)
+    prefix = prefix or ""
+    taken = _existing_norms(db.get_conn(path))
+    if 36 ** length < (len(taken) + count) * 100:
+        raise SystemExit(f"length {length} is too short for {count} codes; use --length {length + 2}")
+    left = count
+    while left:
+        want = min(chunk_size, left)
+        chunk = []
+        while len(chunk) < want:
+            for body in _random_codes(want - len(chunk), length):
+                code = prefix + body
+                norm = normalize(code)
+                if norm not in taken:
+                    taken.add(norm)
+                    chunk.append((code, norm, amount))
         try:
-            cur.execute("INSERT INTO coupons (code, amount) VALUES (?, ?)", (code, amount))
-            created.append(code)
-        except Exception:
-            # duplicate or db error, try next
+            with db.transaction(path) as conn:
+                conn.executemany("INSERT INTO coupons (code, code_norm, amount) VALUES (?, ?, ?)", chunk)
+        except db.sqlite3.IntegrityError:
+            # raced with another writer: reload what exists and draw this chunk again
+            taken = _existing_norms(db.get_conn(path)) | taken
             continue
-    conn.commit()
-    conn.close()
+        coupon_guard.add([c[1] for c in chunk], path)
+        left -= len(chunk)
+        yield [c[0] for c in chunk]
+
+
+def _positive(value):
+    n = int(value)
+    if n < 1:
+        raise argparse.ArgumentTypeError("يجب أن يكون العدد 1 أو أكثر")
+    return n
+
+
+def generate(amount, count, prefix=None):
+    created = []
+    for chunk in generate_chunks(amount, count, prefix):
+        created.extend(chunk)
     return created
 
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--amount", type=int, choices=[60,100], required=True, help="60 أو 100")
-    parser.add_argument("--count", type=int, default=10)
+    parser.add_argument("--count", type=_positive, default=10)
     parser.add_argument("--prefix", type=str, help="بادئة اختيارية")
+    parser.add_argument("--length", type=_positive, default=8, help="طول الجزء العشوائي من الكود")
+    parser.add_argument("--chunk", type=_positive, default=20000, help="عدد الأكواد في كل معاملة")
+    parser.add_argument("--out", type=str, help="ملف الإخراج (ينتهي بـ .gz للضغط)")
+    parser.add_argument("--gzip", action="store_true", help="ضغط ملف الإخراج")
+    parser.add_argument("--db", type=str, default=DB)
     args = parser.parse_args()
-    codes = generate(args.amount, args.count, args.prefix)
-    out = f"coupons_{args.amount}_{datetime.utcnow().strftime('%Y%m%d%H%M%S')}.txt"
-    with open(out, "w", encoding="utf-8") as f:
-        for c in codes:
-            f.write(f"{c}\n")
-    print("Generated:", len(codes), "saved to", out)
\ No newline at end of file
+    out = args.out or f"coupons_{args.amount}_{datetime.utcnow().strftime('%Y%m%d%H%M%S')}.txt"
+    if args.gzip and not out.endswith(".gz"):
+        out += ".gz"
+    opener = gzip.open if out.endswith(".gz") else open
+    start = time.perf_counter()
+    done = 0
+    # the file is written chunk by chunk, right after each chunk is committed
+    with opener(out, "wt", encoding="utf-8") as f:
+        for chunk in generate_chunks(args.amount, args.count, args.prefix, args.length, args.chunk, args.db):
+            f.write("\n".join(chunk) + "\n")
+            done += len(chunk)
+            if args.count > args.chunk:
+                elapsed = time.perf_counter() - start
+                print(f"\r{done}/{args.count} ({done / elapsed:,.0f} codes/s)", end="", file=sys.stderr, flush=True)
+    if args.count > args.chunk:
+        print(file=sys.stderr)
+    db.close_all()
+    elapsed = time.perf_counter() - start
+    print("Generated:", done, "saved to", out, f"in {elapsed:.2f}s ({done / elapsed if elapsed else done:,.0f} codes/s)")
@@ -1,18 +1,32 @@
 from telegram import Update, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, MessageHandler, ContextTypes, filters, CallbackQueryHandler
-import sqlite3
 import os
 import logging
 import re
 from dotenv import load_dotenv
 import math
-import datetime
+import asyncio
+from src.utils import db  # shared long-lived SQLite connections (WAL, busy timeout)
+from src.utils import migrations  # versioned schema migrations (PRAGMA user_version)
+from src.utils import coupons  # index-backed, atomic coupon redemption
+from src.utils import coupon_guard  # in-memory unused-code check + per-user attempt limiter
+from src.utils import outbound  # rate limiter every Telegram request goes through
+from src.utils import state_store  # TTL-bounded conversation state persisted in SQLite
+from src.utils import counters  # write-behind buffer for worker counters
+from src.utils import geo  # grid-cell spatial index for nearest-worker search
+from src.utils import scoring  # batched (NumPy) distance scoring and ranking
+from src.utils import result_pages  # top-K search results cached for paging
+from src.utils import labels  # precompiled Arabic normalisation + label variant index
+from src.utils import service_search  # trigram index suggesting services for mistyped text
+from src.utils import worker_search  # FTS5 keyword filter over worker names and specialisations
 
 load_dotenv()
 logging.basicConfig(level=logging.INFO)
 TOKEN = os.getenv("BOT_TOKEN") or ""
 ADMIN_ID = int(os.getenv("ADMIN_USER_ID", "0")) or 0
 DB_PATH = os.path.join(os.path.dirname(__file__), "data.db")
+# clients see workers up to this distance (km)
+CLIENT_MAX_KM = 40.0
 
 # Categories -> services mapping (category first UX)
 SERVICE_CATEGORIES = {
@@ -35,67 +49,50 @@ for cat, vals in SERVICE_CATEGORIES.items():
     else:
         WORK_TYPES.append(cat)
 
-# (WORK_TYPES_NORMALIZED will be built after normalize_label is defined)
+# (LABELS, the label variant index, is built after MAIN_KB below)
 
 SERVICE_KEYS = {"الخدمات", "🛠️ الخدمات", "الخدمة", "خدمات", "عرض الخدمات", "سيرفز", "سرفز"}
 CONTACT_KEYS = {"تواصل معنا", "اتصل بنا", "تواصل", "اتصل", "📞 تواصل معنا"}
 ABOUT_KEYS = {"نبذة عنا", "📜 نبذة عنا", "📜نبذة عنا", "نبذة", "عن التطبيق", "من نحن"}
 
 
-def normalize_label(s: str) -> str:
-    """Normalize a label by removing emojis/special chars and lowercasing for matching."""
-    if not s:
-        return ""
-    # keep Arabic letters, Latin letters, digits and spaces
-    import re
-    cleaned = re.sub(r"[^\w\u0600-\u06FF\s]", "", s)
-    # remove spaces after the Arabic conjunction 'و' (e.g. 'و المفروشات' -> 'والمفروشات')
-    cleaned = re.sub(r"و\s+", "و", cleaned)
-    # collapse multiple whitespace to single space
-    cleaned = re.sub(r"\s+", " ", cleaned)
-    # remove Arabic diacritics (tashkeel)
-    cleaned = re.sub(r"[\u064B-\u0652]", "", cleaned)
-    # normalize Alef/Hamza variants to bare Alef
-    cleaned = re.sub(r"[إأآ]", "ا", cleaned)
-    # normalize final Alef Maqsura to Ya
-    cleaned = cleaned.replace("ى", "ي")
-    # remove tatweel/kashida
-    cleaned = cleaned.replace("ـ", "")
-    return cleaned.strip().lower()
+# one shared, memoised normaliser (src/utils/labels.py)
+normalize_label = labels.normalize
+strip_definite_article = labels.strip_definite_article
 
 
-def strip_definite_article(s: str) -> str:
-    """Remove Arabic definite article 'ال' from the start of words to allow matching
-    user input without the article (e.g. 'تركيب كاميرات' -> match 'تركيب الكاميرات')."""
-    if not s:
-        return s
-    parts = []
-    for w in s.split():
-        if w.startswith("ال") and len(w) > 2:
-            parts.append(w[2:])
-        else:
-            parts.append(w)
-    return " ".join(parts)
-
-# build reverse map: normalized -> canonical category key
-CATEGORY_NORMALIZED = {normalize_label(k): k for k in SERVICE_CATEGORIES.keys()}
-SERVICE_KEYS_NORMALIZED = {normalize_label(s) for s in SERVICE_KEYS}
-
 MAIN_MENU_LAYOUT = [["🛠️ الخدمات", "📝 التسجيل للحرفيين"], ["🔓 تفعيل الاشتراك", "📊حسابي"], ["📜 نبذة عنا", "📞 تواصل معنا"]]
 MAIN_KB = ReplyKeyboardMarkup(MAIN_MENU_LAYOUT, resize_keyboard=True)
 
-# normalized reverse map for work types so users can type without emojis
-# e.g. "تركيب كاميرات" -> canonical "🔧تركيب الكاميرات"
-WORK_TYPES_NORMALIZED = {}
-# include both the plain normalized label and a version with the definite article
-for w in WORK_TYPES:
-    k = normalize_label(w)
-    WORK_TYPES_NORMALIZED.setdefault(k, w)
-    k2 = strip_definite_article(k)
-    if k2 and k2 != k:
-        WORK_TYPES_NORMALIZED.setdefault(k2, w)
+# every accepted label variant -> (kind, canonical label); users can type without emojis,
+# articles or hamza, e.g. "تركيب كاميرات" -> ("service", "🔧تركيب الكاميرات").
+# Registration order decides shared keys: the services menu, then categories, then services.
+LABELS = labels.LabelIndex()
+LABELS.add(("services_menu", None), *SERVICE_KEYS)
+for _cat in SERVICE_CATEGORIES:
+    LABELS.add(("category", _cat), _cat)
+for _w in WORK_TYPES:
+    LABELS.add(("service", _w), _w)
+WORK_TYPES_SET = set(WORK_TYPES)
+
+# work types with an extra registration question
+TRANSPORT_WORK_TYPE = normalize_label("سيارات نقل")
+FLOORING_WORK_TYPE = normalize_label("أرضيات")
+
 
-user_states = {}
+def resolve_service(text):
+    """Canonical work type for a pressed or typed label, or None."""
+    if text in WORK_TYPES_SET:
+        return text
+    _, canonical = LABELS.get(text, (None, None))
+    return canonical if canonical in WORK_TYPES_SET else None
+
+
+# typo-tolerant suggestions: every service and category label is suggested as itself
+service_search.build([(w, w) for w in WORK_TYPES] + [(c, c) for c in SERVICE_CATEGORIES])
+
+# multi-step conversation state: TTL-bounded, persisted so a restart resumes at the same step
+user_states = state_store.StateStore("khidmati", DB_PATH)
 
 
 def make_reply_kb(rows, include_back=True):
@@ -135,165 +132,88 @@ def haversine(lat1, lon1, lat2, lon2):
     return R * 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
 
 def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    # base table (keep compatible with create_db.py)
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS workers (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER UNIQUE,
-        name TEXT,
-        phone TEXT,
-        work_type TEXT,
-        worker_code INTEGER
-    )
-    """)
-    # Ensure optional columns exist (safe migrations)
-    existing = {r[1] for r in cur.execute("PRAGMA table_info(workers)").fetchall()}
-    extras = {
-        'lat': 'REAL', 'lon': 'REAL', 'vehicle_type': 'TEXT', 'edu_specialty': 'TEXT',
-        'floor_type': 'TEXT', 'tier': 'TEXT', 'appearance_count': 'INTEGER DEFAULT 0',
-        'selection_count': 'INTEGER DEFAULT 0', 'avg_rating': 'REAL DEFAULT 0', 'ratings_received': 'INTEGER DEFAULT 0', 'subscription_end': 'TEXT',
-        'subscription_level': 'INTEGER', 'subscription_expiry': 'TEXT', 'coupon_code': 'TEXT'
-    }
-    for col, coldef in extras.items():
-        if col not in existing:
-            try:
-                cur.execute(f"ALTER TABLE workers ADD COLUMN {col} {coldef}")
-            except Exception:
-                pass
-    # coupons table (used by coupon generation script)
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS coupons (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        code TEXT UNIQUE,
-        amount INTEGER,
-        used INTEGER DEFAULT 0
-    )
-    """)
-    # ensure coupon metadata columns exist
-    existing_c = {r[1] for r in cur.execute("PRAGMA table_info(coupons)").fetchall()}
-    c_extras = {
-        'used_by_worker_user_id': 'INTEGER', 'used_at': 'TEXT'
-    }
-    for col, coldef in c_extras.items():
-        if col not in existing_c:
-            try:
-                cur.execute(f"ALTER TABLE coupons ADD COLUMN {col} {coldef}")
-            except Exception:
-                pass
-    conn.commit(); conn.close()
+    # versioned migrations shared with bot.py (src/utils/migrations.py); a current
+    # database costs one PRAGMA read instead of probing every column
+    version = migrations.migrate(DB_PATH)
+    logging.info("DB schema version %d", version)
 
 def save_worker_to_db(user_id, state):
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("SELECT id, worker_code FROM workers WHERE user_id = ?", (user_id,))
-    r = cur.fetchone()
-    if r:
-        cur.execute(
-            "UPDATE workers SET name=?, phone=?, work_type=?, lat=?, lon=?, vehicle_type=?, edu_specialty=?, floor_type=?, tier=?, subscription_end=? WHERE user_id=?",
-            (state.get("name"), state.get("phone"), state.get("work_type"), state.get("lat"), state.get("lon"), state.get("vehicle_type"), state.get("edu_specialty"), state.get("floor_type"), state.get("tier"), state.get("subscription_end"), user_id)
-        )
-    else:
-        cur.execute(
-            "INSERT INTO workers (user_id, name, phone, work_type, lat, lon, vehicle_type, edu_specialty, floor_type, tier, subscription_end) VALUES (?,?,?,?,?,?,?,?,?,?,?)",
-            (user_id, state.get("name"), state.get("phone"), state.get("work_type"), state.get("lat"), state.get("lon"), state.get("vehicle_type"), state.get("edu_specialty"), state.get("floor_type"), state.get("tier"), state.get("subscription_end"))
-        )
-        # ensure worker_code exists
+    # one transaction: a failure part-way leaves nothing behind on the shared connection
+    with db.transaction(DB_PATH) as conn:
+        cur = conn.cursor()
         cur.execute("SELECT id, worker_code FROM workers WHERE user_id = ?", (user_id,))
-        new = cur.fetchone()
-        if new and (not new[1]):
-            code = 2000 + new[0]
-            try:
-                cur.execute("UPDATE workers SET worker_code=? WHERE id=?", (code, new[0]))
-            except Exception:
-                pass
-    conn.commit(); conn.close()
+        r = cur.fetchone()
+        if r:
+            cur.execute(
+                "UPDATE workers SET name=?, phone=?, work_type=?, lat=?, lon=?, geo_cell=?, vehicle_type=?, education_specialization=?, floor_type=?, tier=?, subscription_end=? WHERE user_id=?",
+                (state.get("name"), state.get("phone"), state.get("work_type"), state.get("lat"), state.get("lon"), geo.cell_of(state.get("lat"), state.get("lon")), state.get("vehicle_type"), state.get("edu_specialty"), state.get("floor_type"), state.get("tier"), state.get("subscription_end"), user_id)
+            )
+        else:
+            cur.execute(
+                "INSERT INTO workers (user_id, name, phone, work_type, lat, lon, geo_cell, vehicle_type, education_specialization, floor_type, tier, subscription_end) VALUES (?,?,?,?,?,?,?,?,?,?,?,?)",
+                (user_id, state.get("name"), state.get("phone"), state.get("work_type"), state.get("lat"), state.get("lon"), geo.cell_of(state.get("lat"), state.get("lon")), state.get("vehicle_type"), state.get("edu_specialty"), state.get("floor_type"), state.get("tier"), state.get("subscription_end"))
+            )
+            # ensure worker_code exists
+            cur.execute("SELECT id, worker_code FROM workers WHERE user_id = ?", (user_id,))
+            new = cur.fetchone()
+            if new and (not new[1]):
+                code = 2000 + new[0]
+                try:
+                    cur.execute("UPDATE workers SET worker_code=? WHERE id=?", (code, new[0]))
+                except Exception:
+                    pass
 
 def fetch_worker_by_code(code):
-    conn = sqlite3.connect(DB_PATH)
+    conn = db.connect(DB_PATH)
     cur = conn.cursor()
-    cur.execute("SELECT id, user_id, name, phone, work_type, worker_code, lat, lon, tier, appearance_count, selection_count, avg_rating, subscription_end, subscription_level, subscription_expiry, coupon_code FROM workers WHERE worker_code=?", (code,))
+    cur.execute("SELECT id, user_id, name, phone, work_type, worker_code, lat, lon, tier, appearance_count, selected_count, avg_rating, subscription_end, subscription_level, subscription_expiry, coupon_code FROM workers WHERE worker_code=?", (code,))
     r = cur.fetchone()
     conn.close()
     if not r:
         return None
-    keys = ['id','user_id','name','phone','work_type','worker_code','lat','lon','tier','appearance_count','selection_count','avg_rating','subscription_end','subscription_level','subscription_expiry','coupon_code']
-    return dict(zip(keys, r))
+    keys = ['id','user_id','name','phone','work_type','worker_code','lat','lon','tier','appearance_count','selected_count','avg_rating','subscription_end','subscription_level','subscription_expiry','coupon_code']
+    w = dict(zip(keys, r))
+    # include increments still waiting in the write-behind buffer
+    for col, delta in counters.pending_for(w['user_id']).items():
+        if col in w:
+            w[col] = (w[col] or 0) + delta
+    return w
 
 
 def redeem_coupon_for_worker(code_input, requesting_user_id, target_worker_user_id=None, desired_tier=None):
     code = (code_input or "").strip().upper()
     if not code:
         return False, "الكود فارغ."
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    # allow multiple candidate formats: raw, with hyphens
-    candidates = [code]
-    if '-' in code:
-        candidates.append(code.replace('-', ''))
-    try:
-        found = None
-        for c in candidates:
-            cur.execute("SELECT id, amount, used, code FROM coupons WHERE UPPER(code)=?", (c.upper(),))
-            row = cur.fetchone()
-            if row:
-                found = row
-                break
-        if not found:
-            conn.close()
-            return False, "الكود غير موجود أو غير صالح."
-        cid, amount, used, actual_code = found
-        if used:
-            conn.close()
-            return False, "هذا الكود مُستخدم مسبقاً."
 
+    def plan(amount):
+        tier = desired_tier
         # Validate desired_tier vs coupon amount
-        if desired_tier:
-            if desired_tier == "gold" and int(amount) != 100:
-                conn.close(); return False, "هذا الكود ليس مخصصًا للفئة الذهبية. استخدم كودًا بقيمة 100 د.ل."
-            if desired_tier == "silver" and int(amount) != 60:
-                conn.close(); return False, "هذا الكود ليس مخصصًا للفئة الفضية. استخدم كودًا بقيمة 60 د.ل."
-        else:
+        if tier == "gold" and amount != 100:
+            return "هذا الكود ليس مخصصًا للفئة الذهبية. استخدم كودًا بقيمة 100 د.ل."
+        if tier == "silver" and amount != 60:
+            return "هذا الكود ليس مخصصًا للفئة الفضية. استخدم كودًا بقيمة 60 د.ل."
+        if not tier:
             # infer from amount
-            if int(amount) == 100:
-                desired_tier = "gold"
-            elif int(amount) == 60:
-                desired_tier = "silver"
-            else:
-                desired_tier = "custom"
-
-        if desired_tier == "gold":
+            tier = {100: "gold", 60: "silver"}.get(amount, "custom")
+        if tier == "gold":
             # New mapping: gold -> 1, silver -> 0 (gold gets star when level == 1)
-            level = 1; days = 32; tier_name = "ذهبي"
-        elif desired_tier == "silver":
-            level = 0; days = 30; tier_name = "فضي"
-        else:
-            level = 0; days = 30; tier_name = f"({amount})"
-
-        import datetime
-        expiry = datetime.datetime.utcnow() + datetime.timedelta(days=days)
-        expiry_iso = expiry.isoformat()
+            return 1, 32, "ذهبي"
+        if tier == "silver":
+            return 0, 30, "فضي"
+        return 0, 30, f"({amount})"
 
-        # choose target worker
-        if not target_worker_user_id:
-            target_worker_user_id = requesting_user_id
-
-        # mark coupon used and update worker
-        try:
-            cur.execute("UPDATE coupons SET used=1, used_by_worker_user_id=?, used_at=? WHERE id=?", (target_worker_user_id, expiry_iso, cid))
-            cur.execute("UPDATE workers SET subscription_level = ?, subscription_expiry = ?, coupon_code = ? WHERE user_id = ?",
-                        (level, expiry_iso, actual_code, target_worker_user_id))
-            conn.commit()
-            conn.close()
-            return True, f"تم تفعيل الاشتراك للفئة {tier_name}. سينتهي الاشتراك بتاريخ {expiry_iso}."
-        except Exception:
-            conn.close()
-            logging.exception("Error while marking coupon used in redeem_coupon_for_worker")
-            return False, "حدث خطأ أثناء تفعيل الكود. حاول مرة أخرى أو تواصل مع الدعم."
+    # choose target worker
+    if not target_worker_user_id:
+        target_worker_user_id = requesting_user_id
+    try:
+        # indexed lookup + conditional claim (WHERE used=0) + worker update in one transaction
+        ok, result = coupons.redeem(code, target_worker_user_id, plan, path=DB_PATH, requested_by=requesting_user_id)
     except Exception:
-        conn.close()
+        logging.exception("Error while marking coupon used in redeem_coupon_for_worker")
         return False, "حدث خطأ أثناء معالجة الكود."
+    if not ok:
+        return False, result
+    return True, f"تم تفعيل الاشتراك للفئة {result['tier_name']}. سينتهي الاشتراك بتاريخ {result['expiry']}."
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_states.pop(update.effective_user.id, None)
@@ -344,6 +264,22 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.edit_message_text("تم الرجوع. اختر فئة الاشتراك المطلوبة:", reply_markup=sub_kb)
         return
 
+    # next page of a nearest-worker search: more:{search_key}:{page}
+    if data.startswith("more:"):
+        parts = data.split(":")
+        try:
+            search_key = parts[1]; page_no = int(parts[2])
+        except Exception:
+            await query.edit_message_text("خطأ في بيانات الصفحة.")
+            return
+        # the button is used once; the next page brings its own
+        try:
+            await query.edit_message_reply_markup(reply_markup=None)
+        except Exception:
+            logging.debug("Could not remove the more button")
+        await send_worker_page(query.message, search_key, page_no)
+        return
+
     # Registration subscription selection (during worker registration)
     if data.startswith("reg_sub:"):
         parts = data.split(":", 1)
@@ -409,15 +345,8 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not w:
             await query.edit_message_text("لم يتم العثور على معلومات هذا العامل. ربما تم حذفه.")
             return
-        # increment selection_count
-        try:
-            conn = sqlite3.connect(DB_PATH)
-            cur = conn.cursor()
-            cur.execute("UPDATE workers SET selection_count = COALESCE(selection_count,0)+1 WHERE user_id=?", (w.get('user_id'),))
-            conn.commit()
-            conn.close()
-        except Exception:
-            logging.exception("Failed to increment selection_count")
+        # increment selected_count (buffered, flushed in batches)
+        counters.add("selected_count", w.get('user_id'))
         # confirm to the user and provide contact info (phone)
         # Do NOT reveal worker_code to customers; it's private for the worker.
         reply_text = f"تم اختيار العامل:\nالاسم: {w.get('name') or '-'}\nالهاتف: {w.get('phone') or '-'}\nالعمل: {w.get('work_type') or '-'}"
@@ -446,20 +375,15 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not w:
             await query.answer(text="العامل غير موجود.", show_alert=True)
             return
-        # update avg_rating and ratings_received
+        # insert the rating; the ratings trigger updates rating_count/rating_sum/avg_rating
+        # on the worker row in the same statement, so concurrent ratings are never lost
         try:
-            conn = sqlite3.connect(DB_PATH)
-            cur = conn.cursor()
-            cur.execute("SELECT avg_rating, ratings_received FROM workers WHERE user_id=?", (w.get('user_id'),))
-            row = cur.fetchone()
-            if row:
-                old_avg = float(row[0] or 0.0); old_count = int(row[1] or 0)
-            else:
-                old_avg = 0.0; old_count = 0
-            new_count = old_count + 1
-            new_avg = (old_avg * old_count + score) / new_count
-            cur.execute("UPDATE workers SET avg_rating=?, ratings_received=? WHERE user_id=?", (new_avg, new_count, w.get('user_id')))
-            conn.commit(); conn.close()
+            with db.transaction(DB_PATH) as conn:
+                conn.execute("INSERT INTO ratings (worker_user_id, client_user_id, rating) VALUES (?,?,?)",
+                             (w.get('user_id'), query.from_user.id, score))
+                new_count, new_sum = conn.execute("SELECT rating_count, rating_sum FROM workers WHERE user_id=?", (w.get('user_id'),)).fetchone()
+            counters.add("ratings_received", w.get('user_id'))
+            new_avg = (new_sum or 0) / new_count if new_count else 0.0
             await query.edit_message_text(f"شكرًا لتقييمك! التقييم الحالي للعامل {w.get('name') or '-'} هو {new_avg:.2f} ({new_count} تقييمات)")
         except Exception:
             logging.exception("Failed to save rating")
@@ -473,7 +397,6 @@ async def handle_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = msg.from_user.id
     text = (msg.text or "").strip()
     text_l = (text or "").lower()
-    cleaned_label = re.sub(r"^[^\w\u0600-\u06FF]*", "", text).strip()
     # load current user state early so we can branch client vs worker flows
     st = user_states.get(user_id)
 
@@ -550,21 +473,21 @@ async def handle_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await start(update, context); return
     # Activation flow entrance (button in main menu)
     norm = normalize_label(text)
+    kind, canonical = LABELS.get(text, (None, None))
     if text in ("تفعيل الاشتراك", "� تفعيل الاشتراك", "تفعيل") or norm == 'تفعيل الاشتراك' or 'تفعيل' in norm:
         user_states[user_id] = {"role": "activate_subscription", "step": "enter_worker_code"}
         await msg.reply_text("أدخل رقم المعرف الخاص بك (worker code) لتفعيل أو تجديد اشتراكك:")
         return
     # Services / categories handling: be robust to emoji/label variants using normalized map
     # Only show categories to browsing/clients — do not intercept worker registration
-    if (not st or st.get("role") != "worker") and norm in SERVICE_KEYS_NORMALIZED:
+    if (not st or st.get("role") != "worker") and kind == "services_menu":
         cats = list(SERVICE_CATEGORIES.keys())
         kb = make_reply_kb([[c] for c in cats])
         user_states[user_id] = {"role": "browsing", "step": "categories"}
         await msg.reply_text("اختر الفئة:", reply_markup=kb)
         return
     # If user selected a category name (possibly with emoji), map via normalized map
-    if (not st or st.get("role") != "worker") and norm in CATEGORY_NORMALIZED:
-        canonical = CATEGORY_NORMALIZED.get(norm)
+    if (not st or st.get("role") != "worker") and kind == "category":
         services = SERVICE_CATEGORIES.get(canonical) or []
         if services:
             kb = make_reply_kb([[s] for s in services])
@@ -600,10 +523,7 @@ async def handle_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Accept service selection only for clients (do not override worker registration flow)
     canonical_service = None
     if not (st and st.get("role") == "worker"):
-        if text in WORK_TYPES:
-            canonical_service = text
-        else:
-            canonical_service = WORK_TYPES_NORMALIZED.get(norm) or WORK_TYPES_NORMALIZED.get(strip_definite_article(norm))
+        canonical_service = resolve_service(text)
     if canonical_service:
         name = (update.effective_user.first_name or "")
         # preserve previous browsing category if any so 'رجوع' can restore it
@@ -729,12 +649,12 @@ async def handle_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     st["work_type"] = text
                     # if the selected category is a direct work type without subservices
                     # Compare normalized labels so emoji/no-emoji variants match
-                    if normalize_label(st.get("work_type")) == normalize_label("سيارات نقل"):
+                    if normalize_label(st.get("work_type")) == TRANSPORT_WORK_TYPE:
                         st["step"] = "vehicle"
                         user_states[user_id] = st
                         await msg.reply_text("ما نوع السيارة لديك؟")
                         return
-                    if normalize_label(st.get("work_type")) == normalize_label("أرضيات"):
+                    if normalize_label(st.get("work_type")) == FLOORING_WORK_TYPE:
                         st["step"] = "floor_type"
                         user_states[user_id] = st
                         await msg.reply_text("ما نوع الأرضيات التي تتقنها؟")
@@ -744,7 +664,7 @@ async def handle_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     has_phone = bool(st.get("phone"))
                     if not has_phone:
                         try:
-                            conn = sqlite3.connect(DB_PATH)
+                            conn = db.connect(DB_PATH)
                             cur = conn.cursor()
                             cur.execute("SELECT phone FROM workers WHERE user_id=?", (user_id,))
                             row = cur.fetchone()
@@ -772,20 +692,16 @@ async def handle_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     await msg.reply_text('الرجاء إدخال رقم هاتفك يدوياً بصيغة 09XXXXXXXX:')
                     return
             # accept non-emoji typed services by mapping normalized input
-            canonical_w = None
-            if text in WORK_TYPES:
-                canonical_w = text
-            else:
-                canonical_w = WORK_TYPES_NORMALIZED.get(norm) or WORK_TYPES_NORMALIZED.get(strip_definite_article(norm))
+            canonical_w = resolve_service(text)
             if canonical_w:
                 st["work_type"] = canonical_w
                 # special prompts based on chosen work_type
-                if normalize_label(st.get("work_type")) == normalize_label("سيارات نقل"):
+                if normalize_label(st.get("work_type")) == TRANSPORT_WORK_TYPE:
                     st["step"] = "vehicle"
                     user_states[user_id] = st
                     await msg.reply_text("ما نوع السيارة لديك؟")
                     return
-                if normalize_label(st.get("work_type")) == normalize_label("أرضيات"):
+                if normalize_label(st.get("work_type")) == FLOORING_WORK_TYPE:
                     st["step"] = "floor_type"
                     user_states[user_id] = st
                     await msg.reply_text("ما نوع الأرضيات التي تتقنها؟")
@@ -800,7 +716,7 @@ async def handle_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 has_phone = bool(st.get("phone"))
                 if not has_phone:
                     try:
-                        conn = sqlite3.connect(DB_PATH)
+                        conn = db.connect(DB_PATH)
                         cur = conn.cursor()
                         cur.execute("SELECT phone FROM workers WHERE user_id=?", (user_id,))
                         row = cur.fetchone()
@@ -886,10 +802,27 @@ async def handle_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
         tier_map = {1: 'ذهبي', 0: 'فضي'}
         lvl = w.get('subscription_level')
         tier_text = tier_map.get(lvl, 'لا يوجد')
-        resp = f"الاسم: {w.get('name') or '-'}\nالفئة: {tier_text}\nانتهاء الاشتراك: {w.get('subscription_expiry') or '-'}\nمرات الظهور: {w.get('appearance_count') or 0}\nمرات الاختيار: {w.get('selection_count') or 0}\nمتوسط التقييم: {w.get('avg_rating') or 0}"
+        resp = f"الاسم: {w.get('name') or '-'}\nالفئة: {tier_text}\nانتهاء الاشتراك: {w.get('subscription_expiry') or '-'}\nمرات الظهور: {w.get('appearance_count') or 0}\nمرات الاختيار: {w.get('selected_count') or 0}\nمتوسط التقييم: {w.get('avg_rating') or 0}"
         await msg.reply_text(resp)
         user_states.pop(user_id, None)
         return
+    # a client looking at results: a word narrows them by name/specialisation
+    if st and st.get("role") == "client" and st.get("step") == "choose_worker" and st.get("lat") is not None \
+            and not text.isdigit() and worker_search.match_query(text):
+        found = fetch_nearby_workers(st.get("service"), st["lat"], st["lon"], keyword=text)
+        if not found:
+            await msg.reply_text(f"لا يوجد حرفي قريب يطابق «{text}». جرّب كلمة أخرى أو اختر خدمة من القائمة.")
+            return
+        search_key = f"{st.get('search_key') or user_id}-{abs(hash(text)) % 100000}"
+        result_pages.put(search_key, found)
+        await msg.reply_text(f"نتائج البحث عن «{text}»:")
+        await send_worker_page(msg, search_key, 0)
+        return
+    # free text while not in a registration flow is most likely a mistyped service name
+    found = service_search.suggest(text) if (not st or st.get("role") == "browsing") else []
+    if found:
+        await msg.reply_text("هل تقصد إحدى هذه الخدمات؟ اختر من الأزرار:", reply_markup=make_reply_kb([[w] for w in found]))
+        return
     await msg.reply_text("لم أفهم. استخدم الأزرار أو اكتب /start للعودة للقائمة.", reply_markup=MAIN_KB)
     # Do not allow clients to select a worker by typing the worker code.
     # The worker code is private and shown only to the worker (after registration).
@@ -897,6 +830,80 @@ async def handle_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await msg.reply_text("لأسباب تتعلق بالخصوصية، لا يمكن اختيار الحرفي بإدخال رمز العامل.\nالرجاء استخدام زر 'اختيار هذا الحرفي' الموجود في بطاقة الحرفي.")
         return
 
+def fetch_nearby_workers(service, lat, lon, keyword=None):
+    """Best result_pages.MAX_RESULTS workers of `service` within CLIENT_MAX_KM, optionally matching `keyword`."""
+    conn = db.connect(DB_PATH)
+    try:
+        # select matching workers inside the grid cells / bounding box around the client;
+        # workers without lat/lon have no geo_cell and never match
+        geo_sql, geo_params = geo.bbox_sql(lat, lon, CLIENT_MAX_KM)
+        sql = "SELECT user_id,name,phone,work_type,lat,lon,worker_code,subscription_level,subscription_expiry,avg_rating FROM workers WHERE work_type=? AND " + geo_sql
+        params = [service] + geo_params
+        kw_sql, kw_params = worker_search.filter_sql(keyword) if keyword else ("", [])
+        if kw_sql:
+            # names/specialisations through the FTS index (schema migration 12)
+            sql += " AND " + kw_sql
+            params += kw_params
+        rows = conn.execute(sql, params).fetchall()
+    finally:
+        conn.close()
+    # score all rows in one batched pass: keeps the best MAX_RESULTS workers within range,
+    # sorted by level (higher first), then distance (lower first)
+    ranked = scoring.rank(lat, lon, [r[4] for r in rows], [r[5] for r in rows], [r[7] for r in rows], CLIENT_MAX_KM, k=result_pages.MAX_RESULTS)
+    candidates = []
+    for i, dist, level in ranked:
+        uid, name, phone, work_type, wlat, wlon, wcode, _level, expiry, avg_rating = rows[i]
+        candidates.append((level, dist, uid, name, phone, work_type, wcode, avg_rating))
+    return candidates
+
+
+async def send_worker_page(msg, search_key, page_no):
+    """Send one page of a cached nearest-worker result, with a "more" button if pages remain."""
+    found = result_pages.page(search_key, page_no)
+    if found is None:
+        await msg.reply_text("انتهت صلاحية نتائج هذا البحث. أرسل موقعك من جديد لعرض الحرفيين.")
+        return
+    chunk, start, total, has_more, _ = found
+    # increment appearance_count for the workers on this page (buffered, one batch write)
+    counters.add_many("appearance_count", [c[2] for c in chunk])
+    conn = db.connect(DB_PATH)
+    try:
+        for level, dist, uid, name, phone, work_type, wcode, avg_rating in chunk:
+            # show golden star when subscription_level == 1
+            star = " ⭐️" if int(level if level is not None else -1) == 1 else ""
+            # fetch specialty fields if present
+            spec_parts = []
+            try:
+                cur2 = conn.cursor()
+                cur2.execute("SELECT vehicle_type, education_specialization, floor_type FROM workers WHERE user_id=?", (uid,))
+                rp = cur2.fetchone()
+                if rp:
+                    vehicle_type, edu_specialty, floor_type = rp
+                    if vehicle_type:
+                        spec_parts.append(f"نوع السيارة: {vehicle_type}")
+                    if edu_specialty:
+                        spec_parts.append(f"تخصص دراسي: {edu_specialty}")
+                    if floor_type:
+                        spec_parts.append(f"نوع الأرضيات: {floor_type}")
+            except Exception:
+                pass
+            spec_text = ("\n" + "\n".join(spec_parts)) if spec_parts else ""
+            # include average rating in the profile box
+            avg_text = f"{(float(avg_rating) if avg_rating is not None else 0):.1f}" if avg_rating is not None else "-"
+            box = f"الاسم:{star} {name or '-'}\nالهاتف: {phone or '-'}\nالعمل: {work_type}{spec_text}\nمتوسط التقييم: {avg_text}\nالمسافة: {dist:.2f} كم"
+            # attach selection and rating buttons
+            rate_kb = InlineKeyboardMarkup([
+                [InlineKeyboardButton("اختيار هذا الحرفي", callback_data=f"select:{wcode}")],
+                [InlineKeyboardButton("⭐ 1", callback_data=f"rate:{wcode}:1"), InlineKeyboardButton("⭐ 2", callback_data=f"rate:{wcode}:2"), InlineKeyboardButton("⭐ 3", callback_data=f"rate:{wcode}:3")],
+                [InlineKeyboardButton("⭐ 4", callback_data=f"rate:{wcode}:4"), InlineKeyboardButton("⭐ 5", callback_data=f"rate:{wcode}:5")]
+            ])
+            await msg.reply_text(box, reply_markup=rate_kb)
+    finally:
+        conn.close()
+    if has_more:
+        more_kb = InlineKeyboardMarkup([[InlineKeyboardButton("المزيد", callback_data=f"more:{search_key}:{page_no + 1}")]])
+        await msg.reply_text(f"عرض {start + 1}-{start + len(chunk)} من {total} حرفي داخل 40 كم.", reply_markup=more_kb)
+
 async def handle_location(update: Update, context: ContextTypes.DEFAULT_TYPE):
     msg = update.message
     if not msg or not msg.location:
@@ -911,7 +918,7 @@ async def handle_location(update: Update, context: ContextTypes.DEFAULT_TYPE):
         save_worker_to_db(user_id, st)
         # fetch assigned worker_code to show to the user
         try:
-            conn = sqlite3.connect(DB_PATH)
+            conn = db.connect(DB_PATH)
             cur = conn.cursor()
             cur.execute("SELECT worker_code FROM workers WHERE user_id=?", (user_id,))
             r = cur.fetchone()
@@ -931,98 +938,53 @@ async def handle_location(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Client sending location to find nearest workers
     if st and st.get("role") == "client" and st.get("step") in ("categories", "services", "awaiting_location"):
         service = st.get("service")
-        conn = sqlite3.connect(DB_PATH)
-        cur = conn.cursor()
-        # select workers with non-null lat/lon and matching work_type
-        cur.execute("SELECT user_id,name,phone,work_type,lat,lon,worker_code,subscription_level,subscription_expiry,avg_rating FROM workers WHERE lat IS NOT NULL AND lon IS NOT NULL AND work_type=?", (service,))
-        rows = cur.fetchall()
-        candidates = []
-        now = datetime.datetime.utcnow()
-        for r in rows:
-            uid, name, phone, work_type, wlat, wlon, wcode, level, expiry, avg_rating = r
-            # skip if no location
-            if wlat is None or wlon is None:
-                continue
-                # skip if no active subscription: require subscription_level not None and expiry present
-                try:
-                    if level is None or not expiry:
-                        continue
-                    # parse expiry
-                    exp_dt = datetime.datetime.fromisoformat(expiry)
-                    if exp_dt <= now:
-                        # expired -> do not show
-                        continue
-                except Exception:
-                    # if parsing fails, skip this worker
-                    continue
-            dist = haversine(lat, lon, wlat, wlon)
-            # store as (level, dist, ...)
-            candidates.append((level or 0, dist, uid, name, phone, work_type, wcode, avg_rating))
-        # only keep workers within 40 km
-        candidates = [c for c in candidates if c[1] <= 40.0]
-        # sort by level (higher first), then distance (lower first)
-        candidates.sort(key=lambda x: (-int(x[0] or 0), x[1]))
+        candidates = fetch_nearby_workers(service, lat, lon)
         if not candidates:
             await msg.reply_text("عذراً، لا يوجد حرفيون مسجلون لهذه الخدمة ضمن نطاق 40 كم من موقعك.")
-            conn.close(); return
-        # increment appearance_count for shown workers
-        for level, dist, uid, name, phone, work_type, wcode, avg_rating in candidates:
-            try:
-                cur.execute("UPDATE workers SET appearance_count = COALESCE(appearance_count,0)+1 WHERE user_id=?", (uid,))
-            except Exception:
-                pass
-        conn.commit()
-        # reply with each worker in its own box; cap to avoid huge messages
-        MAX_SHOW = 50
-        to_show = candidates[:MAX_SHOW]
-        for level, dist, uid, name, phone, work_type, wcode, avg_rating in to_show:
-            # show golden star when subscription_level == 1
-            star = " ⭐️" if int(level if level is not None else -1) == 1 else ""
-            # fetch specialty fields if present
-            spec_parts = []
-            try:
-                cur2 = conn.cursor()
-                cur2.execute("SELECT vehicle_type, edu_specialty, floor_type FROM workers WHERE user_id=?", (uid,))
-                rp = cur2.fetchone()
-                if rp:
-                    vehicle_type, edu_specialty, floor_type = rp
-                    if vehicle_type:
-                        spec_parts.append(f"نوع السيارة: {vehicle_type}")
-                    if edu_specialty:
-                        spec_parts.append(f"تخصص دراسي: {edu_specialty}")
-                    if floor_type:
-                        spec_parts.append(f"نوع الأرضيات: {floor_type}")
-            except Exception:
-                pass
-            spec_text = ("\n" + "\n".join(spec_parts)) if spec_parts else ""
-            # include average rating in the profile box
-            avg_text = f"{(float(avg_rating) if avg_rating is not None else 0):.1f}" if avg_rating is not None else "-"
-            box = f"الاسم:{star} {name or '-'}\nالهاتف: {phone or '-'}\nالعمل: {work_type}{spec_text}\nمتوسط التقييم: {avg_text}\nالمسافة: {dist:.2f} كم"
-            # attach selection and rating buttons
-            rate_kb = InlineKeyboardMarkup([
-                [InlineKeyboardButton("اختيار هذا الحرفي", callback_data=f"select:{wcode}")],
-                [InlineKeyboardButton("⭐ 1", callback_data=f"rate:{wcode}:1"), InlineKeyboardButton("⭐ 2", callback_data=f"rate:{wcode}:2"), InlineKeyboardButton("⭐ 3", callback_data=f"rate:{wcode}:3")],
-                [InlineKeyboardButton("⭐ 4", callback_data=f"rate:{wcode}:4"), InlineKeyboardButton("⭐ 5", callback_data=f"rate:{wcode}:5")]
-            ])
-            await msg.reply_text(box, reply_markup=rate_kb)
-        # if too many, tell user we truncated
-        if len(candidates) > MAX_SHOW:
-            await msg.reply_text(f"\nوتم عرض {MAX_SHOW} من أصل {len(candidates)} حرفيين داخل 40 كم.")
-        # set client state to allow selection by button (choose_worker)
+            return
+        # cache the ranked result and send the first page; "more" serves the rest from the cache
+        search_key = f"{user_id}-{msg.message_id}"
+        result_pages.put(search_key, candidates)
+        await send_worker_page(msg, search_key, 0)
+        # set client state to allow selection by button (choose_worker); a typed word narrows the results
         st["step"] = "choose_worker"
+        st["lat"] = lat; st["lon"] = lon; st["search_key"] = search_key
         user_states[user_id] = st
-        conn.close()
         return
         
     # otherwise ignore
     await msg.reply_text("لاستخدام الموقع: اختر خدمة ثم أرسل الموقع عبر الزر.")
 
+async def _post_init(application):
+    try:
+        coupon_guard.load(DB_PATH)
+    except Exception:
+        logging.exception("Could not load coupon guard; every code will be checked in the DB")
+    try:
+        user_states.load()
+    except Exception:
+        logging.exception("Could not restore conversation states; everyone starts over")
+    # flush buffered counters and conversation states in the background while the bot runs
+    application.bot_data["counter_flusher"] = asyncio.create_task(counters.run_flusher(DB_PATH))
+    application.bot_data["state_flusher"] = asyncio.create_task(user_states.run_flusher())
+
+
+async def _post_shutdown(application):
+    for name in ("counter_flusher", "state_flusher"):
+        task = application.bot_data.pop(name, None)
+        if task:
+            task.cancel()
+    counters.flush(DB_PATH)
+    user_states.flush()
+
+
 def main():
     init_db()
     if not TOKEN:
         logging.info("BOT_TOKEN missing; exiting main without starting bot.")
         return
-    app = Application.builder().token(TOKEN).build()
+    app = (Application.builder().token(TOKEN).rate_limiter(outbound.OutboundScheduler())
+           .post_init(_post_init).post_shutdown(_post_shutdown).build())
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("redeem", redeem_cmd))
     # conf_cmd will be registered later after its definition to avoid NameError
@@ -1036,7 +998,11 @@ def main():
     app.add_handler(MessageHandler(filters.LOCATION, handle_location))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_buttons))
     logging.info("Starting khidmati_fixed bot")
-    app.run_polling()
+    try:
+        app.run_polling()
+    finally:
+        counters.flush(DB_PATH)
+        db.close_all()
 
 
 async def conf_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1048,7 +1014,7 @@ async def conf_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("أمر محصور للمشرف فقط.")
         return
     logging.info(f"/conf invoked by admin user_id={uid}")
-    conn = sqlite3.connect(DB_PATH)
+    conn = db.connect(DB_PATH)
     cur = conn.cursor()
     cur.execute("SELECT user_id, name, phone, work_type, subscription_level, subscription_expiry FROM workers ORDER BY id")
     rows = cur.fetchall()
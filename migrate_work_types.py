@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 """Migrate workers.work_type values to canonical emoji-labeled names.
-This script imports khidmati (to reuse normalize_label and WORK_TYPES_NORMALIZED)
+This script imports khidmati (to reuse resolve_service and its label index)
 and updates rows in data.db. It creates a timestamped backup before modifying.
 """
 import os
@@ -33,8 +33,7 @@ for wt in rows:
     # if it's already a canonical entry (exact match), skip
     if wt in khidmati.WORK_TYPES:
         continue
-    norm = khidmati.normalize_label(wt)
-    canonical = khidmati.WORK_TYPES_NORMALIZED.get(norm) or khidmati.WORK_TYPES_NORMALIZED.get(khidmati.strip_definite_article(norm))
+    canonical = khidmati.resolve_service(wt)
     if canonical and canonical != wt:
         print(f"Updating: '{wt}' -> '{canonical}'")
         cur.execute("UPDATE workers SET work_type=? WHERE work_type=?", (canonical, wt))
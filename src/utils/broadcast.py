@@ -0,0 +1,260 @@
+"""Persisted, resumable broadcast jobs for the admin "sta" flow.
+
+A broadcast is one row in broadcast_jobs (schema migration 8). The admin's
+handler only inserts the job and returns; run_worker() -- a background task
+started in post_init -- delivers it:
+
+- recipients are read page by page with keyset pagination on workers.user_id
+  (never all ids in memory); after every page the job's cursor and counters are
+  committed, so a restart resumes where it stopped (at most one page is sent
+  twice);
+- every Telegram call takes a token from a bucket refilled at BROADCAST_RATE
+  per second, kept under Telegram's global ~30 msg/s limit, and is marked
+  bulk so the outbound scheduler (src/utils/outbound.py) lets interactive
+  replies go first;
+- RetryAfter pauses the whole bucket for the requested time and the message is
+  retried; timeouts/network errors are retried with exponential backoff up to
+  BROADCAST_MAX_RETRIES times; Forbidden/BadRequest (blocked bot, deleted
+  chat) are counted as failed at once and such chats are recorded by
+  src/utils/reachability.py, which the recipient queries skip;
+- the admin's progress message is edited at most every BROADCAST_PROGRESS_SECONDS.
+"""
+import os
+import time
+import asyncio
+import logging
+from datetime import timedelta
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import RetryAfter, Forbidden, BadRequest, TimedOut, NetworkError
+
+from src.utils import db, reachability
+from src.utils.outbound import BULK
+
+# messages per second for broadcasts; interactive replies use the rest of the ~30/s budget
+RATE = float(os.getenv("BROADCAST_RATE", "25"))
+PAGE_SIZE = int(os.getenv("BROADCAST_PAGE_SIZE", "50"))
+MAX_RETRIES = int(os.getenv("BROADCAST_MAX_RETRIES", "3"))
+PROGRESS_SECONDS = float(os.getenv("BROADCAST_PROGRESS_SECONDS", "5"))
+
+HEADER = "رسالة من خدمتي ليبيا:"
+
+# audience -> keyset query over distinct recipient chat ids
+_AUDIENCES = {
+    "workers": ("SELECT COUNT(*) FROM workers w WHERE user_id IS NOT NULL "
+                "AND NOT EXISTS (SELECT 1 FROM unreachable_chats u WHERE u.chat_id = w.user_id)",
+                "SELECT user_id FROM workers w WHERE user_id > ? "
+                "AND NOT EXISTS (SELECT 1 FROM unreachable_chats u WHERE u.chat_id = w.user_id) ORDER BY user_id LIMIT ?"),
+}
+
+_JOB_COLUMNS = ("id", "kind", "text", "from_chat_id", "message_id", "audience", "status", "cursor",
+                "total", "sent", "failed", "admin_chat_id", "progress_message_id")
+
+_wake = None
+_cancelled = set()
+
+
+class TokenBucket:
+    """Async token bucket; pause() blocks every taker (used for RetryAfter)."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+# ---------- job rows (blocking; run through db_executor) ----------
+
+def create_job(path, admin_chat_id, progress_message_id, text=None, from_chat_id=None, message_id=None, audience="workers"):
+    """Insert a job. kind is 'copy' when a message to copy is given, else 'text'. Returns (job_id, total)."""
+    kind = "copy" if message_id else "text"
+    with db.transaction(path) as conn:
+        total = conn.execute(_AUDIENCES[audience][0]).fetchone()[0]
+        cur = conn.execute(
+            "INSERT INTO broadcast_jobs (kind, text, from_chat_id, message_id, audience, total, admin_chat_id, progress_message_id) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (kind, text, from_chat_id, message_id, audience, total, admin_chat_id, progress_message_id))
+    return cur.lastrowid, total
+
+
+def next_job(path):
+    """Oldest unfinished job as a dict, or None."""
+    row = db.get_conn(path).execute(
+        f"SELECT {', '.join(_JOB_COLUMNS)} FROM broadcast_jobs WHERE status = 'running' ORDER BY id LIMIT 1").fetchone()
+    return dict(zip(_JOB_COLUMNS, row)) if row else None
+
+
+def recipients_page(path, audience, cursor, limit=PAGE_SIZE):
+    return [r[0] for r in db.get_conn(path).execute(_AUDIENCES[audience][1], (cursor, limit))]
+
+
+def save_progress(path, job_id, cursor, sent, failed, status="running"):
+    with db.transaction(path) as conn:
+        conn.execute(
+            "UPDATE broadcast_jobs SET cursor = ?, sent = ?, failed = ?, status = ?, updated_at = CURRENT_TIMESTAMP, "
+            "finished_at = CASE WHEN ? != 'running' THEN CURRENT_TIMESTAMP END WHERE id = ? AND status = 'running'",
+            (cursor, sent, failed, status, status, job_id))
+
+
+def cancel(path, job_id):
+    """Stop a running job (the worker notices before its next page)."""
+    _cancelled.add(job_id)
+    with db.transaction(path) as conn:
+        cur = conn.execute("UPDATE broadcast_jobs SET status = 'cancelled', finished_at = CURRENT_TIMESTAMP "
+                           "WHERE id = ? AND status = 'running'", (job_id,))
+    return cur.rowcount == 1
+
+
+def notify():
+    """Wake the worker after a job was created."""
+    if _wake is not None:
+        _wake.set()
+
+
+# ---------- delivery ----------
+
+def _retry_seconds(err):
+    ra = err.retry_after
+    return ra.total_seconds() if isinstance(ra, timedelta) else float(ra)
+
+
+async def _call(bucket, fn, *args, **kwargs):
+    """One Telegram call through the bucket. Returns True, or False once retries are used up.
+
+    Forbidden/BadRequest are raised to the caller: retrying cannot help.
+    """
+    attempt = 0
+    while True:
+        await bucket.acquire()
+        try:
+            await fn(*args, **kwargs)
+            return True
+        except RetryAfter as e:
+            # flood control applies to the whole bot: stop everyone, then retry this message
+            wait = _retry_seconds(e) + 0.5
+            logging.warning("broadcast: RetryAfter %.1fs", wait)
+            bucket.pause(wait)
+        except (Forbidden, BadRequest):
+            raise
+        except (TimedOut, NetworkError) as e:
+            attempt += 1
+            if attempt > MAX_RETRIES:
+                logging.info("broadcast: giving up after %d retries: %s", MAX_RETRIES, e)
+                return False
+            await asyncio.sleep(2 ** (attempt - 1))
+
+
+async def _deliver(bot, bucket, job, chat_id, path):
+    try:
+        if job["kind"] == "copy":
+            ok = (await _call(bucket, bot.send_message, chat_id, HEADER, rate_limit_args=BULK)
+                  and await _call(bucket, bot.copy_message, chat_id=chat_id, from_chat_id=job["from_chat_id"],
+                                  message_id=job["message_id"], rate_limit_args=BULK))
+        else:
+            ok = await _call(bucket, bot.send_message, chat_id, f"{HEADER}\n\n{job['text']}", rate_limit_args=BULK)
+    except (Forbidden, BadRequest) as e:
+        logging.debug("broadcast: permanent failure for %s: %s", chat_id, e)
+        await reachability.note_failure(chat_id, e, path)
+        return False
+    reachability.count("delivered" if ok else "failed")
+    return ok
+
+
+def progress_text(job):
+    processed = job["sent"] + job["failed"]
+    head = {"done": "انتهى الإرسال", "cancelled": "أُلغي الإرسال"}.get(job["status"], "جارٍ الإرسال")
+    return f"{head} (مهمة #{job['id']}): {processed}/{job['total'] or 0}\nتم: {job['sent']} | فشل: {job['failed']}"
+
+
+def cancel_keyboard(job_id):
+    return InlineKeyboardMarkup([[InlineKeyboardButton("إيقاف الإرسال", callback_data=f"bc_cancel:{job_id}")]])
+
+
+async def _show_progress(bot, job):
+    if not job["admin_chat_id"] or not job["progress_message_id"]:
+        return
+    try:
+        await bot.edit_message_text(progress_text(job), chat_id=job["admin_chat_id"], message_id=job["progress_message_id"],
+                                    reply_markup=cancel_keyboard(job["id"]) if job["status"] == "running" else None)
+    except RetryAfter as e:
+        logging.debug("progress edit throttled for %.1fs", _retry_seconds(e))
+    except Exception:
+        # "message is not modified" and friends: progress is best effort
+        logging.debug("progress edit failed for job %s", job["id"])
+
+
+async def run_job(bot, path, job, bucket):
+    from src.utils import db_executor
+    last_shown = 0.0
+    while True:
+        if job["id"] in _cancelled:
+            job["status"] = "cancelled"
+            break
+        page = await db_executor.run_read(recipients_page, path, job["audience"], job["cursor"])
+        if not page:
+            job["status"] = "done"
+            break
+        results = await asyncio.gather(*(_deliver(bot, bucket, job, chat_id, path) for chat_id in page), return_exceptions=True)
+        for chat_id, ok in zip(page, results):
+            if ok is True:
+                job["sent"] += 1
+            else:
+                if isinstance(ok, Exception):
+                    logging.warning("broadcast to %s raised %r", chat_id, ok)
+                job["failed"] += 1
+        job["cursor"] = page[-1]
+        await db_executor.run_write(save_progress, path, job["id"], job["cursor"], job["sent"], job["failed"])
+        if time.monotonic() - last_shown >= PROGRESS_SECONDS:
+            await _show_progress(bot, job)
+            last_shown = time.monotonic()
+    if job["status"] == "done":
+        await db_executor.run_write(save_progress, path, job["id"], job["cursor"], job["sent"], job["failed"], "done")
+    _cancelled.discard(job["id"])
+    logging.info("broadcast job %s %s: sent %d, failed %d", job["id"], job["status"], job["sent"], job["failed"])
+    await _show_progress(bot, job)
+
+
+async def run_worker(bot, path=None, idle=30.0):
+    """Background task: deliver unfinished jobs one at a time, oldest first (resumes after restart)."""
+    global _wake
+    from src.utils import db_executor
+    _wake = asyncio.Event()
+    bucket = TokenBucket(RATE)
+    while True:
+        try:
+            job = await db_executor.run_read(next_job, path)
+            if job is not None:
+                await run_job(bot, path, job, bucket)
+                continue
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logging.exception("broadcast worker failed; retrying shortly")
+            await asyncio.sleep(5)
+            continue
+        _wake.clear()
+        try:
+            await asyncio.wait_for(_wake.wait(), idle)
+        except asyncio.TimeoutError:
+            pass
@@ -0,0 +1,110 @@
+"""Write-behind buffer for the per-worker counters (appearance/selection/ratings).
+
+Showing 50 workers used to cost 50 UPDATE+COMMIT round trips. Increments are
+now merged in memory per (column, worker) and written in one executemany
+transaction, either every FLUSH_INTERVAL seconds or as soon as FLUSH_MAX_PENDING
+distinct workers are waiting. Call flush() on shutdown so nothing is lost.
+
+Readers that display counters should add pending_for(user_id) to the stored
+values so buffered increments are visible before they reach the database.
+"""
+import os
+import time
+import asyncio
+import logging
+import threading
+
+from src.utils import db
+
+FLUSH_INTERVAL = float(os.getenv("COUNTER_FLUSH_INTERVAL", "5"))
+FLUSH_MAX_PENDING = int(os.getenv("COUNTER_FLUSH_MAX_PENDING", "500"))
+
+# both bots use selected_count since schema migration 4 (khidmati.py's selection_count is retired)
+COLUMNS = {"appearance_count", "selected_count", "ratings_received"}
+
+_pending = {}  # column -> {worker_user_id: delta}
+_lock = threading.Lock()
+
+
+def _size():
+    return sum(len(d) for d in _pending.values())
+
+
+def add(column, worker_user_id, by=1):
+    """Buffer an increment. Returns True once the buffer has reached its size limit."""
+    if column not in COLUMNS:
+        raise ValueError(f"unknown counter column: {column}")
+    if worker_user_id is None or not by:
+        return False
+    with _lock:
+        col = _pending.setdefault(column, {})
+        col[worker_user_id] = col.get(worker_user_id, 0) + by
+        return _size() >= FLUSH_MAX_PENDING
+
+
+def add_many(column, worker_user_ids, by=1):
+    """Buffer the same increment for several workers (e.g. every worker shown in one search)."""
+    if column not in COLUMNS:
+        raise ValueError(f"unknown counter column: {column}")
+    with _lock:
+        col = _pending.setdefault(column, {})
+        for uid in worker_user_ids:
+            if uid is not None:
+                col[uid] = col.get(uid, 0) + by
+        return _size() >= FLUSH_MAX_PENDING
+
+
+def pending_for(worker_user_id):
+    """Return {column: delta} not yet written for this worker."""
+    with _lock:
+        return {c: d[worker_user_id] for c, d in _pending.items() if worker_user_id in d}
+
+
+def pending_count():
+    with _lock:
+        return _size()
+
+
+def flush(path=None):
+    """Write all buffered increments in one transaction. Returns the number of rows updated."""
+    global _pending
+    with _lock:
+        batch, _pending = _pending, {}
+    if not batch:
+        return 0
+    written = 0
+    try:
+        with db.transaction(path) as conn:
+            for column, deltas in batch.items():
+                if not deltas:
+                    continue
+                conn.executemany(f"UPDATE workers SET {column} = COALESCE({column},0) + ? WHERE user_id = ?",
+                                 [(delta, uid) for uid, delta in deltas.items()])
+                written += len(deltas)
+    except Exception:
+        logging.exception("counter flush failed; keeping %d pending increments", sum(len(d) for d in batch.values()))
+        # put the batch back (merging with anything buffered meanwhile) so a later flush retries it
+        with _lock:
+            for column, deltas in batch.items():
+                col = _pending.setdefault(column, {})
+                for uid, delta in deltas.items():
+                    col[uid] = col.get(uid, 0) + delta
+        return 0
+    logging.debug("flushed %d buffered counter rows", written)
+    return written
+
+
+async def run_flusher(path=None, interval=FLUSH_INTERVAL, tick=0.25):
+    """Background task: flush on the interval, or early when the buffer is full."""
+    from src.utils import db_executor
+    last = time.monotonic()
+    while True:
+        await asyncio.sleep(tick)
+        if pending_count() and (time.monotonic() - last >= interval or pending_count() >= FLUSH_MAX_PENDING):
+            try:
+                await db_executor.run_write(flush, path)
+            except Exception:
+                logging.exception("background counter flush failed")
+            last = time.monotonic()
+        elif not pending_count():
+            last = time.monotonic()
@@ -0,0 +1,182 @@
+"""In-memory pre-check for coupon codes plus a per-user attempt limiter.
+
+Every unused coupon's code_norm (see src/utils/coupons.py) is kept as a 64-bit
+hash in a sorted array('Q'): 8 bytes per code, an exact membership test by
+bisect, and cheap removal when a coupon is redeemed. A typed code none of
+whose candidate spellings is in the array cannot be redeemed, so it is refused
+without touching SQLite.
+
+Coupons are generated by a separate process (generate_coupons.py), so a miss
+first pulls coupons with an id above the last one seen -- at most once every
+SYNC_MIN_SECONDS, so a guessing storm costs one tiny indexed query per
+interval. The whole array is rebuilt every REBUILD_SECONDS to pick up
+anything changed by hand in the database.
+
+The limiter counts failed redemptions per user: after MAX_FAILURES within
+WINDOW_SECONDS the user is refused until the oldest failure ages out.
+"""
+import os
+import time
+import bisect
+import hashlib
+import logging
+import threading
+from array import array
+from collections import deque
+
+from src.utils import db
+
+SYNC_MIN_SECONDS = float(os.getenv("COUPON_SYNC_MIN_SECONDS", "5"))
+REBUILD_SECONDS = float(os.getenv("COUPON_REBUILD_SECONDS", "3600"))
+MAX_FAILURES = int(os.getenv("COUPON_MAX_FAILURES", "5"))
+WINDOW_SECONDS = float(os.getenv("COUPON_FAILURE_WINDOW", "600"))
+
+_lock = threading.Lock()
+_hashes = array("Q")
+_path = None
+_last_id = 0
+_synced_at = 0.0
+_built_at = 0.0
+# user_id -> deque of failure timestamps (monotonic)
+_failures = {}
+_stats = {"rejected": 0, "passed": 0, "syncs": 0, "limited": 0}
+ready = False
+
+
+def _h(norm):
+    return int.from_bytes(hashlib.blake2b(norm.encode(), digest_size=8).digest(), "big")
+
+
+def _contains(h):
+    i = bisect.bisect_left(_hashes, h)
+    return i < len(_hashes) and _hashes[i] == h
+
+
+def load(path=None):
+    """(Re)build the array from every unused coupon in `path`."""
+    global _hashes, _path, _last_id, _synced_at, _built_at, ready
+    conn = db.connect(path)
+    try:
+        rows = conn.execute("SELECT id, code_norm FROM coupons WHERE used = 0 AND code_norm IS NOT NULL").fetchall()
+        last_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM coupons").fetchone()[0]
+    finally:
+        conn.close()
+    hashes = array("Q", sorted({_h(norm) for _, norm in rows}))
+    now = time.monotonic()
+    with _lock:
+        _hashes, _path, _last_id = hashes, os.path.abspath(path or db.DEFAULT_DB_PATH), last_id
+        _synced_at = _built_at = now
+        ready = True
+    logging.info("coupon guard loaded: %d unused codes", len(hashes))
+    return len(hashes)
+
+
+def sync(path=None):
+    """Add coupons created since the last load/sync (or rebuild when due)."""
+    global _last_id, _synced_at
+    if time.monotonic() - _built_at > REBUILD_SECONDS:
+        return load(path)
+    conn = db.connect(path)
+    try:
+        rows = conn.execute("SELECT id, code_norm, used FROM coupons WHERE id > ? ORDER BY id", (_last_id,)).fetchall()
+    finally:
+        conn.close()
+    with _lock:
+        for cid, norm, used in rows:
+            if norm and not used:
+                h = _h(norm)
+                if not _contains(h):
+                    bisect.insort(_hashes, h)
+            _last_id = max(_last_id, cid)
+        _synced_at = time.monotonic()
+        _stats["syncs"] += 1
+    return len(rows)
+
+
+def _applies(path):
+    return ready and os.path.abspath(path or db.DEFAULT_DB_PATH) == _path
+
+
+def may_exist(cands, path=None):
+    """False only if none of the normalised candidate spellings can be an unused coupon."""
+    if not _applies(path):
+        return True
+    with _lock:
+        found = any(_contains(_h(c)) for c in cands)
+        stale = time.monotonic() - _synced_at >= SYNC_MIN_SECONDS
+    if not found and stale:
+        try:
+            sync(path)
+        except Exception:
+            logging.exception("coupon guard sync failed")
+            return True
+        with _lock:
+            found = any(_contains(_h(c)) for c in cands)
+    with _lock:
+        _stats["passed" if found else "rejected"] += 1
+    return found
+
+
+def add(norms, path=None):
+    """Make freshly inserted coupons known to this process."""
+    if not _applies(path):
+        return
+    with _lock:
+        for norm in norms:
+            h = _h(norm)
+            if not _contains(h):
+                bisect.insort(_hashes, h)
+
+
+def discard(norm, path=None):
+    """Forget a redeemed coupon."""
+    if not _applies(path) or not norm:
+        return
+    with _lock:
+        h = _h(norm)
+        i = bisect.bisect_left(_hashes, h)
+        if i < len(_hashes) and _hashes[i] == h:
+            del _hashes[i]
+
+
+def retry_after(user_id):
+    """Seconds the user must wait before trying another code (0 if allowed)."""
+    if user_id is None:
+        return 0
+    now = time.monotonic()
+    with _lock:
+        q = _failures.get(user_id)
+        if not q:
+            return 0
+        while q and now - q[0] >= WINDOW_SECONDS:
+            q.popleft()
+        if not q:
+            _failures.pop(user_id, None)
+            return 0
+        if len(q) < MAX_FAILURES:
+            return 0
+        _stats["limited"] += 1
+        return int(WINDOW_SECONDS - (now - q[0])) + 1
+
+
+def record_failure(user_id):
+    if user_id is None:
+        return
+    now = time.monotonic()
+    with _lock:
+        if len(_failures) > 10000:
+            # drop users whose latest failure has aged out
+            for uid in [u for u, q in _failures.items() if now - q[-1] >= WINDOW_SECONDS]:
+                del _failures[uid]
+        q = _failures.setdefault(user_id, deque(maxlen=MAX_FAILURES))
+        q.append(now)
+
+
+def record_success(user_id):
+    with _lock:
+        _failures.pop(user_id, None)
+
+
+def stats():
+    with _lock:
+        return dict(_stats, size=len(_hashes), limited_users=sum(1 for q in _failures.values() if len(q) >= MAX_FAILURES))
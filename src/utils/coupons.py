@@ -0,0 +1,138 @@
+"""Coupon lookup and redemption shared by bot.py and khidmati.py.
+
+Every coupon has `code_norm`: the code upper-cased with everything but A-Z/0-9
+removed (Arabic-Indic digits are read as 0-9). It has its own unique index, so
+a user's spelling ("vip-100 ab12", "VIP100AB12", ...) is matched with one
+indexed lookup of a few normalised candidates instead of UPPER(code) scans.
+
+redeem() claims a coupon with a single conditional
+``UPDATE coupons SET used=1 ... WHERE id=? AND used=0`` and updates the worker
+in the same IMMEDIATE transaction: when many users race for one code, exactly
+one UPDATE matches a row and everyone else is told the code is used.
+
+Before any of that, src/utils/coupon_guard.py refuses codes that cannot be an
+unused coupon without a database round trip, and stops users who keep
+guessing (MAX_FAILURES wrong codes within WINDOW_SECONDS).
+"""
+import re
+import logging
+from datetime import datetime, timedelta
+
+from src.utils import db, coupon_guard
+
+_ARABIC_DIGIT_CHARS = "٠١٢٣٤٥٦٧٨٩۰۱۲۳۴۵۶۷۸۹"
+_ARABIC_DIGITS = str.maketrans(_ARABIC_DIGIT_CHARS, "0123456789" * 2)
+_NOT_CODE = re.compile(r"[^0-9A-Z]")
+# separators sql_strip_code() strips; anything else outside A-Z/0-9 has no SQL equivalent
+_SQL_SEPARATORS = "-_ ./,:#\t\r\n"
+
+MSG_NOT_FOUND = "الكود غير موجود أو غير صالح."
+MSG_USED = "هذا الكود مُستخدم مسبقاً."
+MSG_INVALID = "كود غير صالح."
+MSG_UNAVAILABLE = "الكود غير صالح أو مُستخدم مسبقاً."
+MSG_TOO_MANY = "محاولات خاطئة كثيرة. حاول مرة أخرى بعد {minutes} دقيقة."
+
+
+def normalize(code):
+    """Return the code_norm form of a coupon code ('' for empty input)."""
+    return _NOT_CODE.sub("", str(code or "").translate(_ARABIC_DIGITS).upper())
+
+
+def sql_fold_digits(expr):
+    """SQL expression for `expr` with Arabic-Indic digits read as 0-9 (first half of normalize())."""
+    for src, dst in zip(_ARABIC_DIGIT_CHARS, "0123456789" * 2):
+        expr = f"replace({expr}, char({ord(src)}), '{dst}')"
+    return expr
+
+
+def sql_strip_code(expr):
+    """SQL expression for `expr` upper-cased without separators (second half of normalize()).
+
+    SQLite has no regex replace, so only _SQL_SEPARATORS are removed; callers
+    check the result with ``GLOB '*[^A-Z0-9]*'``. The two halves are separate
+    expressions because nesting all the replace() calls overflows SQLite's parser.
+    """
+    for ch in _SQL_SEPARATORS:
+        expr = f"replace({expr}, char({ord(ch)}), '')"
+    return f"upper({expr})"
+
+
+def candidates(code_input):
+    """Normalised spellings to try, most exact first: as typed, without leading zeros, with the VIP prefix."""
+    norm = normalize(code_input)
+    out = []
+    for cand in (norm, norm.lstrip("0")):
+        for c in (cand, cand if cand.startswith("VIP") else "VIP" + cand):
+            if c and c != "VIP" and c not in out:
+                out.append(c)
+    return out
+
+
+def find(conn, code_input):
+    """Return (id, amount, used, code) of the coupon matching the input, or None."""
+    cands = candidates(code_input)
+    if not cands:
+        return None
+    rows = conn.execute(f"SELECT id, amount, used, code, code_norm FROM coupons WHERE code_norm IN ({','.join('?' * len(cands))})",
+                        cands).fetchall()
+    if not rows:
+        return None
+    by_norm = {r[4]: r[:4] for r in rows}
+    for c in cands:
+        if c in by_norm:
+            return by_norm[c]
+    return None
+
+
+def claim(conn, coupon_id, worker_user_id, used_at):
+    """Mark an unused coupon as used. Returns False if someone else claimed it first."""
+    cur = conn.execute("UPDATE coupons SET used=1, used_by_worker_user_id=?, used_at=? WHERE id=? AND used=0",
+                       (worker_user_id, used_at, coupon_id))
+    return cur.rowcount == 1
+
+
+def redeem(code_input, worker_user_id, plan, path=None, update_worker=True, requested_by=None):
+    """Claim a coupon for a worker and (optionally) apply the subscription, all in one transaction.
+
+    `plan(amount)` returns (level, days, tier_name) for an acceptable coupon or
+    an error message (str) to refuse it. Returns (True, info) with info =
+    {level, expiry, tier_name, code} or (False, error_message).
+    Failed attempts are counted against `requested_by` (the user typing the code).
+    """
+    wait = coupon_guard.retry_after(requested_by)
+    if wait:
+        return False, MSG_TOO_MANY.format(minutes=(wait + 59) // 60)
+    ok, result = _redeem(code_input, worker_user_id, plan, path, update_worker)
+    if ok:
+        coupon_guard.record_success(requested_by)
+        coupon_guard.discard(normalize(result["code"]), path)
+    elif result in (MSG_NOT_FOUND, MSG_USED, MSG_UNAVAILABLE, MSG_INVALID):
+        # a refused tier (plan() message) is the user's choice, not a guess
+        coupon_guard.record_failure(requested_by)
+    return ok, result
+
+
+def _redeem(code_input, worker_user_id, plan, path, update_worker):
+    if not normalize(code_input):
+        return False, MSG_INVALID
+    if not coupon_guard.may_exist(candidates(code_input), path):
+        return False, MSG_UNAVAILABLE
+    with db.transaction(path) as conn:
+        found = find(conn, code_input)
+        if found is None:
+            return False, MSG_NOT_FOUND
+        cid, amount, used, actual_code = found
+        if used:
+            return False, MSG_USED
+        decision = plan(int(amount or 0))
+        if isinstance(decision, str):
+            return False, decision
+        level, days, tier_name = decision
+        expiry_iso = (datetime.utcnow() + timedelta(days=days)).isoformat()
+        if not claim(conn, cid, worker_user_id, expiry_iso):
+            return False, MSG_USED
+        if update_worker:
+            conn.execute("UPDATE workers SET subscription_level = ?, subscription_expiry = ?, coupon_code = ? WHERE user_id = ?",
+                         (level, expiry_iso, actual_code, worker_user_id))
+    logging.info("coupon %s redeemed for %s", actual_code, worker_user_id)
+    return True, {"level": level, "expiry": expiry_iso, "tier_name": tier_name, "code": actual_code}
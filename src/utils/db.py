@@ -0,0 +1,177 @@
+"""Shared SQLite connection layer for bot.py and khidmati.py.
+
+Both bots write the same data.db, so instead of opening and closing a new
+connection inside every helper we keep one long-lived connection per thread
+(per database path). Every connection is switched to WAL so readers do not
+block the writer, gets a busy timeout so the two processes wait for each other
+instead of failing with "database is locked", and keeps a prepared-statement
+cache that survives across helper calls.
+
+Existing helpers keep their open/commit/close shape: ``connect()`` hands out a
+proxy whose ``close()`` returns the shared connection instead of closing it.
+New code can use ``get_conn()`` / ``transaction()`` directly.
+"""
+import os
+import sqlite3
+import logging
+import threading
+import weakref
+from contextlib import contextmanager
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+DEFAULT_DB_PATH = os.path.join(ROOT_DIR, "data.db")
+
+# how long a writer waits for the other process' lock before giving up (ms)
+BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+# number of prepared statements kept per connection
+STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "256"))
+
+_local = threading.local()
+# every connection we opened (any thread) so close_all() can release them on shutdown
+_opened = []
+_opened_lock = threading.Lock()
+
+
+def _open(path):
+    conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT_MS / 1000.0,
+                           cached_statements=STATEMENT_CACHE_SIZE, check_same_thread=False)
+    try:
+        conn.execute(f"PRAGMA busy_timeout = {int(BUSY_TIMEOUT_MS)}")
+        conn.execute("PRAGMA journal_mode = WAL")
+        # WAL + NORMAL is durable across application crashes and avoids an fsync per commit
+        conn.execute("PRAGMA synchronous = NORMAL")
+    except sqlite3.DatabaseError:
+        logging.exception("Could not apply connection pragmas for %s", path)
+    with _opened_lock:
+        _opened.append(conn)
+    logging.debug("Opened shared SQLite connection to %s in thread %s", path, threading.current_thread().name)
+    return conn
+
+
+def _slots():
+    slots = getattr(_local, "slots", None)
+    if slots is None:
+        slots = _local.slots = {}
+    return slots
+
+
+def get_conn(path=None):
+    """Return this thread's long-lived connection to `path` (default: data.db)."""
+    path = os.path.abspath(path or DEFAULT_DB_PATH)
+    slots = _slots()
+    slot = slots.get(path)
+    if slot is None:
+        slot = slots[path] = {"conn": _open(path), "tx": 0, "holders": weakref.WeakSet()}
+    return slot["conn"]
+
+
+def _slot(path):
+    get_conn(path)
+    return _slots()[os.path.abspath(path or DEFAULT_DB_PATH)]
+
+
+def _drop_leaked(slot, path):
+    """Roll back a transaction nobody owns any more.
+
+    A helper that raised between its write and close() leaves its transaction
+    open on the shared connection; once its proxy is gone nothing may commit it.
+    """
+    conn = slot["conn"]
+    if slot["tx"] == 0 and not slot["holders"] and conn.in_transaction:
+        logging.warning("Rolling back an unfinished transaction on %s", path)
+        try:
+            conn.rollback()
+        except sqlite3.Error:
+            logging.debug("rollback of leaked transaction failed", exc_info=True)
+
+
+class PooledConnection:
+    """Proxy around the shared connection; close() hands it back instead of closing it.
+
+    Whatever the helper did not commit is rolled back on close(), as closing a
+    private connection used to do, so a failed helper's partial writes can never
+    be committed by the next helper on the same connection. Helpers running
+    inside transaction() leave the transaction to the block.
+    """
+
+    def __init__(self, path):
+        self._path = os.path.abspath(path or DEFAULT_DB_PATH)
+        self._conn = get_conn(self._path)
+        self._slot = _slots()[self._path]
+        _drop_leaked(self._slot, self._path)
+        self._slot["holders"].add(self)
+        self._released = False
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def __enter__(self):
+        return self._conn.__enter__()
+
+    def __exit__(self, *exc):
+        return self._conn.__exit__(*exc)
+
+    def close(self):
+        if self._released:
+            return
+        self._released = True
+        self._slot["holders"].discard(self)
+        if self._slot["tx"] == 0 and self._conn.in_transaction:
+            try:
+                self._conn.rollback()
+            except sqlite3.Error:
+                logging.debug("rollback on release failed")
+
+
+def connect(path=None):
+    """Drop-in replacement for sqlite3.connect(DB_PATH) backed by the shared connection."""
+    return PooledConnection(path)
+
+
+@contextmanager
+def transaction(path=None, immediate=True):
+    """Run a block in one transaction on the shared connection; commit or roll back.
+
+    IMMEDIATE takes the write lock up front so two writers never deadlock while
+    upgrading from a read lock. Nested use joins the outer transaction.
+    """
+    conn = get_conn(path)
+    slot = _slot(path)
+    if slot["tx"]:
+        slot["tx"] += 1
+        try:
+            yield conn
+        finally:
+            slot["tx"] -= 1
+        return
+    _drop_leaked(slot, path or DEFAULT_DB_PATH)
+    if conn.in_transaction:
+        # a connect() helper further up the stack has pending writes: join them
+        yield conn
+        return
+    conn.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+    slot["tx"] += 1
+    try:
+        yield conn
+    except BaseException:
+        conn.rollback()
+        raise
+    else:
+        conn.commit()
+    finally:
+        slot["tx"] -= 1
+
+
+def close_all():
+    """Close every shared connection (call once on shutdown)."""
+    with _opened_lock:
+        conns = list(_opened)
+        _opened.clear()
+    for conn in conns:
+        try:
+            conn.close()
+        except Exception:
+            logging.debug("Failed closing shared connection", exc_info=True)
+    slots = getattr(_local, "slots", None)
+    if slots is not None:
+        slots.clear()
@@ -0,0 +1,104 @@
+"""Run blocking sqlite helpers off the asyncio event loop.
+
+Handlers are async but the DB helpers are plain blocking functions. Awaiting
+them through this module keeps one slow write (e.g. waiting on the other
+process' lock) from stalling every other user's update:
+
+- writes go to a single dedicated thread, so they are serialised and never
+  compete with each other for the SQLite write lock;
+- reads go to a small pool of threads (WAL lets them run next to the writer).
+
+Each thread uses its own long-lived connection from src.utils.db. Every call's
+latency is recorded per helper name; see latency_snapshot()/format_latency_report().
+"""
+import os
+import time
+import asyncio
+import logging
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+READER_THREADS = int(os.getenv("DB_READER_THREADS", "4"))
+# calls slower than this are logged at WARNING so lock waits show up in bot.log
+SLOW_CALL_MS = float(os.getenv("DB_SLOW_CALL_MS", "250"))
+
+_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+_readers = ThreadPoolExecutor(max_workers=max(1, READER_THREADS), thread_name_prefix="db-reader")
+
+# name -> {"calls", "total_ms", "max_ms", "errors"}
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+def _record(name, kind, elapsed_ms, failed):
+    with _stats_lock:
+        st = _stats.get(name)
+        if st is None:
+            st = _stats[name] = {"kind": kind, "calls": 0, "total_ms": 0.0, "max_ms": 0.0, "errors": 0}
+        st["calls"] += 1
+        st["total_ms"] += elapsed_ms
+        if elapsed_ms > st["max_ms"]:
+            st["max_ms"] = elapsed_ms
+        if failed:
+            st["errors"] += 1
+    if elapsed_ms >= SLOW_CALL_MS:
+        logging.warning("slow DB %s call %s took %.1f ms", kind, name, elapsed_ms)
+
+
+def _timed(fn, name, kind, queued_at, args, kwargs):
+    start = time.perf_counter()
+    failed = True
+    try:
+        result = fn(*args, **kwargs)
+        failed = False
+        return result
+    finally:
+        done = time.perf_counter()
+        # latency as seen by the awaiting handler: queue wait + execution
+        _record(name, kind, (done - queued_at) * 1000.0, failed)
+        logging.debug("DB %s %s: queued %.1f ms, ran %.1f ms", kind, name, (start - queued_at) * 1000.0, (done - start) * 1000.0)
+
+
+async def _submit(executor, kind, fn, args, kwargs):
+    name = getattr(fn, "__name__", repr(fn))
+    loop = asyncio.get_running_loop()
+    call = functools.partial(_timed, fn, name, kind, time.perf_counter(), args, kwargs)
+    return await loop.run_in_executor(executor, call)
+
+
+async def run_write(fn, *args, **kwargs):
+    """Await fn(*args, **kwargs) on the single writer thread."""
+    return await _submit(_writer, "write", fn, args, kwargs)
+
+
+async def run_read(fn, *args, **kwargs):
+    """Await fn(*args, **kwargs) on the reader pool."""
+    return await _submit(_readers, "read", fn, args, kwargs)
+
+
+def latency_snapshot():
+    """Return {name: stats} with avg_ms filled in (a copy, safe to mutate)."""
+    with _stats_lock:
+        out = {k: dict(v) for k, v in _stats.items()}
+    for st in out.values():
+        st["avg_ms"] = st["total_ms"] / st["calls"] if st["calls"] else 0.0
+    return out
+
+
+def format_latency_report(limit=8):
+    """Short text report of the slowest helpers by total time (for the admin panel)."""
+    snap = latency_snapshot()
+    if not snap:
+        return "زمن استعلامات قاعدة البيانات: لا توجد بيانات بعد"
+    rows = sorted(snap.items(), key=lambda kv: kv[1]["total_ms"], reverse=True)[:limit]
+    lines = ["زمن استعلامات قاعدة البيانات (اسم | عدد | متوسط ms | أقصى ms):"]
+    for name, st in rows:
+        lines.append(f"{name} | {st['calls']} | {st['avg_ms']:.1f} | {st['max_ms']:.1f}" + (f" | أخطاء:{st['errors']}" if st["errors"] else ""))
+    return "\n".join(lines)
+
+
+def shutdown(wait=True):
+    """Stop accepting work and wait for queued writes to finish."""
+    _writer.shutdown(wait=wait)
+    _readers.shutdown(wait=wait)
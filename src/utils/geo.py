@@ -0,0 +1,85 @@
+"""Grid-cell spatial index helpers for the workers table.
+
+Each worker with a location gets an integer `geo_cell` (a fixed lat/lon grid of
+CELL_DEG degrees). workers(work_type, geo_cell) is indexed — only rows with a
+cell, so workers without a location never enter the index — and a nearest-worker
+search loads just the cells overlapping the search radius, plus a lat/lon
+bounding box, before computing exact distances.
+"""
+import math
+
+# ~55 km of latitude per cell: a 40-100 km search touches a handful of cells
+CELL_DEG = 0.5
+_COLS = int(round(360 / CELL_DEG))
+_ROWS = int(round(180 / CELL_DEG))
+EARTH_RADIUS_KM = 6371.0
+_KM_PER_DEG_LAT = math.pi * EARTH_RADIUS_KM / 180.0
+
+# same formula as cell_of(), for backfilling rows in SQL (lat+90 / lon+180 are never negative,
+# so CAST truncation is a floor)
+SQL_CELL_EXPR = (f"MIN(CAST((lat + 90.0) / {CELL_DEG} AS INTEGER), {_ROWS - 1}) * {_COLS} "
+                 f"+ (CAST((lon + 180.0) / {CELL_DEG} AS INTEGER) % {_COLS})")
+
+
+def _row_col(lat, lon):
+    row = min(int((float(lat) + 90.0) / CELL_DEG), _ROWS - 1)
+    col = int((float(lon) + 180.0) / CELL_DEG) % _COLS
+    return row, col
+
+
+def cell_of(lat, lon):
+    """Return the integer grid cell for a point, or None when the location is missing."""
+    if lat is None or lon is None:
+        return None
+    try:
+        row, col = _row_col(lat, lon)
+    except (TypeError, ValueError):
+        return None
+    return row * _COLS + col
+
+
+def cell_center(cell):
+    """Return (lat, lon) of the centre of a grid cell."""
+    row, col = divmod(int(cell), _COLS)
+    return -90.0 + (row + 0.5) * CELL_DEG, -180.0 + (col + 0.5) * CELL_DEG
+
+
+# farthest any point of a cell can be from its centre (half diagonal at the equator)
+CELL_HALF_DIAG_KM = math.hypot(CELL_DEG / 2, CELL_DEG / 2) * _KM_PER_DEG_LAT
+
+
+def bounding_box(lat, lon, radius_km):
+    """Return (min_lat, max_lat, min_lon, max_lon) enclosing a circle of radius_km."""
+    dlat = radius_km / _KM_PER_DEG_LAT
+    coslat = math.cos(math.radians(lat))
+    # near the poles every longitude is within reach
+    dlon = 180.0 if coslat < 1e-6 else min(180.0, radius_km / (_KM_PER_DEG_LAT * coslat))
+    return max(-90.0, lat - dlat), min(90.0, lat + dlat), lon - dlon, lon + dlon
+
+
+def cells_for_radius(lat, lon, radius_km):
+    """Return every grid cell overlapping the bounding box of the search circle."""
+    min_lat, max_lat, min_lon, max_lon = bounding_box(lat, lon, radius_km)
+    r0, _ = _row_col(min_lat, 0.0)
+    r1, _ = _row_col(max_lat, 0.0)
+    c0 = int(math.floor((min_lon + 180.0) / CELL_DEG))
+    c1 = int(math.floor((max_lon + 180.0) / CELL_DEG))
+    cols = {c % _COLS for c in range(c0, c1 + 1)}
+    return [r * _COLS + c for r in range(r0, r1 + 1) for c in sorted(cols)]
+
+
+def bbox_sql(lat, lon, radius_km, lat_col="lat", lon_col="lon"):
+    """Return (sql_fragment, params) restricting rows to the cells + bounding box of a search.
+
+    The fragment starts with the geo_cell test so SQLite can use the
+    (work_type, geo_cell) index; the lat/lon range trims the edge cells.
+    """
+    cells = cells_for_radius(lat, lon, radius_km)
+    min_lat, max_lat, min_lon, max_lon = bounding_box(lat, lon, radius_km)
+    sql = f"geo_cell IN ({','.join('?' * len(cells))}) AND {lat_col} BETWEEN ? AND ?"
+    params = list(cells) + [min_lat, max_lat]
+    # a box crossing the antimeridian cannot be expressed as one BETWEEN; the cells already bound it
+    if -180.0 <= min_lon and max_lon <= 180.0:
+        sql += f" AND {lon_col} BETWEEN ? AND ?"
+        params += [min_lon, max_lon]
+    return sql, params
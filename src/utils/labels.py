@@ -0,0 +1,77 @@
+"""Arabic label normalisation and a lookup index of accepted button texts.
+
+normalize() is the one normaliser both bots use: emoji and punctuation are
+removed, the space after the conjunction "و" is dropped, whitespace is
+collapsed, diacritics and tatweel are removed, alef/hamza forms (إ أ آ) become
+"ا" and alef maqsura "ى" becomes "ي". The patterns are compiled once and
+results are memoised (button texts repeat endlessly).
+
+LabelIndex maps every accepted variant of a label -- with or without emoji,
+with or without the definite article "ال", any hamza form -- to a value (the
+canonical label, or e.g. ``("category", label)``), so resolving a button text
+is one normalize() plus one dict lookup. It is built once at import.
+"""
+import re
+import logging
+from functools import lru_cache
+
+_NOT_WORD = re.compile(r"[^\w\u0600-\u06FF\s]")
+_WAW_SPACE = re.compile(r"و\s+")
+_SPACES = re.compile(r"\s+")
+_DIACRITICS = re.compile(r"[\u064B-\u0652]")
+_FOLD = str.maketrans({"إ": "ا", "أ": "ا", "آ": "ا", "ى": "ي", "ـ": None})
+
+
+@lru_cache(maxsize=4096)
+def normalize(s):
+    """Normalize a label by removing emojis/special chars and lowercasing for matching."""
+    if not s:
+        return ""
+    cleaned = _NOT_WORD.sub("", s)
+    cleaned = _WAW_SPACE.sub("و", cleaned)
+    cleaned = _SPACES.sub(" ", cleaned)
+    cleaned = _DIACRITICS.sub("", cleaned)
+    return cleaned.translate(_FOLD).strip().lower()
+
+
+def strip_definite_article(s):
+    """Remove the definite article 'ال' from the start of every word ('تركيب الكاميرات' -> 'تركيب كاميرات')."""
+    if not s:
+        return s
+    return " ".join(w[2:] if w.startswith("ال") and len(w) > 2 else w for w in s.split())
+
+
+def variants(label):
+    """Normalized keys under which `label` is accepted."""
+    norm = normalize(label)
+    if not norm:
+        return set()
+    bare = strip_definite_article(norm)
+    keys = {norm, bare}
+    # a one-word label is also accepted with the article ("سباكة" -> "السباكة")
+    if " " not in bare and len(bare) > 1:
+        keys.add("ال" + bare)
+    return keys
+
+
+class LabelIndex:
+    def __init__(self):
+        self._map = {}
+
+    def add(self, value, *labels):
+        """Accept every variant of `labels` for `value`. An earlier registration keeps a shared key."""
+        for label in labels:
+            for key in variants(label):
+                old = self._map.setdefault(key, value)
+                if old != value:
+                    logging.debug("label %r: %r kept over %r", key, old, value)
+        return self
+
+    def get(self, text, default=None):
+        return self._map.get(normalize(text), default)
+
+    def __contains__(self, text):
+        return normalize(text) in self._map
+
+    def __len__(self):
+        return len(self._map)
@@ -0,0 +1,366 @@
+"""Versioned schema migrations for data.db (shared by bot.py and khidmati.py).
+
+PRAGMA user_version records the last migration applied to the file. On start
+both bots call migrate(): a database that is already current costs a single
+PRAGMA read — no CREATE TABLE IF NOT EXISTS and no PRAGMA table_info per
+column. Pending migrations run in order, each in its own IMMEDIATE transaction
+together with the user_version bump, so two processes starting at once cannot
+apply the same step twice.
+
+To change the schema append a new (version, name, fn) to MIGRATIONS; never
+edit a migration that has shipped. Run by hand with:
+
+    python -m src.utils.migrations [path/to/data.db]
+"""
+import sys
+import logging
+
+from src.utils import db, geo, usage, coupons, worker_search
+
+
+def _columns(conn, table):
+    return {r[1] for r in conn.execute(f"PRAGMA table_info({table})").fetchall()}
+
+
+def _add_columns(conn, table, coldefs):
+    """Add the missing columns of `coldefs` ("name TYPE ..." strings). Only used inside migrations."""
+    existing = _columns(conn, table)
+    for coldef in coldefs:
+        if coldef.split()[0] not in existing:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {coldef}")
+
+
+def _m1_base_schema(conn):
+    # tables as bot.py created them; older files (create_db.py, khidmati.py) get the missing columns
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS workers (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER UNIQUE,
+        name TEXT,
+        phone TEXT,
+        work_type TEXT,
+        lat REAL,
+        lon REAL,
+        worker_code INTEGER,
+        coupon_code TEXT,
+        subscription_level INTEGER DEFAULT 0,
+        subscription_expiry TIMESTAMP
+    )
+    """)
+    _add_columns(conn, "workers", [
+        "lat REAL", "lon REAL", "worker_code INTEGER", "coupon_code TEXT",
+        "subscription_level INTEGER DEFAULT 0", "subscription_expiry TIMESTAMP",
+        "appearance_count INTEGER DEFAULT 0", "ratings_received INTEGER DEFAULT 0",
+        "selected_count INTEGER DEFAULT 0", "avg_rating REAL DEFAULT 0",
+        "education_type TEXT", "education_specialization TEXT", "vehicle_type TEXT",
+        "company_name TEXT", "halakat_hoosh TEXT", "work_specialization TEXT",
+        "floor_type TEXT", "tier TEXT", "subscription_end TEXT",
+    ])
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS clients (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        name TEXT,
+        phone TEXT,
+        service TEXT,
+        lat REAL,
+        lon REAL,
+        assigned_worker_id INTEGER,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+    _add_columns(conn, "clients", ["assigned_worker_id INTEGER"])
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS coupons (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        code TEXT UNIQUE,
+        amount INTEGER,
+        used INTEGER DEFAULT 0,
+        used_by_worker_user_id INTEGER,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        used_at TIMESTAMP
+    )
+    """)
+    # ALTER TABLE cannot add a CURRENT_TIMESTAMP default; old rows keep NULL
+    _add_columns(conn, "coupons", ["used_by_worker_user_id INTEGER", "created_at TIMESTAMP", "used_at TIMESTAMP"])
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS ratings (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        worker_user_id INTEGER,
+        client_user_id INTEGER,
+        rating INTEGER,
+        comment TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+    # usage_stats table to track total users/requests
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS usage_stats (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        total_users INTEGER DEFAULT 0,
+        total_requests INTEGER DEFAULT 0
+    )
+    """)
+    conn.execute("INSERT OR IGNORE INTO usage_stats (id, total_users, total_requests) VALUES (1,0,0)")
+    # table to track if we've greeted a user before (so first-time users get the full menu)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS seen_users (
+        user_id INTEGER PRIMARY KEY,
+        first_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+
+
+def _m2_geo_cell(conn):
+    # grid-cell spatial index for nearest-worker search; rows without a
+    # location keep geo_cell NULL and stay out of the (partial) index
+    _add_columns(conn, "workers", ["geo_cell INTEGER"])
+    conn.execute(f"UPDATE workers SET geo_cell = {geo.SQL_CELL_EXPR} WHERE geo_cell IS NULL AND lat IS NOT NULL AND lon IS NOT NULL")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_workers_service_cell ON workers(work_type, geo_cell) WHERE geo_cell IS NOT NULL")
+
+
+def _m3_lookup_indexes(conn):
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_workers_service_edu ON workers(work_type, education_type)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_workers_code ON workers(worker_code)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_ratings_worker ON ratings(worker_user_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_clients_user ON clients(user_id)")
+
+
+def _m4_reconcile_columns(conn):
+    # khidmati.py used its own names for two workers columns; both bots now use
+    # selected_count and education_specialization. The old columns are kept
+    # (SQLite before 3.35 cannot drop columns) but no longer written.
+    cols = _columns(conn, "workers")
+    if "selection_count" in cols:
+        conn.execute("UPDATE workers SET selected_count = COALESCE(selected_count,0) + COALESCE(selection_count,0), selection_count = 0 "
+                     "WHERE COALESCE(selection_count,0) != 0")
+    if "edu_specialty" in cols:
+        conn.execute("UPDATE workers SET education_specialization = edu_specialty "
+                     "WHERE education_specialization IS NULL AND edu_specialty IS NOT NULL")
+
+
+def _m5_rating_aggregates(conn):
+    # per-worker rating totals kept by triggers, so reading an average is one row lookup
+    # instead of COUNT/AVG over ratings, and concurrent ratings cannot overwrite each other
+    _add_columns(conn, "workers", ["rating_count INTEGER DEFAULT 0", "rating_sum INTEGER DEFAULT 0"])
+    conn.execute("""
+    UPDATE workers SET
+        rating_count = (SELECT COUNT(*) FROM ratings r WHERE r.worker_user_id = workers.user_id),
+        rating_sum = (SELECT COALESCE(SUM(r.rating), 0) FROM ratings r WHERE r.worker_user_id = workers.user_id)
+    """)
+    # khidmati.py used to keep only a running avg_rating/ratings_received without rows in
+    # ratings; carry that history over for workers that have no rating rows
+    conn.execute("""
+    UPDATE workers SET rating_count = ratings_received, rating_sum = CAST(ROUND(avg_rating * ratings_received) AS INTEGER)
+    WHERE rating_count = 0 AND COALESCE(ratings_received, 0) > 0 AND COALESCE(avg_rating, 0) > 0
+    """)
+    conn.execute("UPDATE workers SET avg_rating = CASE WHEN rating_count > 0 THEN CAST(rating_sum AS REAL) / rating_count ELSE 0 END")
+    # SET expressions see the row before the update, so avg uses the old totals + NEW.rating
+    conn.execute("""
+    CREATE TRIGGER IF NOT EXISTS trg_ratings_insert AFTER INSERT ON ratings BEGIN
+        UPDATE workers SET
+            rating_count = COALESCE(rating_count, 0) + 1,
+            rating_sum = COALESCE(rating_sum, 0) + NEW.rating,
+            avg_rating = CAST(COALESCE(rating_sum, 0) + NEW.rating AS REAL) / (COALESCE(rating_count, 0) + 1)
+        WHERE user_id = NEW.worker_user_id;
+    END
+    """)
+    conn.execute("""
+    CREATE TRIGGER IF NOT EXISTS trg_ratings_delete AFTER DELETE ON ratings BEGIN
+        UPDATE workers SET
+            rating_count = MAX(COALESCE(rating_count, 0) - 1, 0),
+            rating_sum = COALESCE(rating_sum, 0) - OLD.rating,
+            avg_rating = CASE WHEN COALESCE(rating_count, 0) > 1
+                              THEN CAST(COALESCE(rating_sum, 0) - OLD.rating AS REAL) / (rating_count - 1) ELSE 0 END
+        WHERE user_id = OLD.worker_user_id;
+    END
+    """)
+
+
+def _m6_requesters(conn):
+    # distinct requesters for usage_stats.total_users (see src/utils/usage.py)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS requesters (
+        user_id INTEGER PRIMARY KEY,
+        first_request_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+    usage.backfill_conn(conn)
+
+
+def _coupon_norms(conn):
+    """(code_norm, id) for every coupon; a code normalising to one already taken gets None."""
+    taken = set()
+    rows = []
+    for cid, code in conn.execute("SELECT id, code FROM coupons ORDER BY id").fetchall():
+        norm = coupons.normalize(code) or None
+        if norm is not None:
+            if norm in taken:
+                # two old codes that differ only in punctuation/case: keep the first reachable
+                logging.warning("coupon %s (%r) normalises to an existing code; left without code_norm", cid, code)
+                norm = None
+            else:
+                taken.add(norm)
+        rows.append((norm, cid))
+    return rows
+
+
+def _m7_coupon_code_norm(conn):
+    # normalised coupon code with its own unique index (see src/utils/coupons.py)
+    _add_columns(conn, "coupons", ["code_norm TEXT"])
+    rows = _coupon_norms(conn)
+    conn.executemany("UPDATE coupons SET code_norm = ? WHERE id = ?", rows)
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_coupons_code_norm ON coupons(code_norm)")
+    # safety net for tools that insert only `code`: the common separators are stripped in SQL
+    conn.execute("""
+    CREATE TRIGGER IF NOT EXISTS trg_coupons_code_norm AFTER INSERT ON coupons WHEN NEW.code_norm IS NULL BEGIN
+        UPDATE coupons SET code_norm = UPPER(REPLACE(REPLACE(REPLACE(NEW.code, '-', ''), ' ', ''), '_', '')) WHERE id = NEW.id;
+    END
+    """)
+
+
+def _m8_broadcast_jobs(conn):
+    # persisted admin broadcasts, resumed after a restart (see src/utils/broadcast.py)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS broadcast_jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        kind TEXT NOT NULL,
+        text TEXT,
+        from_chat_id INTEGER,
+        message_id INTEGER,
+        audience TEXT NOT NULL DEFAULT 'workers',
+        status TEXT NOT NULL DEFAULT 'running',
+        cursor INTEGER NOT NULL DEFAULT 0,
+        total INTEGER DEFAULT 0,
+        sent INTEGER NOT NULL DEFAULT 0,
+        failed INTEGER NOT NULL DEFAULT 0,
+        admin_chat_id INTEGER,
+        progress_message_id INTEGER,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP,
+        finished_at TIMESTAMP
+    )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_broadcast_jobs_status ON broadcast_jobs(status)")
+
+
+def _m9_unreachable_chats(conn):
+    # chats that blocked the bot / were deleted; skipped by fan-outs (see src/utils/reachability.py)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS unreachable_chats (
+        chat_id INTEGER PRIMARY KEY,
+        reason TEXT NOT NULL,
+        error TEXT,
+        marked_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+
+
+def _m10_outbox(conn):
+    # notifications committed with the change they announce, delivered in the background (src/utils/outbox.py)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        chat_id INTEGER NOT NULL,
+        text TEXT NOT NULL,
+        dedupe_key TEXT UNIQUE,
+        status TEXT NOT NULL DEFAULT 'pending',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        next_attempt_at REAL NOT NULL,
+        claimed_at REAL,
+        last_error TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        sent_at TIMESTAMP
+    )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox(status, next_attempt_at)")
+
+
+def _m11_conversation_states(conn):
+    # multi-step conversation state per bot, restored after a restart (src/utils/state_store.py)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS conversation_states (
+        scope TEXT NOT NULL,
+        user_id INTEGER NOT NULL,
+        state TEXT NOT NULL,
+        updated_at REAL NOT NULL,
+        PRIMARY KEY (scope, user_id)
+    ) WITHOUT ROWID
+    """)
+
+
+def _m12_worker_fts(conn):
+    # FTS5 keyword index over names and specialisations, kept in sync by triggers (src/utils/worker_search.py)
+    worker_search.create_schema(conn)
+
+
+def _m13_coupon_norm_trigger(conn):
+    # the m7 trigger only stripped "-", " " and "_": normalise like coupons.normalize()
+    # (Arabic-Indic digits too) and refuse codes SQL cannot normalise instead of storing a wrong code_norm
+    conn.execute("DROP TRIGGER IF EXISTS trg_coupons_code_norm")
+    conn.execute(f"""
+    CREATE TRIGGER trg_coupons_code_norm AFTER INSERT ON coupons WHEN NEW.code_norm IS NULL BEGIN
+        UPDATE coupons SET code_norm = {coupons.sql_fold_digits('NEW.code')} WHERE id = NEW.id;
+        UPDATE coupons SET code_norm = NULLIF({coupons.sql_strip_code('code_norm')}, '') WHERE id = NEW.id;
+        SELECT RAISE(ABORT, 'coupon code needs code_norm: use coupons.normalize()')
+        FROM coupons WHERE id = NEW.id AND code_norm GLOB '*[^A-Z0-9]*';
+    END
+    """)
+    # rows the old trigger normalised differently; cleared first so the unique index never sees a swap half-done
+    current = dict(conn.execute("SELECT id, code_norm FROM coupons").fetchall())
+    changed = [(norm, cid) for norm, cid in _coupon_norms(conn) if current.get(cid) != norm]
+    if changed:
+        conn.executemany("UPDATE coupons SET code_norm = NULL WHERE id = ?", [(cid,) for _, cid in changed])
+        conn.executemany("UPDATE coupons SET code_norm = ? WHERE id = ?", changed)
+        logging.info("re-normalised %d coupon codes", len(changed))
+
+
+# (user_version, name, fn) in the order they are applied
+MIGRATIONS = [
+    (1, "base schema", _m1_base_schema),
+    (2, "geo_cell spatial index", _m2_geo_cell),
+    (3, "lookup indexes", _m3_lookup_indexes),
+    (4, "reconcile khidmati column names", _m4_reconcile_columns),
+    (5, "rating aggregates on workers", _m5_rating_aggregates),
+    (6, "distinct requesters for usage stats", _m6_requesters),
+    (7, "normalised coupon codes", _m7_coupon_code_norm),
+    (8, "broadcast jobs", _m8_broadcast_jobs),
+    (9, "unreachable chats", _m9_unreachable_chats),
+    (10, "notification outbox", _m10_outbox),
+    (11, "conversation states", _m11_conversation_states),
+    (12, "worker full-text search", _m12_worker_fts),
+    (13, "coupon code_norm trigger", _m13_coupon_norm_trigger),
+]
+LATEST = MIGRATIONS[-1][0]
+
+
+def current_version(path=None):
+    return db.get_conn(path).execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(path=None):
+    """Bring the database up to LATEST. Returns the resulting user_version."""
+    version = current_version(path)
+    if version >= LATEST:
+        return version
+    for target, name, fn in MIGRATIONS:
+        if target <= version:
+            continue
+        with db.transaction(path) as conn:
+            # another process may have migrated while we waited for the write lock
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            if target <= version:
+                continue
+            fn(conn)
+            conn.execute(f"PRAGMA user_version = {int(target)}")
+        version = target
+        logging.info("Applied DB migration %d (%s)", target, name)
+    return version
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    path = sys.argv[1] if len(sys.argv) > 1 else None
+    before = current_version(path)
+    after = migrate(path)
+    print(f"{path or db.DEFAULT_DB_PATH}: user_version {before} -> {after}")
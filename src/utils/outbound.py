@@ -0,0 +1,240 @@
+"""One scheduler for every outgoing Telegram request (python-telegram-bot rate limiter).
+
+OutboundScheduler is plugged into Application.builder().rate_limiter(...), so
+every context.bot / reply_text call passes through process_request():
+
+- message-sending endpoints are queued per chat; each chat gets one message
+  per PER_CHAT_INTERVAL seconds (Telegram allows ~1/s) with a burst of
+  PER_CHAT_BURST, so a reply followed by a menu is not held back;
+- all of them share a global budget of GLOBAL_RATE requests per second
+  (~30/s); when several wait, interactive traffic always goes before bulk.
+  Bulk is requested with ``rate_limit_args=BULK`` (broadcasts do);
+- when the chat's budget would hold messages back, a plain sendMessage
+  absorbs the next queued plain sendMessage to the same chat (no reply
+  markup on the earlier one, same parse mode, fits 4096 characters): the
+  user gets one message and both callers receive it;
+- RetryAfter pauses everything for the requested time and the request is
+  retried up to MAX_RETRIES times.
+
+Other endpoints (getUpdates, answerCallbackQuery, ...) are not delayed.
+stats() returns queue depths and counters for the admin panel.
+"""
+import os
+import time
+import heapq
+import asyncio
+import logging
+import itertools
+from datetime import timedelta
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+GLOBAL_RATE = float(os.getenv("OUTBOUND_GLOBAL_RATE", "30"))
+PER_CHAT_INTERVAL = float(os.getenv("OUTBOUND_PER_CHAT_INTERVAL", "1.0"))
+PER_CHAT_BURST = float(os.getenv("OUTBOUND_PER_CHAT_BURST", "3"))
+MAX_RETRIES = int(os.getenv("OUTBOUND_MAX_RETRIES", "3"))
+MAX_TEXT = 4096
+
+INTERACTIVE, BULK = 0, 1
+_PRIORITY_NAMES = {INTERACTIVE: "interactive", BULK: "bulk"}
+
+# endpoints that put (or change) a message in a chat and count against Telegram's limits
+_LIMITED = {
+    "sendMessage", "copyMessage", "forwardMessage", "sendPhoto", "sendDocument", "sendContact",
+    "sendLocation", "sendMediaGroup", "sendAudio", "sendVideo", "sendVoice", "sendSticker",
+    "editMessageText", "editMessageReplyMarkup", "editMessageCaption",
+}
+# sendMessage keys that still allow two messages to be merged into one
+_MERGEABLE_KEYS = {"chat_id", "text", "parse_mode", "reply_markup", "disable_web_page_preview", "disable_notification"}
+
+_instance = None
+
+
+def _retry_seconds(err):
+    ra = err.retry_after
+    return ra.total_seconds() if isinstance(ra, timedelta) else float(ra)
+
+
+class _Item:
+    __slots__ = ("callback", "args", "kwargs", "endpoint", "data", "priority", "futures", "queued_at")
+
+    def __init__(self, callback, args, kwargs, endpoint, data, priority):
+        self.callback, self.args, self.kwargs = callback, args, kwargs
+        self.endpoint, self.data, self.priority = endpoint, data, priority
+        self.futures = [asyncio.get_running_loop().create_future()]
+        self.queued_at = time.monotonic()
+
+
+def _mergeable(first, nxt):
+    if first.endpoint != "sendMessage" or nxt.endpoint != "sendMessage":
+        return False
+    a, b = first.data, nxt.data
+    if not (set(a) <= _MERGEABLE_KEYS and set(b) <= _MERGEABLE_KEYS):
+        return False
+    if a.get("reply_markup") is not None or a.get("parse_mode") != b.get("parse_mode"):
+        return False
+    if not isinstance(a.get("text"), str) or not isinstance(b.get("text"), str):
+        return False
+    if len(a["text"]) + 2 + len(b["text"]) > MAX_TEXT:
+        return False
+    # the request data must be what the callback sends, or the merge would be lost
+    return any(x is a for x in first.args) or any(x is a for x in first.kwargs.values())
+
+
+class OutboundScheduler(BaseRateLimiter):
+    def __init__(self, global_rate=GLOBAL_RATE, per_chat_interval=PER_CHAT_INTERVAL, per_chat_burst=PER_CHAT_BURST,
+                 max_retries=MAX_RETRIES):
+        global _instance
+        self.global_rate = global_rate
+        self.per_chat_interval = per_chat_interval
+        self.per_chat_burst = max(1.0, per_chat_burst)
+        self.max_retries = max_retries
+        self._queues = {}      # chat_id -> list of _Item waiting for that chat
+        self._runners = {}     # chat_id -> task draining the chat's queue
+        self._chat_tokens = {}  # chat_id -> (tokens, monotonic time they were counted)
+        self._waiters = []     # heap of (priority, seq, future) waiting for a global slot
+        self._seq = itertools.count()
+        self._next_slot = 0.0
+        self._paused_until = 0.0
+        self._pump = None
+        self._wake = None
+        self.counters = {"sent": 0, "merged": 0, "retry_after": 0, "errors": 0, "max_wait_ms": 0.0}
+        _instance = self
+
+    async def initialize(self):
+        self._wake = asyncio.Event()
+        self._pump = asyncio.create_task(self._run_pump())
+
+    async def shutdown(self):
+        if self._pump:
+            self._pump.cancel()
+            self._pump = None
+        for task in list(self._runners.values()):
+            task.cancel()
+
+    # ---------- global budget ----------
+
+    async def _run_pump(self):
+        """Hand out global slots, GLOBAL_RATE per second, best priority first."""
+        while True:
+            while not self._waiters:
+                self._wake.clear()
+                await self._wake.wait()
+            now = time.monotonic()
+            ready_at = max(self._next_slot, self._paused_until)
+            if now < ready_at:
+                await asyncio.sleep(ready_at - now)
+                continue
+            _, _, fut = heapq.heappop(self._waiters)
+            if fut.done():
+                continue
+            fut.set_result(None)
+            self._next_slot = max(now, self._next_slot) + 1.0 / self.global_rate
+
+    async def _global_slot(self, priority):
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), fut))
+        self._wake.set()
+        await fut
+
+    def _pause(self, seconds):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def _send(self, callback, args, kwargs, priority):
+        retries = 0
+        while True:
+            await self._global_slot(priority)
+            try:
+                result = await callback(*args, **kwargs)
+                self.counters["sent"] += 1
+                return result
+            except RetryAfter as e:
+                self.counters["retry_after"] += 1
+                wait = _retry_seconds(e) + 0.5
+                logging.warning("outbound: RetryAfter %.1fs", wait)
+                self._pause(wait)
+                retries += 1
+                if retries > self.max_retries:
+                    raise
+
+    # ---------- per-chat queues ----------
+
+    def _chat_tokens_now(self, chat_id, now):
+        tokens, at = self._chat_tokens.get(chat_id, (self.per_chat_burst, now))
+        return min(self.per_chat_burst, tokens + (now - at) / self.per_chat_interval)
+
+    async def _chat_slot(self, chat_id):
+        """Per-chat token bucket: PER_CHAT_BURST at once, then one per PER_CHAT_INTERVAL."""
+        while True:
+            now = time.monotonic()
+            tokens = self._chat_tokens_now(chat_id, now)
+            if tokens >= 1:
+                self._chat_tokens[chat_id] = (tokens - 1, now)
+                return
+            self._chat_tokens[chat_id] = (tokens, now)
+            await asyncio.sleep((1 - tokens) * self.per_chat_interval)
+
+    async def _drain(self, chat_id):
+        queue = self._queues[chat_id]
+        try:
+            while queue:
+                # interactive first, FIFO within a priority
+                i = min(range(len(queue)), key=lambda k: queue[k].priority)
+                item = queue.pop(i)
+                # merge only what the per-chat limit would hold back anyway
+                held = self._chat_tokens_now(chat_id, time.monotonic()) < 2
+                while held and i < len(queue) and queue[i].priority == item.priority and _mergeable(item, queue[i]):
+                    nxt = queue.pop(i)
+                    item.data["text"] = f"{item.data['text']}\n\n{nxt.data['text']}"
+                    if nxt.data.get("reply_markup") is not None:
+                        item.data["reply_markup"] = nxt.data["reply_markup"]
+                    item.futures.extend(nxt.futures)
+                    self.counters["merged"] += 1
+                await self._chat_slot(chat_id)
+                waited_ms = (time.monotonic() - item.queued_at) * 1000.0
+                self.counters["max_wait_ms"] = max(self.counters["max_wait_ms"], waited_ms)
+                try:
+                    result = await self._send(item.callback, item.args, item.kwargs, item.priority)
+                except Exception as e:
+                    self.counters["errors"] += 1
+                    for fut in item.futures:
+                        if not fut.done():
+                            fut.set_exception(e)
+                else:
+                    for fut in item.futures:
+                        if not fut.done():
+                            fut.set_result(result)
+        finally:
+            self._queues.pop(chat_id, None)
+            self._runners.pop(chat_id, None)
+            if len(self._chat_tokens) > 10000:
+                # a chat idle for a full refill is back at the burst size anyway
+                cutoff = time.monotonic() - self.per_chat_interval * self.per_chat_burst
+                for cid in [c for c, (_, t) in self._chat_tokens.items() if t < cutoff]:
+                    del self._chat_tokens[cid]
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        priority = BULK if rate_limit_args == BULK else INTERACTIVE
+        chat_id = data.get("chat_id") if isinstance(data, dict) else None
+        if endpoint not in _LIMITED:
+            return await callback(*args, **kwargs)
+        if chat_id is None:
+            return await self._send(callback, args, kwargs, priority)
+        item = _Item(callback, args, kwargs, endpoint, data, priority)
+        self._queues.setdefault(chat_id, []).append(item)
+        if chat_id not in self._runners:
+            self._runners[chat_id] = asyncio.create_task(self._drain(chat_id))
+        return await item.futures[0]
+
+    def snapshot(self):
+        depth = {name: 0 for name in _PRIORITY_NAMES.values()}
+        for queue in self._queues.values():
+            for item in queue:
+                depth[_PRIORITY_NAMES[item.priority]] += 1
+        return dict(self.counters, queued=depth, waiting_global=len(self._waiters), active_chats=len(self._runners))
+
+
+def stats():
+    """Queue metrics of the running scheduler ({} before the bot started)."""
+    return _instance.snapshot() if _instance else {}
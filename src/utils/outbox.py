@@ -0,0 +1,142 @@
+"""Durable outbox for notifications to other users (e.g. "you were chosen").
+
+A handler writes the notification with enqueue() on the same transaction as
+the change it announces, so both commit or neither does, and answers the user
+immediately. run_dispatcher() -- a background task started in post_init --
+delivers due rows:
+
+- a row is claimed with ``UPDATE ... SET status='sending' WHERE status='pending'``
+  so only one dispatcher sends it, and marked 'sent' right after Telegram
+  accepted it. A claim older than LEASE_SECONDS (the process died mid-send) is
+  returned to 'pending': a notification may in rare cases arrive twice, but
+  it is never lost;
+- transient errors retry with exponential backoff (RETRY_BASE_SECONDS,
+  doubling, at most MAX_ATTEMPTS tries); chats that blocked the bot are
+  recorded by src/utils/reachability.py and the row is marked 'failed';
+- dedupe_key makes enqueue() idempotent (a double tap queues one message).
+"""
+import os
+import time
+import asyncio
+import logging
+
+from telegram.error import Forbidden, BadRequest
+
+from src.utils import db, reachability
+
+BATCH = int(os.getenv("OUTBOX_BATCH", "20"))
+MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "6"))
+RETRY_BASE_SECONDS = float(os.getenv("OUTBOX_RETRY_BASE_SECONDS", "5"))
+LEASE_SECONDS = float(os.getenv("OUTBOX_LEASE_SECONDS", "300"))
+
+_wake = None
+_stats = {"sent": 0, "retried": 0, "failed": 0, "skipped": 0}
+
+
+def enqueue(conn, chat_id, text, dedupe_key=None):
+    """Queue a message on an open transaction. Returns False if dedupe_key was already queued."""
+    cur = conn.execute("INSERT OR IGNORE INTO outbox (chat_id, text, dedupe_key, next_attempt_at) VALUES (?, ?, ?, ?)",
+                       (chat_id, text, dedupe_key, time.time()))
+    return cur.rowcount == 1
+
+
+def notify():
+    """Wake the dispatcher after a commit that queued something."""
+    if _wake is not None:
+        _wake.set()
+
+
+# ---------- rows (blocking; run through db_executor) ----------
+
+def claim_due(path=None, limit=BATCH):
+    """Claim up to `limit` due rows for this dispatcher. Returns [(id, chat_id, text, attempts)]."""
+    now = time.time()
+    with db.transaction(path) as conn:
+        conn.execute("UPDATE outbox SET status = 'pending' WHERE status = 'sending' AND claimed_at < ?", (now - LEASE_SECONDS,))
+        rows = conn.execute("SELECT id, chat_id, text, attempts FROM outbox WHERE status = 'pending' AND next_attempt_at <= ? "
+                            "ORDER BY next_attempt_at, id LIMIT ?", (now, limit)).fetchall()
+        conn.executemany("UPDATE outbox SET status = 'sending', claimed_at = ? WHERE id = ? AND status = 'pending'",
+                         [(now, r[0]) for r in rows])
+    return rows
+
+
+def next_due_in(path=None):
+    """Seconds until the next pending row is due (None if there is none)."""
+    row = db.get_conn(path).execute("SELECT MIN(next_attempt_at) FROM outbox WHERE status = 'pending'").fetchone()
+    return None if row[0] is None else max(0.0, row[0] - time.time())
+
+
+def finish(path, outbox_id, status, error=None):
+    with db.transaction(path) as conn:
+        conn.execute("UPDATE outbox SET status = ?, last_error = ?, sent_at = CASE WHEN ? = 'sent' THEN CURRENT_TIMESTAMP END "
+                     "WHERE id = ? AND status = 'sending'", (status, error, status, outbox_id))
+
+
+def retry_later(path, outbox_id, attempts, error):
+    delay = RETRY_BASE_SECONDS * (2 ** (attempts - 1))
+    with db.transaction(path) as conn:
+        conn.execute("UPDATE outbox SET status = 'pending', attempts = ?, next_attempt_at = ?, last_error = ? "
+                     "WHERE id = ? AND status = 'sending'", (attempts, time.time() + delay, error, outbox_id))
+
+
+def counts(path=None):
+    return dict(db.get_conn(path).execute("SELECT status, COUNT(*) FROM outbox GROUP BY status").fetchall())
+
+
+# ---------- delivery ----------
+
+async def _deliver(bot, path, row):
+    from src.utils import db_executor
+    outbox_id, chat_id, text, attempts = row
+    if reachability.is_unreachable(chat_id):
+        _stats["skipped"] += 1
+        await db_executor.run_write(finish, path, outbox_id, "failed", "unreachable")
+        return
+    try:
+        await bot.send_message(chat_id, text)
+    except (Forbidden, BadRequest) as e:
+        _stats["failed"] += 1
+        await reachability.note_failure(chat_id, e, path)
+        await db_executor.run_write(finish, path, outbox_id, "failed", str(e)[:200])
+        return
+    except Exception as e:
+        attempts += 1
+        if attempts >= MAX_ATTEMPTS:
+            _stats["failed"] += 1
+            logging.warning("outbox %s to %s failed %d times: %s", outbox_id, chat_id, attempts, e)
+            await db_executor.run_write(finish, path, outbox_id, "failed", str(e)[:200])
+        else:
+            _stats["retried"] += 1
+            await db_executor.run_write(retry_later, path, outbox_id, attempts, str(e)[:200])
+        return
+    _stats["sent"] += 1
+    reachability.count("delivered")
+    await db_executor.run_write(finish, path, outbox_id, "sent")
+
+
+async def run_dispatcher(bot, path=None, idle=30.0):
+    """Background task: deliver due outbox rows, then sleep until the next is due or notify() is called."""
+    global _wake
+    from src.utils import db_executor
+    _wake = asyncio.Event()
+    while True:
+        _wake.clear()
+        try:
+            rows = await db_executor.run_write(claim_due, path)
+            if rows:
+                await asyncio.gather(*(_deliver(bot, path, r) for r in rows), return_exceptions=True)
+                continue
+            wait = await db_executor.run_read(next_due_in, path)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logging.exception("outbox dispatcher failed; retrying shortly")
+            wait = 5.0
+        try:
+            await asyncio.wait_for(_wake.wait(), idle if wait is None else min(wait, idle))
+        except asyncio.TimeoutError:
+            pass
+
+
+def stats():
+    return dict(_stats)
@@ -0,0 +1,135 @@
+"""Chats the bot can no longer reach, kept out of broadcasts and notifications.
+
+When Telegram answers a send with Forbidden ("bot was blocked by the user",
+"user is deactivated") or BadRequest "chat not found", the chat is stored in
+unreachable_chats (schema migration 9) and in a process-level dict loaded at
+startup, so later fan-outs skip it instead of spending rate budget on a
+guaranteed failure. Broadcast recipient queries exclude the table in SQL.
+
+A chat becomes reachable again as soon as the user writes to the bot or taps a
+button (note_interaction(), an in-memory check for everyone else).
+stats() feeds the delivery-health line of the admin panel.
+"""
+import logging
+import threading
+
+from telegram.error import Forbidden, BadRequest
+
+from src.utils import db
+
+_lock = threading.Lock()
+# chat_id -> reason ("blocked", "deactivated", "not_found")
+_unreachable = {}
+_stats = {"delivered": 0, "failed": 0, "skipped": 0, "marked": 0, "revived": 0}
+ready = False
+
+
+def classify(err):
+    """Reason string if `err` means the chat is gone for good, else None (transient or our own bug)."""
+    msg = str(err).lower()
+    if isinstance(err, Forbidden):
+        return "deactivated" if "deactivated" in msg else "blocked"
+    if isinstance(err, BadRequest) and ("chat not found" in msg or "user not found" in msg):
+        return "not_found"
+    return None
+
+
+def load(path=None):
+    global ready
+    conn = db.connect(path)
+    try:
+        rows = conn.execute("SELECT chat_id, reason FROM unreachable_chats").fetchall()
+    finally:
+        conn.close()
+    with _lock:
+        _unreachable.clear()
+        _unreachable.update(rows)
+    ready = True
+    logging.info("unreachable chats loaded: %d", len(rows))
+    return len(rows)
+
+
+def is_unreachable(chat_id):
+    with _lock:
+        return chat_id in _unreachable
+
+
+def mark_unreachable(chat_id, reason, error=None, path=None):
+    conn = db.connect(path)
+    try:
+        conn.execute("INSERT OR REPLACE INTO unreachable_chats (chat_id, reason, error, marked_at) VALUES (?, ?, ?, CURRENT_TIMESTAMP)",
+                     (chat_id, reason, (error or "")[:200]))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def mark_reachable(chat_id, path=None):
+    conn = db.connect(path)
+    try:
+        conn.execute("DELETE FROM unreachable_chats WHERE chat_id = ?", (chat_id,))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def count(kind):
+    """Count one delivery outcome ("delivered", "failed", "skipped") made outside send()."""
+    with _lock:
+        _stats[kind] += 1
+
+
+async def note_failure(chat_id, err, path=None):
+    """Record a failed send. Returns the reason if the chat was marked unreachable."""
+    from src.utils import db_executor
+    count("failed")
+    reason = classify(err)
+    if reason is None:
+        return None
+    with _lock:
+        known = _unreachable.get(chat_id) == reason
+        _unreachable[chat_id] = reason
+        if not known:
+            _stats["marked"] += 1
+    if not known:
+        logging.info("chat %s marked unreachable (%s): %s", chat_id, reason, err)
+        await db_executor.run_write(mark_unreachable, chat_id, reason, str(err), path)
+    return reason
+
+
+async def note_interaction(chat_id, path=None):
+    """The user talked to us: if the chat was marked unreachable, it is not any more."""
+    if chat_id is None:
+        return
+    from src.utils import db_executor
+    with _lock:
+        if _unreachable.pop(chat_id, None) is None:
+            return
+        _stats["revived"] += 1
+    try:
+        await db_executor.run_write(mark_reachable, chat_id, path)
+    except Exception:
+        logging.exception("could not clear unreachable flag for %s", chat_id)
+
+
+async def send(bot, chat_id, text, path=None, **kwargs):
+    """send_message unless the chat is known unreachable; records the outcome. Returns True if delivered."""
+    if is_unreachable(chat_id):
+        count("skipped")
+        return False
+    try:
+        await bot.send_message(chat_id, text, **kwargs)
+    except Exception as e:
+        await note_failure(chat_id, e, path)
+        logging.debug("could not deliver to %s: %s", chat_id, e)
+        return False
+    count("delivered")
+    return True
+
+
+def stats():
+    with _lock:
+        by_reason = {}
+        for reason in _unreachable.values():
+            by_reason[reason] = by_reason.get(reason, 0) + 1
+        return dict(_stats, unreachable=len(_unreachable), by_reason=by_reason)
@@ -0,0 +1,60 @@
+"""Short-lived cache of ranked search results, served page by page.
+
+A nearest-worker search keeps only the best MAX_RESULTS workers (top-K) and
+stores them here under the request id. The first PAGE_SIZE are sent right
+away; later pages (bot.py's prev/next carousel, khidmati.py's "more" button)
+are read back from this cache, so paging needs no new query or distance pass. Entries expire after
+TTL_SECONDS and the cache never holds more than MAX_ENTRIES searches.
+"""
+import os
+import time
+from collections import OrderedDict
+
+PAGE_SIZE = int(os.getenv("RESULT_PAGE_SIZE", "5"))
+MAX_RESULTS = int(os.getenv("RESULT_MAX_WORKERS", "50"))
+TTL_SECONDS = float(os.getenv("RESULT_PAGE_TTL", "900"))
+MAX_ENTRIES = int(os.getenv("RESULT_PAGE_MAX_ENTRIES", "2000"))
+
+_cache = OrderedDict()  # key -> (expires_at, items, meta)
+
+
+def _purge(now):
+    while _cache:
+        key, (expires_at, _, _) = next(iter(_cache.items()))
+        if expires_at > now and len(_cache) <= MAX_ENTRIES:
+            break
+        _cache.popitem(last=False)
+
+
+def put(key, items, **meta):
+    """Store the ranked `items` of one search (replacing any previous result for `key`)."""
+    now = time.monotonic()
+    key = str(key)
+    _cache.pop(key, None)
+    _cache[key] = (now + TTL_SECONDS, list(items), meta)
+    _purge(now)
+
+
+def get(key):
+    """Return (items, meta) for a live search, or None once it expired."""
+    now = time.monotonic()
+    _purge(now)
+    entry = _cache.get(str(key))
+    if entry is None:
+        return None
+    return entry[1], entry[2]
+
+
+def page(key, n, size=PAGE_SIZE):
+    """Return (items_on_page, start_index, total, has_more, meta) for page `n`, or None if expired."""
+    found = get(key)
+    if found is None:
+        return None
+    items, meta = found
+    start = max(0, n) * size
+    chunk = items[start:start + size]
+    return chunk, start, len(items), start + size < len(items), meta
+
+
+def drop(key):
+    _cache.pop(str(key), None)
@@ -0,0 +1,100 @@
+"""Precompiled routing table for free-text messages (handle_buttons).
+
+A text message used to walk a long if-chain of substring and membership tests
+before it reached the branch that handles it. Router builds the lookups once
+and resolves a message with a few dict probes, in this order:
+
+1. admin commands -- the first word of the message (``conf``, ``sta``), only for
+   the admin; "station" or "confirm" are ordinary words again;
+2. menu labels -- exact (lower-cased) button texts, whatever the conversation;
+3. conversation steps -- ``(role, step)`` of the user's current state;
+4. idle labels -- exact texts (service names) that start a conversation when
+   the user has none, and an optional route for bare numbers (request ids);
+5. the fallback.
+
+Handlers are ``async def handler(ctx)``; a handler may return False to let the
+message continue to the next stage. Each resolved route counts a hit (stats()
+feeds the admin panel).
+"""
+import logging
+import threading
+
+FALLBACK = "fallback"
+
+_lock = threading.Lock()
+
+
+class Route:
+    __slots__ = ("name", "handler", "when")
+
+    def __init__(self, name, handler, when=None):
+        self.name, self.handler, self.when = name, handler, when
+
+
+class Router:
+    def __init__(self, fallback):
+        self.admin = {}      # first word -> Route
+        self.labels = {}     # lower-cased exact text -> Route
+        self.steps = {}      # (role, step) -> Route
+        self.idle = {}       # exact text -> Route, only without a conversation state
+        self.idle_number = None  # Route for digits-only text without a conversation state
+        self.fallback = Route(FALLBACK, fallback)
+        self.hits = {}
+
+    def _add(self, table, keys, route):
+        for key in keys:
+            if key in table and table[key].name != route.name:
+                logging.warning("router: %r routed to %s, was %s", key, route.name, table[key].name)
+            table[key] = route
+
+    def command(self, name, handler, *words, when=None):
+        """Admin command matched on the first word; `when(ctx)` may veto it."""
+        self._add(self.admin, [w.lower() for w in words], Route(name, handler, when))
+
+    def label(self, name, handler, *labels):
+        self._add(self.labels, [l.lower() for l in labels], Route(name, handler))
+
+    def step(self, name, handler, role, *steps):
+        self._add(self.steps, [(role, s) for s in steps], Route(name, handler))
+
+    def idle_label(self, name, handler, *labels):
+        self._add(self.idle, labels, Route(name, handler))
+
+    def number(self, name, handler):
+        self.idle_number = Route(name, handler)
+
+    def candidates(self, text, text_l, state, is_admin):
+        """Routes to try for a message, best first (at most one per stage), then the fallback."""
+        if is_admin and text_l:
+            route = self.admin.get(text_l.split(None, 1)[0])
+            if route is not None:
+                yield route
+        route = self.labels.get(text_l)
+        if route is not None:
+            yield route
+        if state:
+            route = self.steps.get((state.get("role"), state.get("step")))
+            if route is not None:
+                yield route
+        else:
+            route = self.idle.get(text)
+            if route is not None:
+                yield route
+            elif self.idle_number is not None and text.isdigit():
+                yield self.idle_number
+        yield self.fallback
+
+    async def dispatch(self, ctx, text, text_l, state, is_admin=False):
+        """Run the first route that handles the message. Returns the route name."""
+        for route in self.candidates(text, text_l, state, is_admin):
+            if route.when is not None and not route.when(ctx):
+                continue
+            if await route.handler(ctx) is False:
+                continue
+            with _lock:
+                self.hits[route.name] = self.hits.get(route.name, 0) + 1
+            return route.name
+
+    def stats(self):
+        with _lock:
+            return dict(self.hits)
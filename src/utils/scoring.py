@@ -0,0 +1,120 @@
+"""Batched distance scoring for nearest-worker searches.
+
+Both bots rank candidates the same way: keep workers within radius_km of the
+client and sort by (-subscription_level, distance). Instead of one
+calc_distance()/haversine() call (and try/except) per row, rank() takes the
+candidate coordinates as columns and scores them in one pass — vectorised with
+NumPy when it is installed and the batch is big enough to pay for the array
+conversion, otherwise with a tight pure-Python loop. Both paths return the same
+ranking as the old per-row code (including its stable ordering of ties).
+
+Rows with a missing/invalid location get a NaN distance and are dropped, like
+the old inf/99999 sentinel values were.
+"""
+import math
+import heapq
+
+try:
+    import numpy as np
+except ImportError:  # optional: the pure-Python path gives the same answer
+    np = None
+
+from src.utils.geo import EARTH_RADIUS_KM
+
+# below this many candidates building the arrays costs more than the loop
+NUMPY_MIN_ROWS = 64
+
+
+def _as_float(v):
+    try:
+        return float(v)
+    except (TypeError, ValueError):
+        return math.nan
+
+
+def _as_level(v):
+    try:
+        return int(v or 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+def _column(values, convert):
+    # None becomes NaN in a float array; fall back per element for odd values (e.g. bad strings)
+    try:
+        return np.asarray(values, dtype=float)
+    except (TypeError, ValueError):
+        return np.array([convert(v) for v in values], dtype=float)
+
+
+def _rank_numpy(lat, lon, lats, lons, levels, radius_km, radians, k=None):
+    phi2 = _column(lats, _as_float)
+    lam2 = _column(lons, _as_float)
+    if not radians:
+        phi2 = np.radians(phi2)
+        lam2 = np.radians(lam2)
+    lvl = np.nan_to_num(_column(levels, _as_level)).astype(np.int64)
+    phi1 = math.radians(lat)
+    lam1 = math.radians(lon)
+    a = np.sin((phi2 - phi1) / 2) ** 2 + math.cos(phi1) * np.cos(phi2) * np.sin((lam2 - lam1) / 2) ** 2
+    dist = EARTH_RADIUS_KM * 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+    with np.errstate(invalid="ignore"):
+        keep = np.flatnonzero(dist <= radius_km)
+    if k is not None and len(keep) > k:
+        # top-K: (-level, distance) folded into one float (distance < span), partitioned
+        # around the k-th key; ties with it stay in so the stable sort below picks them
+        span = float(radius_km) + 1.0
+        key = dist[keep] - lvl[keep] * span
+        kth = np.partition(key, k - 1)[k - 1]
+        keep = keep[key <= kth]
+    # lexsort is stable and sorts by the last key first: level desc, then distance
+    order = keep[np.lexsort((dist[keep], -lvl[keep]))]
+    if k is not None:
+        order = order[:k]
+    return list(zip(order.tolist(), dist[order].tolist(), lvl[order].tolist()))
+
+
+def _rank_python(lat, lon, lats, lons, levels, radius_km, radians, k=None):
+    phi1 = math.radians(lat)
+    lam1 = math.radians(lon)
+    cos1 = math.cos(phi1)
+    sin, cos, atan2, sqrt, to_rad = math.sin, math.cos, math.atan2, math.sqrt, math.radians
+    hits = []
+    for i in range(len(lats)):
+        if radians:
+            phi2, lam2 = lats[i], lons[i]
+        else:
+            try:
+                phi2, lam2 = to_rad(lats[i]), to_rad(lons[i])
+            except TypeError:
+                # None (missing location) or a numeric string from an old row
+                phi2, lam2 = to_rad(_as_float(lats[i])), to_rad(_as_float(lons[i]))
+                if phi2 != phi2 or lam2 != lam2:
+                    continue
+        a = sin((phi2 - phi1) / 2) ** 2 + cos1 * cos(phi2) * sin((lam2 - lam1) / 2) ** 2
+        d = 2 * EARTH_RADIUS_KM * atan2(sqrt(a), sqrt(1 - a))
+        if d <= radius_km:
+            level = _as_level(levels[i])
+            # the row index as last key keeps equal (level, distance) pairs in input order
+            hits.append((-level, d, i))
+    if k is not None and len(hits) > k:
+        # heap selection: O(n log k) instead of sorting every match
+        hits = heapq.nsmallest(k, hits)
+    else:
+        hits.sort()
+    return [(i, d, -neg_level) for neg_level, d, i in hits]
+
+
+def rank(lat, lon, lats, lons, levels, radius_km, radians=False, k=None):
+    """Score candidates around (lat, lon) and return [(row_index, dist_km, level), ...].
+
+    `lats`/`lons`/`levels` are parallel sequences (lists or arrays); coordinates
+    are degrees unless `radians` is set. Only rows within radius_km are returned,
+    ordered by (-level, distance); equal keys keep their input order. With `k`
+    only the best k rows are selected (heap / partition), not a full sort.
+    """
+    if not len(lats):
+        return []
+    if np is not None and len(lats) >= NUMPY_MIN_ROWS:
+        return _rank_numpy(lat, lon, lats, lons, levels, radius_km, radians, k)
+    return _rank_python(lat, lon, lats, lons, levels, radius_km, radians, k)
@@ -0,0 +1,100 @@
+"""LRU/TTL cache of nearest-worker candidates per (service, edu_type, grid cell).
+
+Clients in the same neighbourhood searching the same service within minutes
+share one candidate list: it holds every worker that can be within radius_km
+of *any* point of the client's grid cell (src/utils/geo.py), so each search only
+re-ranks that short list by its exact distance. Empty lists are cached too, so
+"no workers for this service here" answers without touching the database.
+
+Entries expire after TTL_SECONDS; at most MAX_ENTRIES are kept (least recently
+used dropped first). invalidate() drops the entries that cover a worker's cell
+whenever it registers, moves or changes subscription (see
+worker_index.reload_worker).
+"""
+import os
+import time
+import threading
+from collections import OrderedDict
+
+from src.utils import geo
+
+TTL_SECONDS = float(os.getenv("SEARCH_CACHE_TTL", "120"))
+MAX_ENTRIES = int(os.getenv("SEARCH_CACHE_MAX_ENTRIES", "1000"))
+
+_lock = threading.Lock()
+# (service, edu_type, cell, radius_km) -> (expires_at, candidates, covered_cells)
+_entries = OrderedDict()
+_stats = {"hits": 0, "misses": 0, "invalidated": 0}
+# bumped on every invalidation; a load that raced with one is not stored
+_generation = 0
+
+
+def neighbourhood(cell, radius_km):
+    """Return (centre_lat, centre_lon, reach_km): a circle holding every worker any client in `cell` can reach."""
+    lat, lon = geo.cell_center(cell)
+    return lat, lon, radius_km + geo.CELL_HALF_DIAG_KM + 1.0
+
+
+def generation():
+    """Take before loading candidates on a miss and pass to put()."""
+    return _generation
+
+
+def get(service, edu_type, cell, radius_km):
+    """Return the cached candidate list (possibly empty) or None on a miss."""
+    key = (service, edu_type, cell, radius_km)
+    now = time.monotonic()
+    with _lock:
+        entry = _entries.get(key)
+        if entry is None or entry[0] <= now:
+            if entry is not None:
+                del _entries[key]
+            _stats["misses"] += 1
+            return None
+        _entries.move_to_end(key)
+        _stats["hits"] += 1
+        return entry[1]
+
+
+def put(service, edu_type, cell, radius_km, candidates, gen=None):
+    """Cache candidates; skipped when a worker changed since generation() was `gen`."""
+    lat, lon, reach = neighbourhood(cell, radius_km)
+    covered = frozenset(geo.cells_for_radius(lat, lon, reach))
+    with _lock:
+        if gen is not None and gen != _generation:
+            return
+        _entries[(service, edu_type, cell, radius_km)] = (time.monotonic() + TTL_SECONDS, list(candidates), covered)
+        _entries.move_to_end((service, edu_type, cell, radius_km))
+        while len(_entries) > MAX_ENTRIES:
+            _entries.popitem(last=False)
+
+
+def invalidate(service=None, cell=None):
+    """Drop cached searches of `service` whose neighbourhood covers `cell`.
+
+    Without a cell every entry of the service goes; without a service every
+    entry covering the cell goes; with neither the whole cache is cleared.
+    """
+    global _generation
+    with _lock:
+        _generation += 1
+        if service is None and cell is None:
+            dropped = len(_entries)
+            _entries.clear()
+        else:
+            stale = [k for k, (_, _, covered) in _entries.items()
+                     if (service is None or k[0] == service) and (cell is None or cell in covered)]
+            for k in stale:
+                del _entries[k]
+            dropped = len(stale)
+        _stats["invalidated"] += dropped
+    return dropped
+
+
+def clear():
+    return invalidate()
+
+
+def stats():
+    with _lock:
+        return dict(_stats, entries=len(_entries))
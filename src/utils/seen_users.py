@@ -0,0 +1,68 @@
+"""Process-level set of users the bot has already greeted.
+
+handle_buttons asks "is this user new?" on every text message. The answer is
+almost always no, so the ids from seen_users are loaded into a set once at
+startup (load()) and a known user is answered from memory without touching
+SQLite. Only a miss goes to the database: INSERT OR IGNORE both records a
+genuinely new user and tells us whether someone else (an earlier run, the
+other bot) already did. An exact set costs well under 100 bytes per user,
+which is fine for this bot's user base; no probabilistic filter is needed.
+"""
+import logging
+import threading
+
+from src.utils import db
+
+_ids = set()
+_lock = threading.Lock()
+_stats = {"hits": 0, "misses": 0, "new_users": 0}
+ready = False
+
+
+def load(path=None):
+    """Warm the set from seen_users. Safe to call again (e.g. after a restore)."""
+    global ready
+    conn = db.connect(path)
+    try:
+        ids = {r[0] for r in conn.execute("SELECT user_id FROM seen_users")}
+    finally:
+        conn.close()
+    with _lock:
+        _ids.update(ids)
+    ready = True
+    logging.info("seen users loaded: %d", len(ids))
+    return len(ids)
+
+
+def is_known(user_id):
+    """Answer from memory only: True if the user is known to have been seen (counts a hit)."""
+    with _lock:
+        if user_id in _ids:
+            _stats["hits"] += 1
+            return True
+    return False
+
+
+def mark_seen(user_id, path=None):
+    """Return True if this is the first time we've seen this user (inserted), False otherwise."""
+    if is_known(user_id):
+        return False
+    with _lock:
+        _stats["misses"] += 1
+    conn = db.connect(path)
+    try:
+        cur = conn.execute("INSERT OR IGNORE INTO seen_users (user_id) VALUES (?)", (user_id,))
+        conn.commit()
+        new = cur.rowcount == 1
+    finally:
+        conn.close()
+    with _lock:
+        _ids.add(user_id)
+        if new:
+            _stats["new_users"] += 1
+    return new
+
+
+def stats():
+    with _lock:
+        return dict(_stats, size=len(_ids))
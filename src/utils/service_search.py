@@ -0,0 +1,101 @@
+"""Typo-tolerant service search for text that matched no button.
+
+A client who types "سباكه", "كهربائي" or "تنضيف سجاد" instead of pressing a
+button used to get "لم أفهم". TrigramIndex keeps the trigrams of every
+catalogue label (services, categories, aliases), normalised with
+src/utils/labels.py, plus taa marbuta folded to ha and the article removed, in
+posting lists. A query only touches the postings of its own trigrams and
+ranks labels by a blend of Dice similarity and how much of the query they
+cover. Each service is suggested once, and only above MIN_SCORE.
+
+build() is called once at startup with (label, service) pairs and returns the
+same index until the catalogue changes.
+"""
+import os
+import heapq
+
+from src.utils import labels
+
+MIN_SCORE = float(os.getenv("SERVICE_SEARCH_MIN_SCORE", "0.35"))
+MAX_SUGGESTIONS = int(os.getenv("SERVICE_SEARCH_MAX_SUGGESTIONS", "3"))
+
+_index = None
+_signature = None
+_stats = {"queries": 0, "suggested": 0}
+
+
+def search_key(text):
+    """Normalised form used for trigrams: no emoji, hamza, diacritics, article; ة -> ه."""
+    return labels.strip_definite_article(labels.normalize(text)).replace("ة", "ه")
+
+
+def trigrams(text):
+    grams = set()
+    for word in search_key(text).split():
+        padded = f" {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+class TrigramIndex:
+    def __init__(self, pairs):
+        self.values = []      # entry id -> service the label stands for
+        self.sizes = []       # entry id -> number of trigrams
+        self.postings = {}    # trigram -> [entry id]
+        seen = set()
+        for label, value in pairs:
+            grams = trigrams(label)
+            if not grams or (search_key(label), value) in seen:
+                continue
+            seen.add((search_key(label), value))
+            eid = len(self.values)
+            self.values.append(value)
+            self.sizes.append(len(grams))
+            for g in grams:
+                self.postings.setdefault(g, []).append(eid)
+
+    def search(self, query, limit=MAX_SUGGESTIONS, min_score=MIN_SCORE):
+        """Best matching services for `query`, best first: [(service, score)]."""
+        qgrams = trigrams(query)
+        if not qgrams:
+            return []
+        common = {}
+        for g in qgrams:
+            for eid in self.postings.get(g, ()):
+                common[eid] = common.get(eid, 0) + 1
+        best = {}
+        q = len(qgrams)
+        for eid, n in common.items():
+            # similarity of the whole labels, and how much of what was typed the label explains
+            score = 0.5 * (2.0 * n / (q + self.sizes[eid])) + 0.5 * (n / q)
+            value = self.values[eid]
+            if score >= min_score and score > best.get(value, 0.0):
+                best[value] = score
+        return heapq.nlargest(limit, best.items(), key=lambda kv: kv[1])
+
+    def __len__(self):
+        return len(self.values)
+
+
+def build(pairs):
+    """Index for the (label, service) catalogue; rebuilt only when the catalogue changed."""
+    global _index, _signature
+    pairs = tuple(pairs)
+    if _index is None or pairs != _signature:
+        _index, _signature = TrigramIndex(pairs), pairs
+    return _index
+
+
+def suggest(query, limit=MAX_SUGGESTIONS):
+    """Service names for `query` from the last built index ([] before build())."""
+    if _index is None:
+        return []
+    found = [value for value, _ in _index.search(query, limit)]
+    _stats["queries"] += 1
+    if found:
+        _stats["suggested"] += 1
+    return found
+
+
+def stats():
+    return dict(_stats, entries=len(_index) if _index is not None else 0)
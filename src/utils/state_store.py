@@ -0,0 +1,221 @@
+"""Conversation state per user, bounded in memory and persisted in SQLite.
+
+StateStore replaces the process-global ``user_states = {}`` dict of both bots
+and keeps its interface (``st = user_states.get(uid)``, ``user_states[uid] =
+st``, ``.pop(uid, None)``, ``uid in user_states``), so handlers keep mutating
+the dict they got back.
+
+- Every state that was read or written is serialised by the background flusher
+  (run_flusher, every FLUSH_SECONDS and on shutdown) and upserted into
+  conversation_states (schema migration 11) when its compact JSON changed, so a
+  restart resumes every conversation at the same step. A state stays watched
+  until a pass finds it unchanged WATCH_SECONDS after its last access, so a
+  handler that changes it after an await is still saved. Each bot uses its own
+  scope, the two processes never see each other's states.
+- A conversation idle for TTL_SECONDS is dropped from memory and the database.
+- Above MAX_ENTRIES the least recently used states are written and dropped from
+  memory only; they are read back (one primary-key lookup) if the user returns.
+
+stats() reports size, hits and evictions for the admin panel.
+"""
+import os
+import json
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from collections.abc import MutableMapping
+
+from src.utils import db
+
+TTL_SECONDS = float(os.getenv("CONVERSATION_TTL_SECONDS", str(6 * 3600)))
+MAX_ENTRIES = int(os.getenv("CONVERSATION_MAX_ENTRIES", "20000"))
+FLUSH_SECONDS = float(os.getenv("CONVERSATION_FLUSH_SECONDS", "1"))
+# a state stays watched this long after its last access: handlers change it after an await
+WATCH_SECONDS = float(os.getenv("CONVERSATION_WATCH_SECONDS", "60"))
+
+
+def _dumps(state):
+    try:
+        return json.dumps(state, ensure_ascii=False, separators=(",", ":"))
+    except (TypeError, ValueError):
+        # keep what can be stored; the rest lives in memory only
+        clean = {}
+        for k, v in state.items():
+            try:
+                json.dumps(v)
+                clean[k] = v
+            except (TypeError, ValueError):
+                logging.debug("state key %r is not JSON-serialisable; not persisted", k)
+        return json.dumps(clean, ensure_ascii=False, separators=(",", ":"))
+
+
+class StateStore(MutableMapping):
+    def __init__(self, scope, path=None, ttl=TTL_SECONDS, max_entries=MAX_ENTRIES):
+        self.scope = scope
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._data = OrderedDict()   # user_id -> state, least recently used first
+        self._seen = {}              # user_id -> monotonic time of last access
+        self._saved = {}             # user_id -> hash of the JSON last written
+        self._touched = set()        # accessed recently (may still be mutated by a handler)
+        self._deleted = set()        # popped since the last flush
+        self._spilled = set()        # stored in the database only
+        self._stats = {"hits": 0, "loaded": 0, "expired": 0, "spilled": 0, "written": 0}
+        self.ready = False
+
+    # ---------- mapping interface ----------
+
+    def _touch(self, user_id):
+        self._data.move_to_end(user_id)
+        self._seen[user_id] = time.monotonic()
+        self._touched.add(user_id)
+
+    def _unspill(self, user_id):
+        if user_id not in self._spilled:
+            return False
+        self._spilled.discard(user_id)
+        row = db.get_conn(self.path).execute(
+            "SELECT state FROM conversation_states WHERE scope = ? AND user_id = ?", (self.scope, user_id)).fetchone()
+        if row is None:
+            return False
+        self._data[user_id] = json.loads(row[0])
+        self._saved[user_id] = hash(row[0])
+        self._stats["loaded"] += 1
+        return True
+
+    def __getitem__(self, user_id):
+        if user_id not in self._data and not self._unspill(user_id):
+            raise KeyError(user_id)
+        self._stats["hits"] += 1
+        self._touch(user_id)
+        return self._data[user_id]
+
+    def __setitem__(self, user_id, state):
+        self._spilled.discard(user_id)
+        self._deleted.discard(user_id)
+        self._data[user_id] = state
+        self._touch(user_id)
+
+    def __delitem__(self, user_id):
+        if user_id not in self._data and not self._unspill(user_id):
+            raise KeyError(user_id)
+        del self._data[user_id]
+        self._seen.pop(user_id, None)
+        self._saved.pop(user_id, None)
+        self._touched.discard(user_id)
+        self._deleted.add(user_id)
+
+    def __contains__(self, user_id):
+        return user_id in self._data or user_id in self._spilled
+
+    def __iter__(self):
+        return iter(list(self._data))
+
+    def __len__(self):
+        return len(self._data) + len(self._spilled)
+
+    # ---------- persistence ----------
+
+    def load(self):
+        """Restore unexpired conversations (newest first, up to max_entries in memory)."""
+        cutoff = time.time() - self.ttl
+        with db.transaction(self.path) as conn:
+            conn.execute("DELETE FROM conversation_states WHERE scope = ? AND updated_at < ?", (self.scope, cutoff))
+            rows = conn.execute("SELECT user_id, state, updated_at FROM conversation_states WHERE scope = ? "
+                                "ORDER BY updated_at DESC", (self.scope,)).fetchall()
+        now_wall, now = time.time(), time.monotonic()
+        for i, (user_id, state, updated_at) in enumerate(reversed(rows)):
+            if i < len(rows) - self.max_entries:
+                self._spilled.add(user_id)
+                continue
+            self._data[user_id] = json.loads(state)
+            self._saved[user_id] = hash(state)
+            # idle time carries over the restart
+            self._seen[user_id] = now - (now_wall - updated_at)
+        self.ready = True
+        logging.info("conversation states restored for %s: %d", self.scope, len(rows))
+        return len(rows)
+
+    def _collect(self):
+        """Take (upserts, deletes) from memory; expire and spill while at it. Runs on the event loop."""
+        now = time.monotonic()
+        wall = time.time()
+        # idle conversations, oldest first
+        for user_id in list(self._data):
+            if now - self._seen.get(user_id, now) < self.ttl:
+                break
+            del self[user_id]
+            self._stats["expired"] += 1
+        upserts = []
+        settled = []
+        for user_id in self._touched:
+            state = self._data.get(user_id)
+            if state is None:
+                settled.append(user_id)
+                continue
+            blob = _dumps(state)
+            h = hash(blob)
+            if self._saved.get(user_id) != h:
+                self._saved[user_id] = h
+                upserts.append((self.scope, user_id, blob, wall - (now - self._seen[user_id])))
+            elif now - self._seen[user_id] >= WATCH_SECONDS:
+                # unchanged and nobody has read it for a while: the handler that had it is done
+                settled.append(user_id)
+        self._touched.difference_update(settled)
+        deletes = [(self.scope, user_id) for user_id in self._deleted]
+        self._deleted.clear()
+        # over the cap: the least recently used are already written above (or unchanged)
+        while len(self._data) > self.max_entries:
+            user_id, state = self._data.popitem(last=False)
+            if self._saved.get(user_id) is None:
+                upserts.append((self.scope, user_id, _dumps(state), wall - (now - self._seen[user_id])))
+            self._seen.pop(user_id, None)
+            self._saved.pop(user_id, None)
+            self._spilled.add(user_id)
+            self._stats["spilled"] += 1
+        return upserts, deletes
+
+    def _write(self, upserts, deletes):
+        with db.transaction(self.path) as conn:
+            if upserts:
+                conn.executemany("INSERT OR REPLACE INTO conversation_states (scope, user_id, state, updated_at) VALUES (?, ?, ?, ?)",
+                                 upserts)
+            if deletes:
+                conn.executemany("DELETE FROM conversation_states WHERE scope = ? AND user_id = ?", deletes)
+        self._stats["written"] += len(upserts)
+        return len(upserts) + len(deletes)
+
+    def flush(self):
+        """Write pending changes synchronously (shutdown, scripts)."""
+        upserts, deletes = self._collect()
+        if upserts or deletes:
+            return self._write(upserts, deletes)
+        return 0
+
+    async def run_flusher(self, interval=FLUSH_SECONDS):
+        """Background task: persist changed states every `interval` seconds."""
+        from src.utils import db_executor
+        while True:
+            await asyncio.sleep(interval)
+            upserts, deletes = self._collect()
+            if not (upserts or deletes):
+                continue
+            try:
+                await db_executor.run_write(self._write, upserts, deletes)
+            except Exception:
+                logging.exception("conversation state flush failed; will retry")
+                # make the next pass write them again (spilled states go back to memory first)
+                for _, user_id, blob, _ in upserts:
+                    self._saved.pop(user_id, None)
+                    if user_id in self._spilled:
+                        self._spilled.discard(user_id)
+                        self._data[user_id] = json.loads(blob)
+                        self._seen[user_id] = time.monotonic()
+                    if user_id in self._data:
+                        self._touched.add(user_id)
+                self._deleted.update(user_id for _, user_id in deletes)
+
+    def stats(self):
+        return dict(self._stats, size=len(self._data), spilled_now=len(self._spilled))
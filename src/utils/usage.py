@@ -0,0 +1,54 @@
+"""Constant-time usage statistics (usage_stats.total_users / total_requests).
+
+Distinct requesters are kept in the `requesters` table (user_id is its
+primary key), so deciding whether a request comes from a new user is one
+INSERT OR IGNORE instead of a COUNT(*) over clients. record_request() must run
+on the connection / transaction that inserts the clients row, so the request
+and the counters commit together.
+
+backfill() recomputes everything from clients; run it with
+
+    python -m src.utils.usage [path/to/data.db]
+"""
+import sys
+import logging
+
+from src.utils import db
+
+
+def record_request(conn, user_id):
+    """Count one new request (and a new user the first time `user_id` asks). Returns True for a new user."""
+    new_user = False
+    if user_id is not None:
+        cur = conn.execute("INSERT OR IGNORE INTO requesters (user_id) VALUES (?)", (user_id,))
+        new_user = cur.rowcount == 1
+    conn.execute("UPDATE usage_stats SET total_users = COALESCE(total_users,0) + ?, total_requests = COALESCE(total_requests,0) + 1 WHERE id = 1",
+                 (1 if new_user else 0,))
+    return new_user
+
+
+def backfill_conn(conn):
+    """Rebuild requesters and usage_stats from clients on an open transaction."""
+    conn.execute("DELETE FROM requesters")
+    conn.execute("INSERT INTO requesters (user_id, first_request_at) "
+                 "SELECT user_id, MIN(created_at) FROM clients WHERE user_id IS NOT NULL GROUP BY user_id")
+    conn.execute("INSERT OR IGNORE INTO usage_stats (id, total_users, total_requests) VALUES (1,0,0)")
+    conn.execute("UPDATE usage_stats SET total_users = (SELECT COUNT(*) FROM requesters), "
+                 "total_requests = (SELECT COUNT(*) FROM clients) WHERE id = 1")
+    return conn.execute("SELECT total_users, total_requests FROM usage_stats WHERE id = 1").fetchone()
+
+
+def backfill(path=None):
+    with db.transaction(path) as conn:
+        users, requests = backfill_conn(conn)
+    logging.info("usage_stats rebuilt: %s users, %s requests", users, requests)
+    return users, requests
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    from src.utils import migrations
+    path = sys.argv[1] if len(sys.argv) > 1 else None
+    migrations.migrate(path)
+    users, requests = backfill(path)
+    print(f"total_users={users} total_requests={requests}")
@@ -0,0 +1,243 @@
+"""Resident geo index of every worker that has a location.
+
+Nearest-worker lookup is the hottest read path, so bot.py keeps all located
+workers in memory, bucketed by work_type -> education_type -> grid cell
+(src/utils/geo.py). Each bucket stores compact parallel arrays (user ids,
+lat/lon in radians, subscription level) instead of a dict per row; the
+displayed card fields live in one tuple per worker.
+
+The index is loaded once at startup and updated incrementally by
+save_worker_to_db and coupon redemption (reload_worker). Writes made by the
+other process (khidmati.py shares data.db) are picked up by a periodic full
+resync (run_resync / RESYNC_SECONDS).
+"""
+import os
+import math
+import time
+import asyncio
+import logging
+import threading
+from array import array
+
+from src.utils import db, geo, scoring, search_cache
+
+RESYNC_SECONDS = float(os.getenv("WORKER_INDEX_RESYNC_SECONDS", "300"))
+
+_SELECT = ("SELECT user_id, id, name, phone, work_type, education_type, lat, lon, "
+           "subscription_level, subscription_expiry, worker_code FROM workers")
+
+
+class _Bucket:
+    """Parallel arrays for the workers of one (work_type, education_type, cell)."""
+    __slots__ = ("ids", "lat", "lon", "level", "pos")
+
+    def __init__(self):
+        self.ids = array("q")
+        self.lat = array("d")
+        self.lon = array("d")
+        self.level = array("i")
+        self.pos = {}  # user_id -> index in the arrays
+
+    def add(self, uid, lat_r, lon_r, level):
+        self.pos[uid] = len(self.ids)
+        self.ids.append(uid)
+        self.lat.append(lat_r)
+        self.lon.append(lon_r)
+        self.level.append(level)
+
+    def remove(self, uid):
+        i = self.pos.pop(uid, None)
+        if i is None:
+            return
+        last = len(self.ids) - 1
+        if i != last:
+            # move the last entry into the hole so the arrays stay dense
+            moved = self.ids[last]
+            self.ids[i] = moved
+            self.lat[i] = self.lat[last]
+            self.lon[i] = self.lon[last]
+            self.level[i] = self.level[last]
+            self.pos[moved] = i
+        for col in (self.ids, self.lat, self.lon, self.level):
+            col.pop()
+
+    def __len__(self):
+        return len(self.ids)
+
+
+class WorkerGeoIndex:
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._buckets = {}  # work_type -> {education_type: {cell: _Bucket}}
+        self._where = {}    # user_id -> (work_type, education_type, cell)
+        self._cards = {}    # user_id -> (id, name, phone, work_type, lat, lon, expiry, worker_code)
+        self.ready = False
+        self.loaded_at = 0.0
+        # rows upserted while a rebuild is reading the table; replayed on top of it
+        self._during_rebuild = None
+
+    def __len__(self):
+        return len(self._where)
+
+    def where(self, uid):
+        """Return (work_type, education_type, cell) of an indexed worker, or None."""
+        with self._lock:
+            return self._where.get(uid)
+
+    # ---- maintenance ----
+    def _remove(self, uid):
+        where = self._where.pop(uid, None)
+        self._cards.pop(uid, None)
+        if not where:
+            return
+        wt, edu, cell = where
+        cells = self._buckets.get(wt, {}).get(edu, {})
+        bucket = cells.get(cell)
+        if bucket is not None:
+            bucket.remove(uid)
+            if not len(bucket):
+                del cells[cell]
+
+    def _add_row(self, row):
+        uid, rid, name, phone, work_type, edu, lat, lon, level, expiry, wcode = row
+        cell = geo.cell_of(lat, lon)
+        if cell is None or uid is None or not work_type:
+            return
+        try:
+            level = int(level or 0)
+        except (TypeError, ValueError):
+            level = 0
+        bucket = self._buckets.setdefault(work_type, {}).setdefault(edu, {}).get(cell)
+        if bucket is None:
+            bucket = self._buckets[work_type][edu][cell] = _Bucket()
+        bucket.add(uid, math.radians(lat), math.radians(lon), level)
+        self._where[uid] = (work_type, edu, cell)
+        self._cards[uid] = (rid, name, phone, work_type, lat, lon, expiry, wcode)
+
+    def begin_rebuild(self):
+        with self._lock:
+            self._during_rebuild = {}
+
+    def rebuild(self, rows):
+        """Replace the whole index with `rows` (tuples in _SELECT column order)."""
+        fresh = WorkerGeoIndex()
+        for row in rows:
+            fresh._add_row(row)
+        with self._lock:
+            for uid, row in (self._during_rebuild or {}).items():
+                fresh._remove(uid)
+                if row is not None:
+                    fresh._add_row(row)
+            self._during_rebuild = None
+            self._buckets, self._where, self._cards = fresh._buckets, fresh._where, fresh._cards
+            self.ready = True
+            self.loaded_at = time.monotonic()
+
+    def upsert_row(self, row):
+        with self._lock:
+            if self._during_rebuild is not None:
+                self._during_rebuild[row[0]] = row
+            self._remove(row[0])
+            self._add_row(row)
+
+    def remove(self, uid):
+        with self._lock:
+            if self._during_rebuild is not None:
+                self._during_rebuild[uid] = None
+            self._remove(uid)
+
+    # ---- queries ----
+    def candidates(self, work_type, edu_type, lat, lon, radius_km):
+        """Return (user_ids, lat_r, lon_r, levels) arrays of every bucket that may hold a match."""
+        with self._lock:
+            by_edu = self._buckets.get(work_type)
+            if not by_edu:
+                return []
+            edus = [by_edu.get(edu_type, {})] if edu_type else list(by_edu.values())
+            out = []
+            for cell in geo.cells_for_radius(lat, lon, radius_km):
+                for cells in edus:
+                    b = cells.get(cell)
+                    if b is not None and len(b):
+                        # copies, so callers can score them without holding the lock
+                        out.append((array("q", b.ids), array("d", b.lat), array("d", b.lon), array("i", b.level)))
+            return out
+
+    def nearest(self, work_type, edu_type, lat, lon, radius_km, k=None):
+        """Return worker dicts within radius_km, sorted by (-subscription_level, distance); at most k."""
+        ids, lats, lons, levels = array("q"), array("d"), array("d"), array("i")
+        for b_ids, b_lat, b_lon, b_level in self.candidates(work_type, edu_type, lat, lon, radius_km):
+            ids += b_ids; lats += b_lat; lons += b_lon; levels += b_level
+        ranked = scoring.rank(lat, lon, lats, lons, levels, radius_km, radians=True, k=k)
+        return [self.card(ids[i], level, d) for i, d, level in ranked]
+
+    def card(self, uid, level, dist_km):
+        rid, name, phone, work_type, lat, lon, expiry, wcode = self._cards.get(uid) or (None,) * 8
+        return {
+            "id": rid,
+            "user_id": uid,
+            "name": name,
+            "phone": phone,
+            "work_type": work_type,
+            "location": (lat, lon),
+            "subscription_level": level,
+            "subscription_expiry": expiry,
+            "worker_code": wcode,
+            "dist_km": dist_km,
+        }
+
+
+# process-wide index used by bot.py
+index = WorkerGeoIndex()
+
+
+def load(path=None):
+    """(Re)build the index from the database. Safe to call from any thread."""
+    index.begin_rebuild()
+    conn = db.connect(path)
+    try:
+        rows = conn.execute(_SELECT + " WHERE geo_cell IS NOT NULL").fetchall()
+    finally:
+        conn.close()
+    index.rebuild(rows)
+    logging.info("worker geo index loaded: %d located workers", len(index))
+    return len(index)
+
+
+def reload_worker(conn, user_id):
+    """Refresh one worker from the DB after it registered, moved or changed subscription.
+
+    Cached searches around its old and new cell are dropped as well.
+    """
+    was_ready = index.ready
+    old = index.where(user_id)
+    try:
+        row = conn.execute(_SELECT + " WHERE user_id = ?", (user_id,)).fetchone()
+    except Exception:
+        logging.exception("worker index reload failed for %s", user_id)
+        search_cache.clear()
+        return
+    if row is None:
+        index.remove(user_id)
+    else:
+        index.upsert_row(row)
+    if not was_ready:
+        # the old position is unknown until the first load finished
+        search_cache.clear()
+        return
+    for where in {old, index.where(user_id)}:
+        if where:
+            search_cache.invalidate(where[0], where[2])
+
+
+async def run_resync(path=None, interval=RESYNC_SECONDS):
+    """Background task: periodically rebuild so writes from the other bot process show up."""
+    from src.utils import db_executor
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await db_executor.run_read(load, path)
+            # the resync may bring changes from the other process; cached searches predate them
+            search_cache.clear()
+        except Exception:
+            logging.exception("worker index resync failed")
@@ -0,0 +1,85 @@
+"""Keyword search over worker names and specialisations (SQLite FTS5).
+
+workers_fts (schema migration 12) indexes name, education_specialization,
+work_specialization, vehicle_type, company_name and floor_type of every
+worker; its rowid is workers.id. Triggers on workers keep it in sync on
+insert, update and delete, so both bots and every script that writes workers
+keep it current without extra code.
+
+Arabic is folded the same way on both sides -- alef/hamza forms to "ا", "ى" to
+"ي", "ة" to "ه", no tatweel or diacritics -- with SQL replace() in the triggers
+(no custom function needed on the connection) and labels.normalize() for the
+query. Every query word matches as a prefix with or without the article "ال"
+or a leading "و", so "فيزياء" finds "الفيزياء والكيمياء" and "نقل أثاث" finds
+"نقل الاثاث".
+
+filter_sql() returns an ``id IN (...)`` condition to AND into the existing
+service / geo-cell queries: the keyword narrows results through the index,
+nothing is scanned in Python.
+"""
+from src.utils import labels
+
+COLUMNS = ("name", "education_specialization", "work_specialization", "vehicle_type", "company_name", "floor_type")
+
+# (from, to) folds applied inside the triggers; must match query_terms()
+_SQL_FOLDS = (("أ", "ا"), ("إ", "ا"), ("آ", "ا"), ("ى", "ي"), ("ة", "ه"), ("ـ", "")) + tuple(
+    (chr(c), "") for c in range(0x064B, 0x0653))  # diacritics (tashkeel); unicode61 keeps them
+# prefixes a stored word may carry in front of a query word
+_PREFIXES = ("", "ال", "و", "وال")
+
+
+def sql_fold(expr):
+    """SQL expression folding Arabic letter variants of `expr` (used by the triggers)."""
+    for src, dst in _SQL_FOLDS:
+        expr = f"replace({expr}, '{src}', '{dst}')"
+    return expr
+
+
+def query_terms(text):
+    """Search words of `text`, folded like the index and without the article."""
+    words = labels.normalize(text).replace("ة", "ه").split()
+    return [w for w in (labels.strip_definite_article(w) for w in words) if w]
+
+
+def match_query(text):
+    """FTS5 MATCH expression for free text (every word must match), or None if nothing to search."""
+    terms = query_terms(text)
+    if not terms:
+        return None
+    # normalize() leaves only letters, digits, "_" and spaces, so no quoting issues;
+    # stored words may carry the article or a leading "و" ("والكيمياء")
+    return " AND ".join("(" + " OR ".join(f'"{p}{t}"*' for p in _PREFIXES) + ")" for t in terms)
+
+
+def filter_sql(text, id_column="id"):
+    """(sql, params) narrowing a workers query to keyword matches, or ("", []) without a keyword."""
+    q = match_query(text)
+    if q is None:
+        return "", []
+    return f"{id_column} IN (SELECT rowid FROM workers_fts WHERE workers_fts MATCH ?)", [q]
+
+
+def create_schema(conn):
+    """FTS table, sync triggers and backfill. Only used inside migrations."""
+    cols = ", ".join(COLUMNS)
+    conn.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS workers_fts USING fts5({cols}, tokenize = 'unicode61 remove_diacritics 2')")
+    new_vals = ", ".join(sql_fold(f"COALESCE(new.{c}, '')") for c in COLUMNS)
+    conn.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS workers_fts_ai AFTER INSERT ON workers BEGIN
+        INSERT INTO workers_fts (rowid, {cols}) VALUES (new.id, {new_vals});
+    END
+    """)
+    conn.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS workers_fts_au AFTER UPDATE OF {cols} ON workers BEGIN
+        DELETE FROM workers_fts WHERE rowid = old.id;
+        INSERT INTO workers_fts (rowid, {cols}) VALUES (new.id, {new_vals});
+    END
+    """)
+    conn.execute("""
+    CREATE TRIGGER IF NOT EXISTS workers_fts_ad AFTER DELETE ON workers BEGIN
+        DELETE FROM workers_fts WHERE rowid = old.id;
+    END
+    """)
+    conn.execute("DELETE FROM workers_fts")
+    vals = ", ".join(sql_fold(f"COALESCE({c}, '')") for c in COLUMNS)
+    conn.execute(f"INSERT INTO workers_fts (rowid, {cols}) SELECT id, {vals} FROM workers")